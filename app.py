@@ -10,6 +10,7 @@ import sys
 import time
 import json
 import datetime
+import functools
 import threading
 import logging
 import requests
@@ -18,10 +19,16 @@ from flask import Flask, request, abort, jsonify
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
-    Configuration, ApiClient, MessagingApi, ReplyMessageRequest, PushMessageRequest, TextMessage, ImageMessage
+    ReplyMessageRequest, PushMessageRequest, TextMessage, ImageMessage
 )
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 
+from src.logging_setup import setup_logging
+from src.line_client import line_client, get_messaging_api
+from src.line_sender import line_sender, text_messages
+from src.trigger_matcher import match_trigger
+from src.conversation_store import conversation_store
+
 # 導入緩存模塊
 try:
     from src.response_cache import response_cache
@@ -30,10 +37,77 @@ except ImportError:
     CACHE_ENABLED = False
     logging.warning("無法導入回應緩存模塊，跳過緩存功能")
 
+# 導入流量限制器
+try:
+    from src.rate_limiter import gemini_limiter, LANE_CHAT
+    RATE_LIMITER_ENABLED = True
+except ImportError:
+    RATE_LIMITER_ENABLED = False
+    logging.warning("無法導入流量限制器模塊，跳過流量控制")
+
+# 導入配額降級策略
+try:
+    from src.degradation_policy import degradation_policy, LEVEL_CACHE_ONLY, LEVEL_BACKUP_ONLY
+    DEGRADATION_ENABLED = True
+except ImportError:
+    DEGRADATION_ENABLED = False
+    logging.warning("無法導入配額降級策略模塊，跳過降級功能")
+
+# 導入 webhook 事件派送工作池
+try:
+    from src.webhook_dispatcher import WebhookDispatcher, sign_webhook_body, split_webhook_events, event_ordering_key
+    DISPATCHER_ENABLED = True
+except ImportError:
+    DISPATCHER_ENABLED = False
+    logging.warning("無法導入 webhook 派送模塊，webhook 將同步處理")
+
+# 導入持久化事件佇列
+try:
+    from src.event_queue import DurableEventQueue
+    EVENT_QUEUE_ENABLED = DISPATCHER_ENABLED
+except ImportError:
+    EVENT_QUEUE_ENABLED = False
+    logging.warning("無法導入持久化事件佇列模塊，事件只保存在記憶體中")
+
+# 導入持久化推送佇列（推送失敗時重試，無法送達的請求保存在 dead_letters）
+try:
+    from src.outbound_queue import outbound_queue
+    OUTBOUND_QUEUE_ENABLED = True
+except Exception as e:
+    OUTBOUND_QUEUE_ENABLED = False
+    logging.warning(f"無法初始化推送佇列，推送失敗時不會重試: {str(e)}")
+
+# 導入 webhook 事件預先過濾（群組中不是給機器人的訊息在 SDK 解析前丟棄）
+try:
+    from src.webhook_prefilter import WebhookPrefilter
+    PREFILTER_ENABLED = DISPATCHER_ENABLED and os.getenv("WEBHOOK_PREFILTER", "true").lower() != "false"
+except ImportError:
+    PREFILTER_ENABLED = False
+    logging.warning("無法導入 webhook 預先過濾模塊，所有事件都會交給 SDK 處理")
+
+# 導入訊息合併模組（由 PEANUT_DEBOUNCE_MS 啟用）
+try:
+    from src.message_debouncer import MessageDebouncer
+    DEBOUNCE_ENABLED = True
+except ImportError:
+    DEBOUNCE_ENABLED = False
+    logging.warning("無法導入訊息合併模塊，每則訊息將分別處理")
+
+# 導入回覆傳送策略
+try:
+    from src.delivery_policy import delivery_policy
+    DELIVERY_POLICY_ENABLED = True
+except ImportError:
+    DELIVERY_POLICY_ENABLED = False
+    logging.warning("無法導入回覆傳送策略模塊，將使用固定的回覆流程")
+
 # 導入花生助手新功能模組
 try:
     from src.peanut_assistant import peanut_assistant
-    import asyncio
+    from src.async_runtime import run_coroutine
+    from src.chat_history_index import chat_history_index
+    from src.json_store import json_store
+    from src.jsonl_journal import jsonl_journal
     PEANUT_ENABLED = True
     logging.info("花生助手增強功能已啟用")
 except ImportError as e:
@@ -53,21 +127,22 @@ print("="*80)
 # 初始化Flask應用
 app = Flask(__name__)
 
-# 配置日誌
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]
-)
-logger = logging.getLogger(__name__)
-
-# 載入環境變數
+# 載入環境變數（日誌設定也從環境變數讀取，需先載入）
+dotenv_error = None
 try:
     from dotenv import load_dotenv
     load_dotenv()
-    logger.info("環境變數載入成功")
 except Exception as e:
-    logger.error(f"載入環境變數時發生錯誤: {str(e)}")
+    dotenv_error = e
+
+# 配置日誌（結構化、非同步輸出，詳見 src/logging_setup.py）
+setup_logging()
+logger = logging.getLogger(__name__)
+
+if dotenv_error:
+    logger.error(f"載入環境變數時發生錯誤: {str(dotenv_error)}")
+else:
+    logger.info("環境變數載入成功")
 
 # 環境變數
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
@@ -76,13 +151,7 @@ RENDER_SERVICE_URL = os.getenv('RENDER_SERVICE_URL')
 # 獲取Gemini API金鑰 - 注意兩種可能的環境變數名稱
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY') or os.getenv('GEMINI_KEY')
 
-# 對話歷史紀錄儲存
-# 使用使用者ID作為鍵，儲存該使用者的對話歷史
-conversation_histories = {}
-
-# 對話狀態追蹤
-# 使用使用者ID作為鍵，紀錄用戶是否正在進行連續對話及最後互動時間
-active_conversations = {}
+# 對話歷史與連續對話狀態存放在 conversation_store（有使用者數量上限與閒置逾時，詳見 src/conversation_store.py）
 
 # 連續對話超時時間（秒）
 CONVERSATION_TIMEOUT = 300  # 5分鐘無互動後結束對話
@@ -96,15 +165,6 @@ if GEMINI_API_KEY:
         # 導入套件並設置API金鑰
         import google.generativeai as genai
         genai.configure(api_key=GEMINI_API_KEY)
-        
-        # 測試API連接並列出可用模型
-        try:
-            models = list(genai.list_models())
-            model_names = [model.name for model in models]
-            logger.info(f"成功連接Gemini API，可用模型: {model_names}")
-        except Exception as api_e:
-            logger.warning(f"Gemini API金鑰已設置，但測試連接失敗: {str(api_e)}")
-    
     except ImportError:
         logger.warning("未能載入google-generativeai套件，AI回應功能將受限")
         logger.warning("請確認已安裝該套件：pip install google-generativeai>=0.3.1")
@@ -156,14 +216,29 @@ def self_ping_service():
         # 休眠10分鐘（Render Free Tier休眠時間為15分鐘）
         time.sleep(10 * 60)
 
-# 在Render環境中啟動自我保活機制
-if os.getenv('RENDER', ''):
-    ping_thread = threading.Thread(target=self_ping_service, daemon=True)
-    ping_thread.start()
-    logger.info("自我保活機制已在後台啟動")
+def start_self_ping():
+    """在Render環境中啟動自我保活機制（gunicorn 設定檔只在主程序呼叫一次）"""
+    if os.getenv('RENDER', ''):
+        ping_thread = threading.Thread(target=self_ping_service, daemon=True)
+        ping_thread.start()
+        logger.info("自我保活機制已在後台啟動")
+
+def check_gemini_connection():
+    """測試Gemini API連接並列出可用模型"""
+    if not GEMINI_API_KEY:
+        return
+    try:
+        import google.generativeai as genai
+        models = list(genai.list_models())
+        model_names = [model.name for model in models]
+        logger.info(f"成功連接Gemini API，可用模型: {model_names}")
+    except ImportError:
+        pass
+    except Exception as api_e:
+        logger.warning(f"Gemini API金鑰已設置，但測試連接失敗: {str(api_e)}")
 
 # LINE Bot API設置
-configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
+line_client.configure(access_token=LINE_CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(LINE_CHANNEL_SECRET or "dummy_secret_for_initialization")
 
 @app.route("/", methods=['GET'])
@@ -290,22 +365,51 @@ def health():
                 "details": gemini_details
             }
         },
-        "cache": cache_info
+        "cache": cache_info,
+        "rate_limits": gemini_limiter.get_effective_limits() if RATE_LIMITER_ENABLED else {"enabled": False},
+        "degradation": degradation_policy.get_status() if DEGRADATION_ENABLED else {"enabled": False},
+        "webhook_queue": webhook_dispatcher.get_stats() if DISPATCHER_ENABLED else {"enabled": False},
+        "event_store": event_queue.get_stats() if EVENT_QUEUE_ENABLED else {"enabled": False},
+        "debounce": message_debouncer.get_stats() if DEBOUNCE_ENABLED else {"enabled": False},
+        "delivery": delivery_policy.get_stats() if DELIVERY_POLICY_ENABLED else {"enabled": False},
+        "line_sender": line_sender.get_stats(),
+        "outbound_queue": outbound_queue.get_stats() if OUTBOUND_QUEUE_ENABLED else {"enabled": False},
+        "prefilter": webhook_prefilter.get_stats() if PREFILTER_ENABLED else {"enabled": False},
+        "conversations": conversation_store.get_stats(),
+        "chat_history_index": chat_history_index.get_stats() if PEANUT_ENABLED and chat_history_index else {"enabled": False},
+        "json_store": json_store.get_stats() if PEANUT_ENABLED else {"enabled": False},
+        "content_journal": jsonl_journal.get_stats() if PEANUT_ENABLED else {"enabled": False}
     })
 
-# 對話歷史紀錄儲存
-# 使用使用者ID作為鍵，儲存該使用者的對話歷史
-conversation_histories = {}
-
-# 對話狀態追蹤
-# 使用使用者ID作為鍵，紀錄用戶是否正在進行連續對話及最後互動時間
-active_conversations = {}
+@app.route("/limiter/stats", methods=['GET'])
+def limiter_stats():
+    """流量限制器遙測：各通道統計與每日配額用盡預測"""
+    if not RATE_LIMITER_ENABLED:
+        return jsonify({"enabled": False}), 503
+    stats = gemini_limiter.get_stats()
+    if DEGRADATION_ENABLED:
+        stats["degradation"] = degradation_policy.get_status()
+    return jsonify(stats)
 
-# 連續對話超時時間（秒）
-CONVERSATION_TIMEOUT = 300  # 5分鐘無互動後結束對話
-
-# 對話歷史記錄上限
-MAX_HISTORY = 10  # 保留最近10輪對話
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    """Prometheus 格式的指標"""
+    body = conversation_store.render_prometheus()
+    if DISPATCHER_ENABLED:
+        body += webhook_dispatcher.render_prometheus()
+    if EVENT_QUEUE_ENABLED:
+        body += event_queue.render_prometheus()
+    if OUTBOUND_QUEUE_ENABLED:
+        body += outbound_queue.render_prometheus()
+    if PREFILTER_ENABLED:
+        body += webhook_prefilter.render_prometheus()
+    if not RATE_LIMITER_ENABLED:
+        return body, 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    body += gemini_limiter.render_prometheus()
+    if DEGRADATION_ENABLED:
+        body += "# TYPE gemini_degradation_level gauge\n"
+        body += f"gemini_degradation_level {degradation_policy.current_level()}\n"
+    return body, 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
 
 # 預先定義的回應模板
 weather_response = """
@@ -353,82 +457,30 @@ help_response = """
 """
 
 def extract_query(message):
-    """從訊息中提取實際查詢內容"""
-    user_question = message.strip()
-    
-    # 處理明確的前綴
-    for prefix in ['ai:', 'ai：', '@ai ', '@ai', 'ai ']:
-        if user_question.lower().startswith(prefix):
-            user_question = user_question[len(prefix):]
-            break
-    
-    # 處理「小幫手」和「花生」關鍵字
-    keywords = ['小幫手', '花生', 'AI', 'ai']
-    
-    for keyword in keywords:
-        # 如果關鍵字在開頭，移除它
-        if user_question.startswith(keyword):
-            user_question = user_question[len(keyword):]
-            break
-    
-    # 處理允許的前導字符
-    allowed_prefixes = ['!', '！', ',', '，', '。', '.', '?', '？', ' ', '　', ':', '：', '@', '#', '$', '%', '、', '~', '～']
-    keywords = ['小幫手', '花生']
-    
-    for keyword in keywords:
-        # 如果關鍵字在開頭，移除它
-        if message.startswith(keyword):
-            return message[len(keyword):].strip()
-        
-        # 處理有前導字符的情況
-        if len(message) > 1:
-            first_char = message[0]
-            # 單個前導字符
-            if first_char in allowed_prefixes and message[1:].startswith(keyword):
-                return message[1 + len(keyword):].strip()
-            
-            # 前導字符+空格的情況 (如 ". 小幫手")
-            if len(message) > 2 and first_char in allowed_prefixes and message[1] == ' ':
-                if message[2:].startswith(keyword):
-                    return message[2 + len(keyword):].strip()
-    
-    # 處理「花生」字符級別檢測
-    flower_char = '花'
-    life_char = '生'
-    
-    # 直接在句首的「花生」
-    if message.startswith(flower_char) and len(message) > 1:
-        if message[1] == life_char:
-            return message[2:].strip()
-    
-    # 允許的前導字符後的「花生」
-    if len(message) > 2 and message[0] in allowed_prefixes:
-        # 一個前導字符的情況
-        if message[1] == flower_char and message[2] == life_char:
-            return message[3:].strip()
-        
-        # 前導字符+空格的情況
-        elif message[1] == ' ' and len(message) > 3:
-            if message[2] == flower_char and message[3] == life_char:
-                return message[4:].strip()
-    
-    return user_question.strip()
+    """從訊息中提取實際查詢內容（去除觸發詞與開頭的分隔符號）"""
+    return match_trigger(message).query
 
 def get_ai_response(message, conversation_history=None):
     """獲取AI回應"""
     # 提取用戶問題
     user_question = message
     
+    # 依配額狀況決定降級等級（3: 只用緩存，4: 直接使用備用系統）
+    degradation_level = degradation_policy.current_level() if DEGRADATION_ENABLED else 0
+    
     # 嘗試從緩存中獲取回應
-    if CACHE_ENABLED:
+    if CACHE_ENABLED and degradation_level < LEVEL_BACKUP_ONLY:
         cached_response = response_cache.get(user_question)
         if cached_response:
             logger.info(f"使用緩存回應: {user_question[:30]}...")
             return cached_response
     
+    if DEGRADATION_ENABLED and degradation_level >= LEVEL_CACHE_ONLY:
+        logger.warning(f"配額降級中 (等級 {degradation_level})，不呼叫 Gemini API，改用備用系統")
+    
     # 嘗試使用Gemini API (如果可用)
     try:
-        if GEMINI_API_KEY and 'genai' in globals():
+        if GEMINI_API_KEY and 'genai' in globals() and degradation_level < LEVEL_CACHE_ONLY:
             try:
                 # 獲取可用模型列表
                 available_models = [model.name for model in genai.list_models()]
@@ -500,10 +552,21 @@ def get_ai_response(message, conversation_history=None):
                             # 簡化提示詞，減少令牌消耗
                             prompt = f"簡單回答: {user_question}"
                         
+                        # 配額降級時縮減輸出長度
+                        if DEGRADATION_ENABLED:
+                            max_tokens = degradation_policy.max_output_tokens(generation_config.get("max_output_tokens"))
+                            if max_tokens:
+                                generation_config["max_output_tokens"] = max_tokens
+                        
+                        # 透過 chat 通道取得配額，不足時直接改用備用系統
+                        if RATE_LIMITER_ENABLED and not gemini_limiter.wait_if_needed(lane=LANE_CHAT):
+                            logger.warning("Gemini 對話通道配額不足，改用備用回應")
+                            break
+                        
                         logger.info(f"嘗試 #{retry+1}/{max_retries+1}，調用Gemini API生成回應")
                         
                         # 生成回應
-                        if generation_config and retry > 0:
+                        if generation_config:
                             response = model.generate_content(prompt, generation_config=generation_config)
                         else:
                             response = model.generate_content(prompt)
@@ -511,6 +574,8 @@ def get_ai_response(message, conversation_history=None):
                         if response and hasattr(response, 'text') and response.text:
                             # 檢查回應內容是否有效
                             response_text = response.text
+                            if RATE_LIMITER_ENABLED:
+                                gemini_limiter.record_success()
                             
                             # 使用專用緩存模組保存回應
                             if CACHE_ENABLED:
@@ -531,6 +596,8 @@ def get_ai_response(message, conversation_history=None):
                         
                         # 更細緻的錯誤分類
                         if "429" in error_str:  # 配額限制錯誤
+                            if RATE_LIMITER_ENABLED:
+                                gemini_limiter.record_quota_error(error_str)
                             # 使用指數退避策略
                             retry_delay_seconds = min(base_retry_delay * (2 ** retry), 15)
                             logger.warning(f"Gemini API配額限制(429)，等待{retry_delay_seconds}秒後重試 ({retry+1}/{max_retries})")
@@ -539,10 +606,15 @@ def get_ai_response(message, conversation_history=None):
                             
                         elif "404" in error_str:  # 模型未找到錯誤
                             logger.error(f"模型'{model_name}'未找到(404)，嘗試其他模型")
-                            # 嘗試回退到其他模型
+                            # 嘗試回退到其他模型（配額降級時不再探測，避免浪費配額）
                             fallback_models = ["gemini-pro", "gemini-1.0-pro"]
+                            if DEGRADATION_ENABLED and not degradation_policy.allow_fallback_probes():
+                                logger.info("配額降級中，跳過回退模型探測")
+                                fallback_models = []
                             for fallback in fallback_models:
                                 if fallback != model_name:
+                                    if RATE_LIMITER_ENABLED and not gemini_limiter.wait_if_needed(lane=LANE_CHAT):
+                                        break
                                     try:
                                         logger.info(f"嘗試回退模型: {fallback}")
                                         fallback_model = genai.GenerativeModel(fallback)
@@ -689,98 +761,10 @@ def get_ai_response(message, conversation_history=None):
 感謝您的理解！"""
 
 def is_ai_request(message):
-    """檢查是否為AI請求 (最終版: 僅檢測訊息開頭或帶允許前導字符的關鍵字)"""
-    if not message:
-        return False
-    
-    # 添加日誌以查看接收到的確切訊息
-    logger.info(f"檢測訊息是否為AI請求: '{message}'")
-    
-    # 嘗試處理可能的特殊字符或編碼問題
-    normalized_message = message
-    try:
-        # 先嘗試規範化字符
-        import unicodedata
-        normalized_message = unicodedata.normalize('NFKC', message)
-        if normalized_message != message:
-            logger.info(f"已規範化訊息: '{normalized_message}'")
-    except Exception as e:
-        logger.error(f"規範化訊息時出錯: {str(e)}")
-    
-    # 去除前後空格，便於檢查句首關鍵字
-    trimmed_message = normalized_message.strip()
-    message_lower = trimmed_message.lower()
-    
-    # 1. 檢查常見的AI前綴 (必須在句首)
-    if (message_lower.startswith(('ai:', 'ai：')) or 
-        message_lower.startswith(('@ai', '@ai ')) or
-        message_lower.startswith('ai ') or 
-        message_lower == 'ai'):
-        logger.info("識別為AI請求: 前綴匹配")
-        return True
-    
-    # 2. 檢查中文關鍵字是否在句首或帶有允許的前導字符
-    keywords = ['小幫手', '花生']
-    
-    # 允許的前導字符列表
-    allowed_prefixes = ['!', '！', ',', '，', '。', '.', '?', '？', ' ', '　', ':', '：', '@', '#', '$', '%', '、', '~', '～']
-    
-    for keyword in keywords:
-        # 檢查關鍵字是否在句首
-        if trimmed_message.startswith(keyword):
-            logger.info(f"識別為AI請求: 檢測到句首關鍵字 '{keyword}'")
-            return True
-        
-        # 檢查是否有允許的前導字符後接關鍵字
-        if len(trimmed_message) > 1:
-            # 處理只有一個前導字符的情況
-            first_char = trimmed_message[0]
-            if first_char in allowed_prefixes and trimmed_message[1:].startswith(keyword):
-                logger.info(f"識別為AI請求: 檢測到帶前導字符的關鍵字 '{keyword}', 前導字符: '{first_char}'")
-                return True
-            
-            # 處理有前導字符和空格的情況 (如 ". 小幫手")
-            if len(trimmed_message) > 2 and first_char in allowed_prefixes:
-                # 特殊處理點號+空格情況
-                if first_char == '.' and trimmed_message[1] == ' ' and trimmed_message[2:].startswith(keyword):
-                    logger.info(f"識別為AI請求: 檢測到特殊點號和空格前導的關鍵字 '{keyword}'")
-                    return True
-                
-                # 正常處理其他前導字符+空格情況
-                if trimmed_message[1] == ' ' and trimmed_message[2:].startswith(keyword):
-                    logger.info(f"識別為AI請求: 檢測到帶前導字符和空格的關鍵字 '{keyword}', 前導字符: '{first_char} '")
-                    return True
-    
-    # 3. 特殊處理「花生」(字符級別)
-    flower_char = '花'
-    life_char = '生'
-    
-    # 直接在句首的「花生」
-    if trimmed_message.startswith(flower_char) and len(trimmed_message) > 1:
-        if trimmed_message[1] == life_char:
-            logger.info(f"識別為AI請求: 通過字符級別檢測到句首 '花生' 關鍵字")
-            return True
-    
-    # 允許的前導字符後的「花生」
-    if len(trimmed_message) > 2 and trimmed_message[0] in allowed_prefixes:
-        # 一個前導字符的情況
-        if trimmed_message[1] == flower_char and trimmed_message[2] == life_char:
-            logger.info(f"識別為AI請求: 通過字符級別檢測到帶前導字符的 '花生' 關鍵字")
-            return True
-            
-        # 前導字符+空格的情況 (如 ". 花生")
-        elif trimmed_message[1] == ' ' and len(trimmed_message) > 3:
-            if trimmed_message[2] == flower_char and trimmed_message[3] == life_char:
-                logger.info(f"識別為AI請求: 通過字符級別檢測到帶前導字符和空格的 '花生' 關鍵字")
-                return True
-    
-    # 所有檢查都未通過
-    logger.info("非AI請求: 未檢測到句首或帶允許前導字符的觸發關鍵字")
-    return False
-    
-    # 如果經過所有檢查都不符合條件
-    logger.info("非AI請求: 未檢測到任何觸發關鍵字")
-    return False
+    """檢查是否為AI請求（訊息開頭為 AI 前綴，或帶允許前導字符的「小幫手」、「花生」）"""
+    trigger = match_trigger(message)
+    logger.debug(f"觸發詞比對結果: {trigger.kind or '非AI請求'}")
+    return trigger.is_trigger
 
 @app.route("/callback", methods=['POST'])
 def callback():
@@ -795,7 +779,34 @@ def callback():
     
     # 獲取請求體
     body = request.get_data(as_text=True)
-    logger.info("請求體: %s", body)
+    logger.debug("請求體: %s", body)
+    
+    # 驗證簽名後立即回應，事件交由背景工作池處理
+    if DISPATCHER_ENABLED:
+        if not handler.parser.signature_validator.validate(body, signature):
+            logger.error("無效的簽名")
+            abort(400)
+        try:
+            events = split_webhook_events(body, webhook_prefilter.should_process if PREFILTER_ENABLED else None)
+        except ValueError as e:
+            logger.error("無法解析webhook請求體: %s", e)
+            abort(400)
+        # 同一使用者的事件排入同一通道依序處理，不同使用者平行處理
+        for event, event_body in events:
+            ordering_key = event_ordering_key(event)
+            if EVENT_QUEUE_ENABLED:
+                # 先寫入持久化佇列（同時去除重送造成的重複事件）再交給工作池
+                row_id = event_queue.enqueue(
+                    event.get("webhookEventId"),
+                    event_body,
+                    (event.get("deliveryContext") or {}).get("isRedelivery", False),
+                    ordering_key
+                )
+                if row_id is not None:
+                    webhook_dispatcher.submit(row_id, ordering_key)
+            else:
+                webhook_dispatcher.submit(event_body, ordering_key)
+        return 'OK'
     
     # 處理webhook請求體
     try:
@@ -808,53 +819,111 @@ def callback():
     
     return 'OK'
 
+def process_webhook_event(event_body):
+    """在背景工作執行緒中處理單一事件（重新簽名後交給 handler 分派）"""
+    handler.handle(event_body, sign_webhook_body(LINE_CHANNEL_SECRET or "dummy_secret_for_initialization", event_body))
+
+# 目前派送執行緒正在處理的持久化事件（放進訊息合併緩衝區時延後標記完成）
+_event_context = threading.local()
+
+def process_queued_event(row_id):
+    """領取持久化佇列中的事件並處理，成功後標記完成，失敗則排程重試"""
+    item = event_queue.claim(row_id)
+    if item is None:
+        return  # 已被其他工作者處理
+    _event_context.row_id = row_id
+    _event_context.deferred = False
+    try:
+        process_webhook_event(item["body"])
+    except Exception as e:
+        event_queue.fail(row_id, str(e))
+        raise
+    finally:
+        _event_context.row_id = None
+    # 放進合併緩衝區的事件在整批處理完成後才標記完成
+    if not _event_context.deferred:
+        event_queue.complete(row_id)
+
+def process_dispatched_item(item):
+    """派送執行緒的處理函數：webhook 事件，或訊息合併窗口結束後的整批訊息（callable）"""
+    if callable(item):
+        item()
+    elif EVENT_QUEUE_ENABLED:
+        process_queued_event(item)
+    else:
+        process_webhook_event(item)
+
+if EVENT_QUEUE_ENABLED:
+    try:
+        event_queue = DurableEventQueue(os.getenv("WEBHOOK_QUEUE_DB"))
+    except Exception as e:
+        EVENT_QUEUE_ENABLED = False
+        logger.error(f"初始化持久化事件佇列失敗，事件只保存在記憶體中: {str(e)}")
+
+if DISPATCHER_ENABLED:
+    webhook_dispatcher = WebhookDispatcher(
+        process_dispatched_item,
+        workers=int(os.getenv("WEBHOOK_WORKERS", "4")),
+        queue_size=int(os.getenv("WEBHOOK_QUEUE_SIZE", "100"))
+    )
+
+# 不需要觸發詞的指令（handle_message 與預先過濾共用）
+IMAGE_COMMAND_PREFIX = '生成圖片'
+DAILY_ENGLISH_COMMANDS = ['每日單字', '每日英語', 'Daily English', 'daily english', '單字']
+HELP_COMMANDS = ['使用說明', '說明', 'help', '幫助', '功能', '花生說明']
+END_CONVERSATION_COMMANDS = ['結束', '結束對話', '停止', '停止對話', 'exit', 'quit', 'stop']  # 不分大小寫
+
+def is_debounce_window_open(chat_id, user_id):
+    """該使用者是否還有尚未送出的合併批次（後續訊息即使沒有觸發詞也要處理）"""
+    return DEBOUNCE_ENABLED and message_debouncer.is_open((chat_id, user_id))
+
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event):
     """處理文字訊息"""
-    logger.info("收到訊息事件: %s", event)
+    logger.debug("收到訊息事件: %s", event)
     
     user_id = event.source.user_id
     user_message = event.message.text
     reply_token = event.reply_token
+    # 事件時間戳（毫秒），用於判斷 reply token 是否仍可使用
+    received_at = event.timestamp / 1000 if getattr(event, "timestamp", None) else None
     
     # 獲取訊息來源 (可能是群組、聊天室或個人)
     source_type = event.source.type
     if source_type == 'group':
         chat_id = event.source.group_id
-        logger.info("群組 %s 中的用戶 %s 發送訊息: %s", chat_id, user_id, user_message)
+        logger.info("群組 %s 中的用戶 %s 發送訊息 (%d 字)", chat_id, user_id, len(user_message))
     elif source_type == 'room':
         chat_id = event.source.room_id
-        logger.info("聊天室 %s 中的用戶 %s 發送訊息: %s", chat_id, user_id, user_message)
+        logger.info("聊天室 %s 中的用戶 %s 發送訊息 (%d 字)", chat_id, user_id, len(user_message))
     else:
         chat_id = user_id
-        logger.info("用戶 %s 發送訊息: %s", user_id, user_message)
+        logger.info("用戶 %s 發送訊息 (%d 字)", user_id, len(user_message))
     
     # 檢查是否為「生成圖片」指令
-    if user_message.strip().startswith('生成圖片'):
+    if user_message.strip().startswith(IMAGE_COMMAND_PREFIX):
         try:
             # 提取圖片描述提示詞
-            prompt = user_message.strip()[4:].strip()  # 移除「生成圖片」四個字
+            prompt = user_message.strip()[len(IMAGE_COMMAND_PREFIX):].strip()  # 移除「生成圖片」四個字
             
             if not prompt:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=reply_token,
-                            messages=[TextMessage(text="請提供圖片描述！\n\n使用方式：\n生成圖片 一隻可愛的貓咪在玩毛線球")]
-                        )
-                    )
-                return
-            
-            # 先回覆「正在生成」訊息
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
+                line_bot_api = get_messaging_api()
                 line_bot_api.reply_message(
                     ReplyMessageRequest(
                         reply_token=reply_token,
-                        messages=[TextMessage(text=f"🎨 正在為您生成圖片...\n描述：{prompt}\n\n使用 AI 圖片生成技術\n請稍候約10-15秒")]
+                        messages=[TextMessage(text="請提供圖片描述！\n\n使用方式：\n生成圖片 一隻可愛的貓咪在玩毛線球")]
                     )
                 )
+                return
+            
+            # 先回覆「正在生成」訊息
+            line_bot_api = get_messaging_api()
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=reply_token,
+                    messages=[TextMessage(text=f"🎨 正在為您生成圖片...\n描述：{prompt}\n\n使用 AI 圖片生成技術\n請稍候約10-15秒")]
+                )
+            )
             
             # 生成圖片
             from src.image_generation_service import generate_image_with_gemini
@@ -864,51 +933,48 @@ def handle_message(event):
             
             if image_url:
                 # 推送圖片訊息到原訊息來源 (群組或個人)
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    
-                    # 直接發送圖片訊息到訊息來源
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=chat_id,
-                            messages=[
-                                TextMessage(text=f"✅ 圖片生成成功！\n描述：{prompt}"),
-                                ImageMessage(
-                                    original_content_url=image_url,
-                                    preview_image_url=image_url
-                                )
-                            ]
-                        )
+                line_bot_api = get_messaging_api()
+                
+                # 直接發送圖片訊息到訊息來源
+                line_bot_api.push_message(
+                    PushMessageRequest(
+                        to=chat_id,
+                        messages=[
+                            TextMessage(text=f"✅ 圖片生成成功！\n描述：{prompt}"),
+                            ImageMessage(
+                                original_content_url=image_url,
+                                preview_image_url=image_url
+                            )
+                        ]
                     )
+                )
                 
                 logger.info(f"圖片生成成功並發送到: {chat_id}")
             else:
                 # 生成失敗
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=chat_id,
-                            messages=[TextMessage(text="❌ 圖片生成失敗，請稍後再試\n\n可能原因：\n1. 網路連線問題\n2. 提示詞包含不當內容\n3. 服務暫時不可用")]
-                        )
+                line_bot_api = get_messaging_api()
+                line_bot_api.push_message(
+                    PushMessageRequest(
+                        to=chat_id,
+                        messages=[TextMessage(text="❌ 圖片生成失敗，請稍後再試\n\n可能原因：\n1. 網路連線問題\n2. 提示詞包含不當內容\n3. 服務暫時不可用")]
                     )
+                )
             
             return
             
         except Exception as e:
             logger.error(f"處理圖片生成時出錯: {str(e)}")
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=chat_id,
-                        messages=[TextMessage(text=f"❌ 處理圖片生成時發生錯誤：{str(e)}")]
-                    )
+            line_bot_api = get_messaging_api()
+            line_bot_api.push_message(
+                PushMessageRequest(
+                    to=chat_id,
+                    messages=[TextMessage(text=f"❌ 處理圖片生成時發生錯誤：{str(e)}")]
                 )
+            )
             return
     
     # 檢查是否為「每日單字」指令
-    if user_message.strip() in ['每日單字', '每日英語', 'Daily English', 'daily english', '單字']:
+    if user_message.strip() in DAILY_ENGLISH_COMMANDS:
         try:
             from src.daily_english_service import get_daily_word, format_daily_english_message, get_word_audio_url, get_sentence_audio_url
             
@@ -921,58 +987,55 @@ def handle_message(event):
             sentence_audio_url = get_sentence_audio_url(word_data['sentence'])
             
             # 回覆訊息
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                
-                messages = [TextMessage(text=message_text)]
-                
-                # 添加發音連結
-                audio_links = []
-                if word_audio_url:
-                    audio_links.append(f"🔊 單字發音:\n{word_audio_url}")
-                if sentence_audio_url:
-                    audio_links.append(f"🔊 例句發音:\n{sentence_audio_url}")
-                
-                if audio_links:
-                    audio_message = "\n\n".join(audio_links)
-                    messages.append(TextMessage(text=audio_message))
-                
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=messages
-                    )
+            line_bot_api = get_messaging_api()
+            
+            messages = [TextMessage(text=message_text)]
+            
+            # 添加發音連結
+            audio_links = []
+            if word_audio_url:
+                audio_links.append(f"🔊 單字發音:\n{word_audio_url}")
+            if sentence_audio_url:
+                audio_links.append(f"🔊 例句發音:\n{sentence_audio_url}")
+            
+            if audio_links:
+                audio_message = "\n\n".join(audio_links)
+                messages.append(TextMessage(text=audio_message))
+            
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=reply_token,
+                    messages=messages
                 )
-                logger.info("已回覆每日單字")
+            )
+            logger.info("已回覆每日單字")
             return
             
         except Exception as e:
             logger.error(f"處理每日單字時出錯: {str(e)}")
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[TextMessage(text="抱歉,獲取每日單字時發生錯誤,請稍後再試。")]
-                    )
+            line_bot_api = get_messaging_api()
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=reply_token,
+                    messages=[TextMessage(text="抱歉,獲取每日單字時發生錯誤,請稍後再試。")]
                 )
+            )
             return
     
     # 檢查是否為「使用說明」請求
-    if user_message.strip() in ['使用說明', '說明', 'help', '幫助', '功能', '花生說明']:
+    if user_message.strip() in HELP_COMMANDS:
         if PEANUT_ENABLED:
             usage_guide = peanut_assistant.get_usage_guide()
         else:
             usage_guide = get_help_message()
         
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text=usage_guide)]
-                )
+        line_bot_api = get_messaging_api()
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=reply_token,
+                messages=[TextMessage(text=usage_guide)]
             )
+        )
         return
     
     # 檢查用戶是否處於活躍對話狀態
@@ -980,191 +1043,266 @@ def handle_message(event):
     is_active_conversation = check_active_conversation(user_id, current_time)
     
     # 檢查是否要結束對話
-    if user_message.lower().strip() in ['結束', '結束對話', '停止', '停止對話', 'exit', 'quit', 'stop']:
+    if user_message.lower().strip() in END_CONVERSATION_COMMANDS:
         if is_active_conversation:
             # 結束對話
             end_conversation(user_id)
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[TextMessage(text="好的，已結束本次對話。有需要時請隨時呼喚我！")]
-                    )
+            line_bot_api = get_messaging_api()
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=reply_token,
+                    messages=[TextMessage(text="好的，已結束本次對話。有需要時請隨時呼喚我！")]
                 )
+            )
             return
     
+    # 合併窗口尚未結束時，同一使用者的後續訊息（即使沒有觸發前綴）併入同一批處理
+    debounce_key = (chat_id, user_id)
+    if DEBOUNCE_ENABLED and message_debouncer.is_open(debounce_key):
+        logger.info("合併窗口中的後續訊息，併入同一批處理")
+        buffer_debounced_message(debounce_key, user_message, reply_token, received_at)
+        return
+    
     # 檢查訊息是否為 AI 對話請求 (必須明確呼叫，不再使用活躍對話自動處理)
     if is_ai_request(user_message):
         # 將用戶設為活躍對話狀態（用於追蹤，但不自動處理未呼叫的訊息）
         start_conversation(user_id)
         logger.info("檢測到AI請求，正在處理...")
-        try:
-            # 如果啟用了花生助手增強功能，優先使用
-            if PEANUT_ENABLED:
-                logger.info("使用花生助手處理訊息")
-                
+        
+        # 啟用訊息合併時先放入緩衝區，窗口結束後再合併處理
+        if DEBOUNCE_ENABLED and message_debouncer.enabled:
+            buffer_debounced_message(debounce_key, user_message, reply_token, received_at)
+            return
+        
+        process_ai_request(user_id, chat_id, reply_token, user_message, received_at)
+    else:
+        logger.info("非AI請求，不處理")
+
+def process_ai_request(user_id, chat_id, reply_token, user_message, received_at=None):
+    """處理 AI 對話請求（花生助手優先，未啟用時使用原有的 Gemini 回應流程）"""
+    # 只比對一次觸發詞，之後重複使用去除前綴後的查詢內容
+    query = extract_query(user_message)
+    try:
+        # 如果啟用了花生助手增強功能，優先使用
+        if PEANUT_ENABLED:
+            logger.info("使用花生助手處理訊息")
+            started = time.monotonic()
+            
+            if DELIVERY_POLICY_ENABLED:
+                # 保留 reply token 給回答；預計來不及在預算內完成時顯示載入動畫
+                plan = delivery_policy.plan(query, received_at)
+                if plan["show_loading"]:
+                    delivery_policy.show_loading(chat_id, plan["estimate"])
+            else:
                 # 先回覆「正在處理」訊息
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=reply_token,
-                            messages=[TextMessage(text="🤔 讓我想想...")]
-                        )
+                line_bot_api = get_messaging_api()
+                line_bot_api.reply_message(
+                    ReplyMessageRequest(
+                        reply_token=reply_token,
+                        messages=[TextMessage(text="🤔 讓我想想...")]
                     )
-                
-                # 使用花生助手處理訊息
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                peanut_result = loop.run_until_complete(
-                    peanut_assistant.process_message(user_id, user_message)
                 )
-                loop.close()
+                reply_token = None
+            
+            # 使用花生助手處理訊息（在共用的背景事件迴圈上執行）
+            peanut_result = run_coroutine(
+                peanut_assistant.process_message(user_id, user_message)
+            )
+            
+            # 檢查是否需要 AI 回應
+            if peanut_result.get("needs_ai_response"):
+                # 需要生成 AI 回應
+                context = peanut_result.get("context", "")
                 
-                # 檢查是否需要 AI 回應
-                if peanut_result.get("needs_ai_response"):
-                    # 需要生成 AI 回應
-                    query = extract_query(user_message)
-                    context = peanut_result.get("context", "")
-                    conversation_history = conversation_histories.get(user_id, [])
-                    
-                    # 構建帶上下文的提示
-                    if context:
-                        full_query = f"以下是用戶的相關記憶：\n{context}\n\n用戶問題：{query}\n\n請根據這些資訊提供個人化的回應。"
-                    else:
-                        full_query = query
-                    
-                    ai_response = get_ai_response(full_query)
-                    update_conversation_history(user_id, query, ai_response)
-                    
-                    # 推送 AI 回應
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=chat_id,
-                                messages=[TextMessage(text=ai_response)]
-                            )
-                        )
+                # 構建帶上下文的提示
+                if context:
+                    full_query = f"以下是用戶的相關記憶：\n{context}\n\n用戶問題：{query}\n\n請根據這些資訊提供個人化的回應。"
                 else:
-                    # 直接推送花生助手的回應
-                    response_text = peanut_result.get("response", "")
-                    if response_text:
-                        with ApiClient(configuration) as api_client:
-                            line_bot_api = MessagingApi(api_client)
-                            line_bot_api.push_message(
-                                PushMessageRequest(
-                                    to=chat_id,
-                                    messages=[TextMessage(text=response_text)]
-                                )
-                            )
+                    full_query = query
                 
-                logger.info("花生助手處理完成")
-                return
-            
-            # 原有的處理邏輯（當花生助手未啟用時）
-            # 取出真實查詢內容（去除前綴）
-            query = user_message
-            if is_ai_request(user_message):
-                # 如果是關鍵字觸發，需要提取查詢內容
-                query = extract_query(user_message)
-            
-            # 獲取或初始化對話歷史
-            conversation_history = conversation_histories.get(user_id, [])
-            
-            # 獲取AI回應
-            start_time = time.time()
-            ai_response = get_ai_response(query)
-            process_time = time.time() - start_time
-            logger.info(f"生成AI回應完成，耗時 {process_time:.2f} 秒")
-            
-            # 更新對話歷史
-            update_conversation_history(user_id, query, ai_response)
+                ai_response = get_ai_response(full_query)
+                update_conversation_history(user_id, query, ai_response)
+                response_text = ai_response
+            else:
+                # 直接使用花生助手的回應
+                response_text = peanut_result.get("response", "")
             
-            # 檢查回應是否為空
-            if not ai_response:
-                ai_response = "抱歉，我目前無法回答這個問題。請稍後再試。"
+            if response_text:
+                if DELIVERY_POLICY_ENABLED:
+                    delivery_policy.deliver(chat_id, reply_token, text_messages(response_text), received_at)
+                    path = delivery_policy.executed_path(plan["path"], peanut_result.get("needs_ai_response"))
+                    delivery_policy.record(path, time.monotonic() - started)
+                else:
+                    line_sender.push(chat_id, text_messages(response_text))
             
-            # 回覆訊息
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                
-                # 發送回覆
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[TextMessage(text=ai_response)]
-                    )
+            logger.info("花生助手處理完成")
+            return
+        
+        # 原有的處理邏輯（當花生助手未啟用時），查詢內容已在上方去除前綴
+        # 獲取AI回應（get_ai_response 不使用對話歷史，對話歷史只在回應後更新）
+        start_time = time.time()
+        ai_response = get_ai_response(query)
+        process_time = time.time() - start_time
+        logger.info(f"生成AI回應完成，耗時 {process_time:.2f} 秒")
+        
+        # 更新對話歷史
+        update_conversation_history(user_id, query, ai_response)
+        
+        # 檢查回應是否為空
+        if not ai_response:
+            ai_response = "抱歉，我目前無法回答這個問題。請稍後再試。"
+        
+        # 發送回覆（過長的回應會分段，超過 5 段的部分改以 push 補送）
+        line_sender.reply(reply_token, text_messages(ai_response), fallback_to=chat_id)
+        logger.info("已回覆AI請求")
+        
+    except Exception as e:
+        logger.error(f"回覆AI訊息時出錯: {str(e)}")
+        try:
+            # 嘗試發送錯誤回覆
+            line_bot_api = get_messaging_api()
+            error_message = "抱歉，處理您的請求時發生錯誤，請稍後再試。"
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=reply_token,
+                    messages=[TextMessage(text=error_message)]
                 )
-                logger.info("已回覆AI請求")
-            
-        except Exception as e:
-            logger.error(f"回覆AI訊息時出錯: {str(e)}")
-            try:
-                # 嘗試發送錯誤回覆
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    error_message = "抱歉，處理您的請求時發生錯誤，請稍後再試。"
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=reply_token,
-                            messages=[TextMessage(text=error_message)]
-                        )
-                    )
-            except Exception as reply_error:
-                logger.error(f"發送錯誤回覆時出錯: {str(reply_error)}")
+            )
+        except Exception as reply_error:
+            logger.error(f"發送錯誤回覆時出錯: {str(reply_error)}")
+
+def merge_burst_messages(texts):
+    """將連續訊息合併為一則：保留第一則的觸發前綴，後續訊息去除前綴後以換行接上"""
+    merged = [texts[0].strip()]
+    for text in texts[1:]:
+        trigger = match_trigger(text)
+        merged.append(trigger.query if trigger.is_trigger else text.strip())
+    return "\n".join(part for part in merged if part)
+
+def buffer_debounced_message(debounce_key, user_message, reply_token, received_at):
+    """放進合併緩衝區；來自持久化佇列的事件改為 buffered，整批處理完成後才標記完成"""
+    row_id = getattr(_event_context, "row_id", None) if EVENT_QUEUE_ENABLED else None
+    if row_id is not None:
+        event_queue.defer([row_id])
+        _event_context.deferred = True
+    message_debouncer.add(debounce_key, user_message, (reply_token, received_at, row_id))
+
+def flush_debounced_messages(key, texts, payloads):
+    """合併窗口結束：交回該使用者的派送通道，與同一使用者的其他事件、其他批次依序處理"""
+    chat_id, user_id = key
+    if DISPATCHER_ENABLED:
+        webhook_dispatcher.submit(functools.partial(process_debounced_messages, key, texts, payloads),
+                                  user_id or chat_id)
     else:
-        logger.info("非AI請求，不處理")
+        process_debounced_messages(key, texts, payloads)
+
+def process_debounced_messages(key, texts, payloads):
+    """處理整批訊息（使用最新一則訊息的 reply token），完成後才標記批次中的持久化事件完成"""
+    chat_id, user_id = key
+    reply_token, received_at, _ = payloads[-1]
+    row_ids = [row_id for _, _, row_id in payloads if row_id is not None]
+    if row_ids:
+        event_queue.defer(row_ids)  # 延長租約，處理期間不會被恢復執行緒重新派送
+    try:
+        process_ai_request(user_id, chat_id, reply_token, merge_burst_messages(texts), received_at)
+    except Exception as e:
+        for row_id in row_ids:
+            event_queue.fail(row_id, str(e))
+        raise
+    for row_id in row_ids:
+        event_queue.complete(row_id)
+
+if DEBOUNCE_ENABLED:
+    message_debouncer = MessageDebouncer(
+        flush_debounced_messages,
+        window_ms=int(os.getenv("PEANUT_DEBOUNCE_MS", "0")),
+        max_delay_ms=int(os.getenv("PEANUT_DEBOUNCE_MAX_MS", "0")) or None,
+        # 有派送器時只負責交回派送通道；沒有時直接處理，以單一執行緒依序執行
+        flush_workers=4 if DISPATCHER_ENABLED else 1
+    )
+
+if PREFILTER_ENABLED:
+    # 觸發詞通過過濾時就開啟後續訊息窗口（與訊息合併相同的窗口設定），
+    # 同一請求體或派送前到達的後續訊息不會在合併窗口開啟前被丟棄
+    debounce_enabled = DEBOUNCE_ENABLED and message_debouncer.enabled
+    webhook_prefilter = WebhookPrefilter(
+        exact_commands=DAILY_ENGLISH_COMMANDS + HELP_COMMANDS,
+        command_prefixes=[IMAGE_COMMAND_PREFIX],
+        keep_func=is_debounce_window_open,
+        casefold_commands=END_CONVERSATION_COMMANDS,
+        follow_up_window=message_debouncer.window if debounce_enabled else 0,
+        follow_up_max_delay=message_debouncer.max_delay if debounce_enabled else None
+    )
+
+# 背景服務（執行緒、連線）不能在 fork 前建立：gunicorn 以 preload_app 載入時，
+# 由 gunicorn.conf.py 設定 DEFER_BACKGROUND_SERVICES，並在每個 worker 啟動後才呼叫
+_background_services_pid = None
+_background_services_lock = threading.Lock()
+
+def start_background_services(self_ping=True):
+    """
+    啟動目前程序的背景服務（每個程序只會啟動一次）
+
+    參數:
+        self_ping: 是否同時啟動自我保活機制（多個 worker 時由 gunicorn 主程序負責）
+    """
+    global _background_services_pid
+    with _background_services_lock:
+        if _background_services_pid == os.getpid():
+            return
+        _background_services_pid = os.getpid()
+
+    if self_ping:
+        start_self_ping()
+    if DISPATCHER_ENABLED and EVENT_QUEUE_ENABLED:
+        # 重新派送重啟前未完成、或到期需要重試的事件
+        event_queue.start_recovery(webhook_dispatcher.submit)
+    if OUTBOUND_QUEUE_ENABLED:
+        # 重送先前失敗的推送
+        outbound_queue.start_worker()
+    # 測試連接需要網路請求，不阻塞 worker 啟動
+    threading.Thread(target=check_gemini_connection, name="gemini-check", daemon=True).start()
+
+def preload_shared_data():
+    """
+    載入唯讀資料（每日單字表等）
+
+    gunicorn 以 preload_app 載入時在主程序呼叫，fork 後各 worker 以 copy-on-write 共用
+    """
+    try:
+        from src.daily_english_service import FULL_YEAR_WORDS
+        logger.info(f"已預先載入每日單字表: {len(FULL_YEAR_WORDS)} 筆")
+    except Exception as e:
+        logger.warning(f"預先載入每日單字表失敗: {str(e)}")
+
+if os.getenv("DEFER_BACKGROUND_SERVICES", "").lower() not in ("1", "true", "yes"):
+    start_background_services()
 
 # 讓gunicorn能夠找到應用
 application = app
 
 # 對話狀態管理相關的函數
 def check_active_conversation(user_id, current_time):
-    """檢查用戶是否處於活躍對話狀態"""
-    if user_id in active_conversations:
-        last_activity_time = active_conversations[user_id]
-        # 檢查是否超時
-        if current_time - last_activity_time <= CONVERSATION_TIMEOUT:
-            return True
-        else:
-            # 超時自動結束對話
-            end_conversation(user_id)
-            return False
-    return False
+    """檢查用戶是否處於活躍對話狀態（超時自動結束對話）"""
+    active, _ = conversation_store.is_active(user_id, CONVERSATION_TIMEOUT, current_time)
+    return active
 
 def start_conversation(user_id):
     """將用戶標記為活躍對話狀態"""
-    active_conversations[user_id] = time.time()
+    conversation_store.start_conversation(user_id)
     logger.info(f"用戶 {user_id} 開始/繼續對話")
 
 def end_conversation(user_id):
-    """結束用戶的對話狀態"""
-    if user_id in active_conversations:
-        del active_conversations[user_id]
+    """結束用戶的對話狀態（對話歷史保留到閒置逾時）"""
+    if conversation_store.end_conversation(user_id):
         logger.info(f"用戶 {user_id} 結束對話")
-    # 可選：根據需求決定是否要清除對話歷史
-    # if user_id in conversation_histories:
-    #     del conversation_histories[user_id]
 
 def update_conversation_history(user_id, query, response):
-    """更新使用者的對話歷史記錄"""
-    # MAX_HISTORY 已在全域定義
-    
-    if user_id not in conversation_histories:
-        conversation_histories[user_id] = []
-    
-    # 添加新的對話
-    conversation_histories[user_id].append({"role": "user", "parts": [query]})
-    conversation_histories[user_id].append({"role": "model", "parts": [response]})
-    
-    # 如果歷史紀錄太長，移除最舊的對話
-    if len(conversation_histories[user_id]) > MAX_HISTORY * 2:  # 一輪對話有兩條紀錄
-        conversation_histories[user_id] = conversation_histories[user_id][-MAX_HISTORY*2:]
-        
-    # 更新對話狀態 (設定最新活動時間)
-    start_conversation(user_id)
+    """更新使用者的對話歷史記錄，並更新對話狀態 (設定最新活動時間)"""
+    conversation_store.append_turn(user_id, query, response, MAX_HISTORY)
+    # 同時寫入本地對話紀錄索引，供「我之前聊過什麼」直接查詢
+    if PEANUT_ENABLED and chat_history_index:
+        chat_history_index.add_turn(user_id, query, response)
 
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 8080))
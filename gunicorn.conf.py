@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+gunicorn 正式環境設定檔（gunicorn -c gunicorn.conf.py app:app）
+
+- gthread worker：webhook 只做驗證與排入佇列，實際處理在派送執行緒，
+  每個 worker 用數條執行緒同時接收請求即可
+- preload_app：主程序先載入 app 與唯讀資料（每日單字表、觸發詞與關鍵字表），
+  fork 後各 worker 以 copy-on-write 共用
+- 執行緒、事件迴圈與連線不能跨 fork 使用，背景服務改在每個 worker 初始化後才啟動
+
+fork 後的重設不使用 post_fork，依賴兩種機制（新增持有執行緒或連線的模組時也要採用其中一種）：
+- os.register_at_fork(after_in_child=...)：async_runtime 的事件迴圈、line_client 的連線池與
+  logging_setup 的背景寫入執行緒在子程序中立即重設
+- 以 os.getpid() 延遲檢查：SQLite 連線（src/sqlite_connection.py，每個執行緒、每個程序各一條）與各模組的背景執行緒
+  （json_store、jsonl_journal、chat_history_index 等）在子程序第一次使用時發現 pid 不同才重新建立
+GUNICORN_PRELOAD=false 時主程序不載入 app，when_ready 也不做任何預先載入，自我保活改由 worker 啟動
+
+對話狀態、訊息合併等仍存放在各 worker 的記憶體中，預設只開一個 worker（Render 免費方案的記憶體也有限）
+"""
+
+import os
+import gc
+
+# app.py 載入時不啟動背景服務，改由下方的 post_worker_init 在各 worker 中啟動
+os.environ.setdefault("DEFER_BACKGROUND_SERVICES", "1")
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+worker_class = "gthread"
+workers = int(os.getenv("GUNICORN_WORKERS") or os.getenv("WEB_CONCURRENCY") or 1)
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() in ("1", "true", "yes")
+
+
+def when_ready(server):
+    """主程序載入完成、開始 fork worker 前"""
+    if not preload_app:
+        # 沒有預先載入時不在主程序匯入 app，避免主程序建立 worker 用不到的資料與連線
+        server.log.info(f"伺服器就緒: workers={workers}, threads={threads}, preload_app={preload_app}")
+        return
+
+    import app as bot_app
+
+    bot_app.preload_shared_data()
+    # 自我保活只需要一條執行緒，放在主程序，不隨 worker 數量增加
+    bot_app.start_self_ping()
+    # 把目前的物件移出 GC 追蹤，避免 worker 的垃圾回收寫入共用頁面而觸發複製
+    gc.freeze()
+    server.log.info(f"伺服器就緒: workers={workers}, threads={threads}, preload_app={preload_app}")
+
+
+def post_worker_init(worker):
+    """worker 載入應用後，重新建立這個程序自己的背景執行緒"""
+    import app as bot_app
+
+    # 預先載入時自我保活在主程序執行，否則由 worker 負責
+    bot_app.start_background_services(self_ping=not preload_app)
+    worker.log.info(f"worker {worker.pid} 背景服務已啟動")
+
+
+def worker_exit(server, worker):
+    """worker 結束前把尚未寫入的對話歷史、對話紀錄與 JSON 文件寫入磁碟"""
+    import app as bot_app
+    from src.json_store import json_store
+
+    bot_app.conversation_store.flush()
+    if bot_app.PEANUT_ENABLED and bot_app.chat_history_index:
+        bot_app.chat_history_index.flush()
+    # 記憶與連結的寫回快取不論花生助手功能是否啟用都要寫入，不只依賴 atexit
+    json_store.flush()
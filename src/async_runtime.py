@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+共用 asyncio 執行環境模組
+在專用的背景執行緒上執行一個長期存在的事件迴圈，讓 Flask 的同步處理函數
+可以透過 submit() 執行協程，並在多則訊息之間重複使用綁定在迴圈上的資源
+（例如 aiohttp 連線池）
+"""
+
+import os
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRuntime:
+    """
+    背景事件迴圈
+
+    迴圈在第一次 submit 時才啟動；fork 之後子程序會重新建立自己的迴圈與執行緒
+    """
+
+    def __init__(self, name="async-runtime"):
+        """
+        初始化執行環境
+
+        參數:
+            name: 背景執行緒名稱
+        """
+        self.name = name
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._pid = None
+
+    def _ensure_started(self):
+        """確保目前程序的事件迴圈已在背景執行緒上執行"""
+        if self._loop is not None and self._pid == os.getpid():
+            return self._loop
+
+        with self._lock:
+            if self._loop is not None and self._pid == os.getpid():
+                return self._loop
+
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+
+            thread = threading.Thread(target=run, name=self.name, daemon=True)
+            thread.start()
+            ready.wait()
+
+            self._loop = loop
+            self._thread = thread
+            self._pid = os.getpid()
+            logger.info(f"共用事件迴圈已啟動 (pid {self._pid})")
+            return loop
+
+    @property
+    def loop(self):
+        """目前程序的事件迴圈"""
+        return self._ensure_started()
+
+    def submit(self, coro):
+        """
+        將協程交給背景事件迴圈執行（可從任何執行緒呼叫）
+
+        參數:
+            coro: 要執行的協程
+
+        返回:
+            concurrent.futures.Future: 協程的結果
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_started())
+
+    def run(self, coro, timeout=None):
+        """
+        執行協程並等待結果
+
+        參數:
+            coro: 要執行的協程
+            timeout: 最長等待秒數（None 表示持續等待）
+
+        返回:
+            協程的返回值
+        """
+        if self._loop is not None and self._thread is threading.current_thread():
+            raise RuntimeError("不能在共用事件迴圈的執行緒中同步等待協程")
+        return self.submit(coro).result(timeout)
+
+    def reset_after_fork(self):
+        """在 fork 出的子程序中捨棄繼承的迴圈（該迴圈的執行緒不存在於子程序）"""
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._pid = None
+
+    def shutdown(self, timeout=5):
+        """停止事件迴圈並等待背景執行緒結束"""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            if loop is None or self._pid != os.getpid():
+                return
+            self._loop = None
+            self._thread = None
+            self._pid = None
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
+        logger.info("共用事件迴圈已停止")
+
+
+# 全域執行環境實例
+async_runtime = AsyncRuntime()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=async_runtime.reset_after_fork)
+
+
+def run_coroutine(coro, timeout=None):
+    """在共用事件迴圈上執行協程並等待結果"""
+    return async_runtime.run(coro, timeout)
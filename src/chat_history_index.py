@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""
+本地對話紀錄索引模組
+「我之前聊過什麼」、「我上週做了什麼」這類問題原本被分類為 chat_history 後，
+仍然走一般的記憶搜尋再交給 Gemini 生成回應。本模組為每位使用者保存過去的對話與儲存的項目，
+依日期分區建立索引，直接以日期範圍與關鍵字（ngram_index 的中文 n-gram 倒排索引）查詢並組成回覆，
+不需要呼叫模型
+
+- 紀錄寫入 SQLite (WAL)：呼叫端只把紀錄放進待寫入區，由背景執行緒批次寫入，
+  所有 worker 共用同一份紀錄，重啟後仍保留
+- 索引依 (使用者, 日期) 分區：查詢時只載入範圍內的分區；已過去的日期不會再變動，
+  分區會快取在記憶體中，當天的分區每次查詢都重新載入以取得其他 worker 的新紀錄
+"""
+
+import os
+import re
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+# 導入 n-gram 倒排索引
+try:
+    from src.ngram_index import NgramIndex
+except ImportError:
+    from ngram_index import NgramIndex
+
+# 導入共用的 SQLite 連線（每個執行緒、每個程序各自一條）
+try:
+    from src.sqlite_connection import ThreadLocalConnection
+except ImportError:
+    from sqlite_connection import ThreadLocalConnection
+
+logger = logging.getLogger(__name__)
+
+# 紀錄類型
+KIND_CHAT = "chat"    # 與 AI 的一輪對話（text 為使用者的問題，detail 為回應）
+KIND_SAVED = "saved"  # 儲存的內容（靈感、知識、記憶等）
+KIND_TODO = "todo"    # 新增的待辦事項
+
+KIND_ICONS = {KIND_CHAT: "💬", KIND_SAVED: "📝", KIND_TODO: "✅"}
+
+# 使用者都在台灣，日期一律以台灣時間（UTC+8，無日光節約時間）切分
+LOCAL_TZ = timezone(timedelta(hours=8))
+
+WEEKDAY_NAMES = "一二三四五六日"
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               '.cache', 'chat_history.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    kind TEXT NOT NULL,
+    text TEXT NOT NULL,
+    detail TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_records_user_day ON records (user_id, day, id);
+"""
+
+# 時間用語：(正規表示式, 計算日期範圍的函數(今天的 date) -> (開始, 結束, 標籤))
+TIME_PHRASES = [
+    (re.compile(r"今天|今日"), lambda d: (d, d, "今天")),
+    (re.compile(r"昨天|昨日"), lambda d: (d - timedelta(days=1), d - timedelta(days=1), "昨天")),
+    (re.compile(r"前天"), lambda d: (d - timedelta(days=2), d - timedelta(days=2), "前天")),
+    (re.compile(r"上週|上周|上禮拜|上星期|上個禮拜|上個星期"),
+     lambda d: (d - timedelta(days=d.weekday() + 7), d - timedelta(days=d.weekday() + 1), "上週")),
+    (re.compile(r"這週|這周|本週|本周|這禮拜|這星期|這個禮拜|這個星期"),
+     lambda d: (d - timedelta(days=d.weekday()), d, "這週")),
+    (re.compile(r"上個月|上月"),
+     lambda d: ((d.replace(day=1) - timedelta(days=1)).replace(day=1), d.replace(day=1) - timedelta(days=1), "上個月")),
+    (re.compile(r"這個月|本月"), lambda d: (d.replace(day=1), d, "這個月")),
+    (re.compile(r"最近"), lambda d: (d - timedelta(days=6), d, "最近一週")),
+]
+
+# 沒有指定時間時查詢的天數
+DEFAULT_RANGE_DAYS = 30
+
+# 查詢句中不是關鍵字的部分（移除後剩下的片段才是關鍵字）
+FILLER_RE = re.compile(
+    r"我們|我之前|之前|以前|過去|上次|曾經|跟你|和你|"
+    r"聊過|聊了|聊到|談過|談到|說過|說了|問過|問了|提過|提到|做過|做了|在幹嘛|在做什麼|幹嘛|"
+    r"什麼|哪些|甚麼|有沒有|有關|關於|相關|的事情|的事|事情|紀錄|記錄|對話|內容|東西|"
+    r"幫我|查詢|查一下|看看|看一下|一下|列出|告訴|"
+    r"[\s，,。.、！!？?：:；;~～「」『』()（）]"
+)
+
+# 單字的虛詞只在片段的開頭或結尾移除（「和服」、「有機蔬菜」裡的「和」、「有」是關鍵字的一部分）
+SINGLE_FILLERS = "你我查都有的了嗎呢吧啊跟和與"
+
+def parse_time_range(message, today=None):
+    """
+    從查詢句中解析日期範圍
+
+    參數:
+        message: 查詢句
+        today: 今天的日期（預設為台灣時間的今天）
+
+    返回:
+        tuple: (開始日期, 結束日期, 標籤)；沒有時間用語時為最近 DEFAULT_RANGE_DAYS 天
+    """
+    today = today or datetime.now(LOCAL_TZ).date()
+    for pattern, resolve in TIME_PHRASES:
+        if pattern.search(message):
+            return resolve(today)
+    return today - timedelta(days=DEFAULT_RANGE_DAYS - 1), today, f"最近 {DEFAULT_RANGE_DAYS} 天"
+
+
+def extract_keywords(message):
+    """
+    去除時間用語與查詢用語後剩下的關鍵字片段
+
+    單字的虛詞可能是關鍵字的一部分，因此每個片段返回由長到短的候選寫法，由呼叫端以紀錄決定採用哪一個：
+    先只去除開頭或結尾的虛詞（「有機蔬菜嗎」-> ("有機蔬菜嗎",)、("有機蔬菜",)、...），
+    最後才以片段中間的虛詞切開（「台南的拉麵」-> ("台南", "拉麵")）
+
+    返回:
+        list: 每個片段的候選列表，每個候選是一組關鍵字（每個關鍵字至少兩個字）
+    """
+    for pattern, _ in TIME_PHRASES:
+        message = pattern.sub(" ", message)
+    keywords = []
+    for part in FILLER_RE.split(message):
+        core = part.strip(SINGLE_FILLERS)
+        if not core:
+            continue
+        lead = part.index(core)
+        trail = len(part) - lead - len(core)
+        variants = {part[i:len(part) - j] for i in range(lead + 1) for j in range(trail + 1)}
+        candidates = [(variant,) for variant in sorted(variants, key=lambda v: (-len(v), part.index(v)))
+                      if len(variant) >= 2]
+        words = tuple(word for word in re.split(f"[{SINGLE_FILLERS}]+", core) if len(word) >= 2)
+        if words and words != (core,):
+            candidates.append(words)
+        if candidates:
+            keywords.append(candidates)
+    return keywords
+
+
+def has_topic(message):
+    """查詢句去除時間用語、查詢用語與虛詞後是否還有內容（例如只有一個字的主題）"""
+    for pattern, _ in TIME_PHRASES:
+        message = pattern.sub(" ", message)
+    return any(part.strip(SINGLE_FILLERS) for part in FILLER_RE.split(message))
+
+
+class _Partition:
+    """一位使用者一天的紀錄與倒排索引"""
+
+    __slots__ = ("records", "index")
+
+    def __init__(self, records):
+        self.records = records  # [(id, created_at, kind, text, detail)]，依時間排序
+        self.index = NgramIndex()
+        for position, record in enumerate(records):
+            self.index.add(position, record[3])
+
+    def search(self, keywords):
+        """返回包含所有關鍵字的紀錄位置（沒有關鍵字時返回全部）"""
+        if not keywords:
+            return range(len(self.records))
+        result = None
+        for keyword in keywords:
+            positions = self.index.find(keyword)
+            result = set(positions) if result is None else result.intersection(positions)
+            if not result:
+                return []
+        return sorted(result)
+
+
+class ChatHistoryIndex:
+    """每位使用者依日期分區的本地對話紀錄索引"""
+
+    def __init__(self, db_path=None, retention_days=180, max_cached_partitions=5000, flush_interval=1.0):
+        """
+        初始化索引
+
+        參數:
+            db_path: SQLite 檔案路徑，預設為 .cache/chat_history.db
+            retention_days: 紀錄保留天數
+            max_cached_partitions: 記憶體中最多快取的分區數（依最近使用淘汰）
+            flush_interval: 待寫入的紀錄批次寫入的間隔（秒）
+        """
+        self.db_path = db_path or DEFAULT_DB_PATH
+        self.retention_days = retention_days
+        self.max_cached_partitions = max_cached_partitions
+        self.flush_interval = flush_interval
+
+        self._connect = ThreadLocalConnection(self.db_path)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._partitions = OrderedDict()  # (user_id, day) -> _Partition
+        self._writer_pid = None
+        self._counters = {"recorded": 0, "queries": 0, "answered": 0, "partition_loads": 0, "partition_hits": 0}
+
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        self._connect().executescript(SCHEMA)
+        atexit.register(self.flush)
+        logger.info(f"對話紀錄索引已初始化: {self.db_path}")
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._counters[key] += amount
+
+    def add(self, user_id, kind, text, detail="", created_at=None):
+        """
+        新增一筆紀錄（非同步寫入）
+
+        參數:
+            user_id: 使用者 ID
+            kind: KIND_CHAT、KIND_SAVED 或 KIND_TODO
+            text: 紀錄內容（搜尋的對象）
+            detail: 補充內容（例如 AI 的回應或內容類型），不列入搜尋
+            created_at: 時間戳記，預設為現在
+        """
+        if not user_id or not text:
+            return
+        created_at = created_at or time.time()
+        day = datetime.fromtimestamp(created_at, LOCAL_TZ).date().isoformat()
+        with self._lock:
+            self._pending.append((user_id, day, created_at, kind, text, detail or ""))
+            self._counters["recorded"] += 1
+        self._ensure_writer()
+
+    def add_turn(self, user_id, query, response):
+        """新增一輪 AI 對話"""
+        self.add(user_id, KIND_CHAT, query, response)
+
+    def flush(self):
+        """
+        把待寫入的紀錄批次寫入資料庫
+
+        返回:
+            int: 寫入的紀錄數
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return 0
+            conn = self._connect()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(
+                    "INSERT INTO records (user_id, day, created_at, kind, text, detail) VALUES (?, ?, ?, ?, ?, ?)",
+                    pending
+                )
+                conn.execute("COMMIT")
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                with self._lock:
+                    self._pending[:0] = pending
+                logger.error(f"寫入對話紀錄失敗，稍後重試: {str(e)}")
+                return 0
+            with self._lock:
+                for user_id, day, *_ in pending:
+                    self._partitions.pop((user_id, day), None)
+            return len(pending)
+
+    def purge(self, now=None):
+        """刪除超過保留天數的紀錄，返回刪除筆數"""
+        cutoff = datetime.fromtimestamp(now or time.time(), LOCAL_TZ).date() - timedelta(days=self.retention_days)
+        return self._connect().execute("DELETE FROM records WHERE day < ?", (cutoff.isoformat(),)).rowcount
+
+    def _ensure_writer(self):
+        """第一次寫入時啟動背景寫入執行緒（每個程序一條，fork 後的子程序會重新啟動）"""
+        if self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+
+        def writer_loop():
+            last_purge = 0
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                    if time.time() - last_purge > 3600:
+                        purged = self.purge()
+                        last_purge = time.time()
+                        if purged:
+                            logger.info(f"已刪除 {purged} 筆過期的對話紀錄")
+                except Exception as e:
+                    logger.error(f"對話紀錄寫入執行緒發生錯誤: {str(e)}")
+
+        threading.Thread(target=writer_loop, name="chat-history-writer", daemon=True).start()
+
+    def _load_partitions(self, user_id, start, end, today):
+        """返回範圍內各天的分區 [(日期字串, _Partition)]，依日期排序"""
+        days = [(start + timedelta(days=offset)).isoformat() for offset in range((end - start).days + 1)]
+        today_key = today.isoformat()
+        partitions = {}
+        with self._lock:
+            for day in days:
+                partition = self._partitions.get((user_id, day))
+                # 當天的分區可能有其他 worker 新增的紀錄，不使用快取
+                if partition is not None and day < today_key:
+                    self._partitions.move_to_end((user_id, day))
+                    partitions[day] = partition
+            self._counters["partition_hits"] += len(partitions)
+        missing = [day for day in days if day not in partitions]
+        if missing:
+            rows = {}
+            for row in self._connect().execute(
+                "SELECT id, created_at, kind, text, detail, day FROM records "
+                "WHERE user_id = ? AND day BETWEEN ? AND ? ORDER BY id",
+                (user_id, missing[0], missing[-1])
+            ):
+                if row[5] not in partitions:
+                    rows.setdefault(row[5], []).append(row[:5])
+            with self._lock:
+                for day in missing:
+                    partition = _Partition(rows.get(day, []))
+                    partitions[day] = partition
+                    self._partitions[(user_id, day)] = partition
+                    self._counters["partition_loads"] += 1
+                while len(self._partitions) > self.max_cached_partitions:
+                    self._partitions.popitem(last=False)
+        return [(day, partitions[day]) for day in days]
+
+    def search(self, user_id, start, end, keywords=(), kinds=None, today=None):
+        """
+        查詢日期範圍內（包含關鍵字）的紀錄
+
+        參數:
+            user_id: 使用者 ID
+            start: 開始日期（date）
+            end: 結束日期（date）
+            keywords: 關鍵字片段（全部都要出現）
+            kinds: 只查詢這些類型的紀錄，None 表示全部
+            today: 今天的日期（預設為台灣時間的今天）
+
+        返回:
+            list: 依時間排序的紀錄 dict（id、created_at、kind、text、detail）
+        """
+        self.flush()
+        today = today or datetime.now(LOCAL_TZ).date()
+        results = []
+        for _, partition in self._load_partitions(user_id, start, min(end, today), today):
+            for position in partition.search(keywords):
+                record_id, created_at, kind, text, detail = partition.records[position]
+                if kinds and kind not in kinds:
+                    continue
+                results.append({"id": record_id, "created_at": created_at, "kind": kind,
+                                "text": text, "detail": detail})
+        return results
+
+    def answer(self, user_id, message, limit=20, today=None):
+        """
+        直接回答對話紀錄類的問題
+
+        參數:
+            user_id: 使用者 ID
+            message: 查詢句（例如「我上週聊過什麼」、「我之前問過日本旅遊嗎」）
+            limit: 回覆中最多列出的紀錄數（列出最新的）
+            today: 今天的日期（預設為台灣時間的今天）
+
+        返回:
+            dict: {"found", "response", "count"}；找不到紀錄時 found 為 False
+        """
+        self._count("queries")
+        start, end, label = parse_time_range(message, today)
+        keywords = []
+        for candidates in extract_keywords(message):
+            # 採用紀錄中有出現的最長寫法（「和服」不會被當成「服」）
+            chosen = next((c for c in candidates if self.search(user_id, start, end, c, today=today)), None)
+            if chosen is None:
+                return {"found": False, "response": "", "count": 0}
+            keywords.extend(chosen)
+        # 有主題但沒有可用的關鍵字（例如只有一個字）時不列出所有紀錄，交給呼叫端處理
+        if not keywords and has_topic(message):
+            return {"found": False, "response": "", "count": 0}
+        records = self.search(user_id, start, end, keywords, today=today)
+        if not records:
+            return {"found": False, "response": "", "count": 0}
+
+        self._count("answered")
+        title = f"🗂️ {label}（{start.month}/{start.day}～{end.month}/{end.day}）"
+        if keywords:
+            title += f"與「{'、'.join(keywords)}」有關"
+        lines = [f"{title}的紀錄，共 {len(records)} 筆："]
+        if len(records) > limit:
+            lines.append(f"（只列出最新的 {limit} 筆）")
+        current_day = None
+        for record in records[-limit:]:
+            moment = datetime.fromtimestamp(record["created_at"], LOCAL_TZ)
+            if moment.date() != current_day:
+                current_day = moment.date()
+                lines.append(f"\n📅 {current_day.month}/{current_day.day}（{WEEKDAY_NAMES[current_day.weekday()]}）")
+            lines.append(f"• {moment:%H:%M} {KIND_ICONS.get(record['kind'], '•')} {_shorten(record['text'])}")
+        return {"found": True, "response": "\n".join(lines), "count": len(records)}
+
+    def get_stats(self):
+        """
+        獲取索引統計
+
+        返回:
+            dict: 待寫入的紀錄數、快取的分區數與計數器
+        """
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "cached_partitions": len(self._partitions),
+                "counters": dict(self._counters),
+            }
+
+
+def _shorten(text, max_chars=40):
+    """過長的內容只顯示開頭"""
+    text = " ".join(text.split())
+    return text if len(text) <= max_chars else text[:max_chars] + "…"
+
+
+def _create_index():
+    """建立全域索引，資料庫無法使用時返回 None（呼叫端改走原本的流程）"""
+    try:
+        return ChatHistoryIndex(
+            os.getenv("CHAT_HISTORY_DB"),
+            retention_days=int(os.getenv("CHAT_HISTORY_RETENTION_DAYS", "180"))
+        )
+    except Exception as e:
+        logger.error(f"初始化對話紀錄索引失敗: {str(e)}")
+        return None
+
+
+# 全域對話紀錄索引實例
+chat_history_index = _create_index()
@@ -2,6 +2,7 @@
 """
 內容儲存管理模組
 支援不同類型內容的分類儲存：insight(靈感)、knowledge(知識)、memory(記憶)、music(音樂)、life(活動)
+每位用戶的內容存成一個只附加的 JSONL 日誌（見 jsonl_journal），新增與刪除都只寫一行
 """
 
 import os
@@ -10,6 +11,18 @@ import logging
 from typing import List, Dict, Optional
 from datetime import datetime
 
+# 導入 JSONL 日誌
+try:
+    from src.jsonl_journal import jsonl_journal
+except ImportError:
+    from jsonl_journal import jsonl_journal
+
+# 導入 n-gram 倒排索引
+try:
+    from src.ngram_index import NgramIndexCache
+except ImportError:
+    from ngram_index import NgramIndexCache
+
 logger = logging.getLogger(__name__)
 
 
@@ -33,38 +46,47 @@ class ContentManager:
             storage_dir: 內容儲存目錄
         """
         self.storage_dir = storage_dir
+        # 每位用戶一個關鍵字索引，日誌有變動時增量更新
+        self._search_index = NgramIndexCache()
         os.makedirs(storage_dir, exist_ok=True)
         logger.info(f"內容管理器已初始化，儲存目錄: {storage_dir}")
     
     def _get_user_file(self, user_id: str) -> str:
-        """獲取用戶內容檔案路徑"""
-        return os.path.join(self.storage_dir, f"{user_id}_contents.json")
+        """獲取用戶內容日誌路徑"""
+        return os.path.join(self.storage_dir, f"{user_id}_contents.jsonl")
     
     def _load_contents(self, user_id: str) -> List[Dict]:
         """載入用戶的內容"""
+        return self._load_contents_with_version(user_id)[0]
+    
+    def _load_contents_with_version(self, user_id: str):
+        """載入用戶的內容與日誌版本"""
         file_path = self._get_user_file(user_id)
-        
         if not os.path.exists(file_path):
-            return []
-        
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"載入內容失敗: {e}")
-            return []
+            self._import_json_file(user_id)
+        return jsonl_journal.load_with_version(file_path)
     
-    def _save_contents(self, user_id: str, contents: List[Dict]) -> bool:
-        """儲存用戶的內容"""
-        file_path = self._get_user_file(user_id)
+    def _search_contents(self, user_id: str, contents: List[Dict], version, keyword: str) -> List[Dict]:
+        """以索引查詢內容或標籤包含關鍵字的項目（依新增順序）"""
+        index = self._search_index.get(user_id, version, lambda: (
+            (c["id"], c["content"] + "\n" + " ".join(c.get("tags", [])), c) for c in contents
+        ))
+        return [index.get(content_id) for content_id in index.find(keyword)]
+    
+    def _import_json_file(self, user_id: str):
+        """把舊格式的 {user_id}_contents.json 轉成日誌，原檔案改名為 .migrated"""
+        legacy_path = os.path.join(self.storage_dir, f"{user_id}_contents.json")
+        if not os.path.exists(legacy_path):
+            return
         
         try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(contents, f, ensure_ascii=False, indent=2)
-            return True
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                contents = json.load(f)
+            jsonl_journal.import_items(self._get_user_file(user_id), contents)
+            os.replace(legacy_path, legacy_path + ".migrated")
+            logger.info(f"已將內容轉換為日誌格式: user_id={user_id}, count={len(contents)}")
         except Exception as e:
-            logger.error(f"儲存內容失敗: {e}")
-            return False
+            logger.error(f"轉換內容檔案失敗: {e}")
     
     def save_content(self, user_id: str, content: str, content_type: str, 
                     tags: Optional[List[str]] = None, metadata: Optional[Dict] = None) -> Dict:
@@ -97,12 +119,12 @@ class ContentManager:
             "metadata": metadata or {}
         }
         
-        contents.append(new_content)
-        
-        if self._save_contents(user_id, contents):
+        try:
+            jsonl_journal.append(self._get_user_file(user_id), new_content)
             logger.info(f"內容儲存成功: user_id={user_id}, type={content_type}")
             return {"success": True, "content": new_content}
-        else:
+        except Exception as e:
+            logger.error(f"儲存內容失敗: {e}")
             return {"success": False, "error": "儲存失敗"}
     
     def query_contents(self, user_id: str, content_type: Optional[str] = None,
@@ -119,22 +141,17 @@ class ContentManager:
         Returns:
             Dict: 查詢結果
         """
-        contents = self._load_contents(user_id)
+        contents, version = self._load_contents_with_version(user_id)
         
         # 過濾條件
         filtered_contents = contents
         
+        if keyword:
+            filtered_contents = self._search_contents(user_id, contents, version, keyword)
+        
         if content_type:
             filtered_contents = [c for c in filtered_contents if c["type"] == content_type]
         
-        if keyword:
-            keyword_lower = keyword.lower()
-            filtered_contents = [
-                c for c in filtered_contents
-                if keyword_lower in c["content"].lower() or
-                   keyword_lower in " ".join(c.get("tags", [])).lower()
-            ]
-        
         # 按時間排序（最新的在前）
         filtered_contents.sort(key=lambda x: x["created_at"], reverse=True)
         
@@ -155,17 +172,18 @@ class ContentManager:
         Returns:
             Dict: 刪除結果
         """
-        contents = self._load_contents(user_id)
+        # 確保舊格式的檔案已轉換為日誌
+        self._load_contents(user_id)
         
-        # 過濾掉要刪除的項目
-        filtered_contents = [c for c in contents if c["id"] != content_id]
+        try:
+            deleted = jsonl_journal.delete(self._get_user_file(user_id), content_id)
+        except Exception as e:
+            logger.error(f"刪除內容失敗: {e}")
+            return {"success": False, "error": "儲存失敗"}
         
-        if len(filtered_contents) < len(contents):
-            if self._save_contents(user_id, filtered_contents):
-                logger.info(f"內容刪除成功: user_id={user_id}, content_id={content_id}")
-                return {"success": True}
-            else:
-                return {"success": False, "error": "儲存失敗"}
+        if deleted:
+            logger.info(f"內容刪除成功: user_id={user_id}, content_id={content_id}")
+            return {"success": True}
         else:
             return {"success": False, "error": "找不到指定的內容"}
     
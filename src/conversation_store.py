@@ -0,0 +1,648 @@
+#!/usr/bin/env python3
+"""
+對話狀態儲存模組
+取代 app.py 與 line_webhook.py 中的 conversation_histories / active_conversations 全域 dict：
+原本每個曾經對話過的使用者都會永久留在記憶體中，對話歷史從不清除
+
+- 使用者數量上限：超過時淘汰最久沒有互動的使用者 (LRU)
+- 閒置逾時：超過 ttl 秒沒有互動的使用者由背景清理執行緒移除
+- 分段鎖：依使用者 ID 分配到數個分段，各自有獨立的鎖，gthread worker 的執行緒不會互相阻塞
+- 記憶體用量估計：/health 與 /metrics 可以看到目前的使用者數與估計位元組數
+
+每個分段是依最後互動時間排序的 OrderedDict，最舊的在最前面，
+清理時從頭檢查到第一個未逾時的使用者就可以停止
+
+對話歷史另外保存在可替換的後端（預設 SQLite/WAL，CONVERSATION_BACKEND=memory 時只存在記憶體），
+多個 gunicorn worker 與重啟後都能讀到同一份上下文：
+- 寫入延後 (write-behind)：每輪對話只更新記憶體並記下待寫入的歷史，由背景執行緒批次寫入
+- 記憶體是熱讀取快取：未命中時從後端載入；快取超過 revalidate_seconds 時比對後端的版本，
+  其他 worker 更新過才重新載入
+
+後端需要提供 load(user_id) -> (history, revision) 或 None、revision(user_id)、
+save_many([(user_id, history, base_revision, revision)]) -> 版本不符的使用者 與 purge(older_than)；
+寫入以載入時的版本為條件，其他 worker 先寫入時重新載入、套用本程序尚未寫入的對話輪後再試
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+try:
+    from src.history_buffer import HistoryBuffer
+except ImportError:
+    from history_buffer import HistoryBuffer
+
+# 導入共用的 SQLite 連線（每個執行緒、每個程序各自一條）
+try:
+    from src.sqlite_connection import ThreadLocalConnection
+except ImportError:
+    from sqlite_connection import ThreadLocalConnection
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               '.cache', 'conversations.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    user_id TEXT PRIMARY KEY,
+    history TEXT NOT NULL,
+    revision TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations (updated_at);
+"""
+
+
+class SQLiteHistoryBackend:
+    """以 SQLite (WAL) 保存對話歷史，同一台機器上的所有 worker 共用"""
+
+    def __init__(self, db_path=None):
+        """
+        參數:
+            db_path: SQLite 檔案路徑，預設為 .cache/conversations.db
+        """
+        self.db_path = db_path or DEFAULT_DB_PATH
+        self._connect = ThreadLocalConnection(self.db_path)
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        self._connect().executescript(SCHEMA)
+        logger.info(f"對話歷史資料庫已初始化: {self.db_path}")
+
+    def load(self, user_id):
+        """返回 (history, revision)，沒有紀錄時返回 None"""
+        row = self._connect().execute(
+            "SELECT history, revision FROM conversations WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def revision(self, user_id):
+        """返回目前保存的版本，沒有紀錄時返回 None"""
+        row = self._connect().execute(
+            "SELECT revision FROM conversations WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def save_many(self, items):
+        """
+        在同一個交易中寫入多位使用者的歷史（空的歷史會刪除紀錄）
+
+        只有後端目前的版本仍是寫入端載入時的版本才會寫入，
+        其他 worker 在這段期間更新過的使用者不寫入，交由呼叫端重新載入後再試
+
+        參數:
+            items: [(user_id, history, base_revision, revision)]，base_revision 為 None 表示載入時沒有紀錄
+
+        返回:
+            set: 版本不符而沒有寫入的使用者 ID
+        """
+        now = time.time()
+        conflicts = set()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for user_id, history, base_revision, revision in items:
+                data = json.dumps(history, ensure_ascii=False)
+                if base_revision is None and history:
+                    cursor = conn.execute(
+                        "INSERT INTO conversations (user_id, history, revision, updated_at) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(user_id) DO NOTHING",
+                        (user_id, data, revision, now)
+                    )
+                elif base_revision is None:
+                    cursor = conn.execute("SELECT 0 FROM conversations WHERE user_id = ?", (user_id,))
+                    if cursor.fetchone() is not None:
+                        conflicts.add(user_id)
+                    continue
+                elif history:
+                    cursor = conn.execute(
+                        "UPDATE conversations SET history = ?, revision = ?, updated_at = ? "
+                        "WHERE user_id = ? AND revision = ?",
+                        (data, revision, now, user_id, base_revision)
+                    )
+                else:
+                    cursor = conn.execute(
+                        "DELETE FROM conversations WHERE user_id = ? AND revision = ?", (user_id, base_revision)
+                    )
+                if cursor.rowcount == 0:
+                    conflicts.add(user_id)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return conflicts
+
+    def purge(self, older_than):
+        """刪除最後更新早於 older_than 的紀錄，返回刪除筆數"""
+        return self._connect().execute(
+            "DELETE FROM conversations WHERE updated_at < ?", (older_than,)
+        ).rowcount
+
+
+class _Conversation:
+    """單一使用者的對話狀態"""
+
+    __slots__ = ("history", "active_since", "last_activity", "revision", "validated_at")
+
+    def __init__(self, now, capacity):
+        self.history = HistoryBuffer(capacity)  # 環形緩衝區，組請求時才轉換為 Gemini 格式
+        self.active_since = None  # 連續對話開始時間，None 表示不在對話中
+        self.last_activity = now
+        self.revision = None      # 後端中對應的版本
+        self.validated_at = None  # 上次與後端比對版本的時間
+
+
+class _PendingWrite:
+    """一位使用者尚未寫入後端的更新"""
+
+    __slots__ = ("history", "base_revision", "ops")
+
+    def __init__(self, base_revision):
+        self.history = None                 # 套用所有更新後的歷史複本
+        self.base_revision = base_revision  # 這些更新所依據的後端版本
+        self.ops = []                       # 依序的更新：("turn", query, response, capacity) 或 ("clear",)
+
+
+def _apply_ops(history, ops):
+    """把尚未寫入的更新依序套用到歷史緩衝區"""
+    for op in ops:
+        if op[0] == "clear":
+            history.clear()
+        else:
+            _, query, response, capacity = op
+            history.resize(capacity)
+            history.append_turn(query, response)
+    return history
+
+
+class _Stripe:
+    """一個分段：獨立的鎖與 LRU 順序的使用者表"""
+
+    __slots__ = ("lock", "entries")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+
+class ConversationStore:
+    """有使用者數量上限與閒置逾時的對話狀態儲存"""
+
+    def __init__(self, max_users=10000, ttl=86400, stripes=16, sweep_interval=60, backend=None,
+                 flush_interval=1.0, revalidate_seconds=2.0, retention_seconds=30 * 86400, max_turns=10):
+        """
+        初始化儲存
+
+        參數:
+            max_users: 最多保留的使用者數（平均分配到各分段）
+            ttl: 使用者閒置超過此秒數後移除其對話狀態（只影響記憶體，後端的歷史仍保留）
+            stripes: 分段數量
+            sweep_interval: 背景清理的間隔（秒）
+            backend: 對話歷史的持久化後端，None 表示只存在記憶體
+            flush_interval: 待寫入的歷史批次寫入後端的間隔（秒）
+            revalidate_seconds: 快取超過此秒數後，讀取時先比對後端版本
+            retention_seconds: 後端保留多久沒有更新的歷史
+            max_turns: 每位使用者預設保留的對話輪數（append_turn 可以另外指定）
+        """
+        self.max_users = max_users
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.revalidate_seconds = revalidate_seconds
+        self.retention_seconds = retention_seconds
+        self.max_turns = max_turns
+        self._stripes = [_Stripe() for _ in range(max(1, stripes))]
+        self._per_stripe = max(1, -(-max_users // len(self._stripes)))
+        self._counters_lock = threading.Lock()
+        self._counters = {"evicted_lru": 0, "expired": 0}
+        self._backend_counters = {"loads": 0, "revalidations": 0, "reloads": 0, "writes": 0,
+                                  "flushes": 0, "write_errors": 0}
+        self._sweeper_pid = None
+        self._writer_pid = None
+        # 待寫入後端的更新：user_id -> _PendingWrite（版本衝突時用來重新套用）
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        if backend is not None:
+            atexit.register(self.flush)
+
+    def _stripe(self, user_id):
+        return self._stripes[hash(user_id) % len(self._stripes)]
+
+    def _count(self, name, value=1):
+        if value:
+            with self._counters_lock:
+                counters = self._counters if name in self._counters else self._backend_counters
+                counters[name] += value
+
+    def _touch(self, stripe, user_id, now):
+        """取得（必要時建立）使用者狀態並移到 LRU 尾端，呼叫端需持有分段鎖"""
+        entry = stripe.entries.get(user_id)
+        if entry is None:
+            entry = _Conversation(now, self.max_turns * 2)
+            stripe.entries[user_id] = entry
+            if len(stripe.entries) > self._per_stripe:
+                stripe.entries.popitem(last=False)
+                self._count("evicted_lru")
+        else:
+            entry.last_activity = now
+            stripe.entries.move_to_end(user_id)
+        return entry
+
+    def get_history(self, user_id):
+        """
+        獲取使用者的對話歷史
+
+        返回:
+            list: 對話歷史（Gemini 格式的 {"role", "parts"} 列表）
+        """
+        history = self._current_history(user_id)
+        return history.to_wire() if history is not None else []
+
+    def _current_history(self, user_id):
+        """返回最新的歷史緩衝區複本（必要時從後端載入或比對版本），記憶體中沒有這位使用者時返回 None"""
+        stripe = self._stripe(user_id)
+        now = time.time()
+        with stripe.lock:
+            entry = stripe.entries.get(user_id)
+            if self.backend is None:
+                return entry.history.copy() if entry else None
+            if entry is not None and entry.validated_at is not None and now - entry.validated_at < self.revalidate_seconds:
+                return entry.history.copy()
+            known_revision = entry.revision if entry is not None else None
+            cached = entry is not None and entry.validated_at is not None
+        with self._pending_lock:
+            if user_id in self._pending:
+                # 本程序還有尚未寫入的更新，記憶體中的就是最新的
+                return self._pending[user_id].history.copy()
+
+        # 查詢後端時不持有分段鎖，避免磁碟 I/O 阻塞同一分段的其他使用者
+        try:
+            if cached:
+                self._count("revalidations")
+                if self.backend.revision(user_id) == known_revision:
+                    with stripe.lock:
+                        entry = stripe.entries.get(user_id)
+                        if entry is not None:
+                            entry.validated_at = now
+                            return entry.history.copy()
+                self._count("reloads")
+            self._count("loads")
+            loaded = self.backend.load(user_id)
+        except Exception as e:
+            logger.error(f"從後端讀取對話歷史失敗，使用記憶體中的內容: {str(e)}")
+            with stripe.lock:
+                entry = stripe.entries.get(user_id)
+                return entry.history.copy() if entry else None
+
+        history, revision = loaded if loaded else ([], None)
+        with stripe.lock:
+            entry = self._touch(stripe, user_id, now)
+            with self._pending_lock:
+                if user_id not in self._pending:
+                    entry.history = HistoryBuffer.from_wire(history, entry.history.capacity)
+                    entry.revision = revision
+                    entry.validated_at = now
+            return entry.history.copy()
+
+    def _mark_pending(self, user_id, entry, op):
+        """記下需要寫入後端的更新（呼叫端需持有分段鎖，且已把 op 套用到 entry.history）"""
+        if self.backend is None:
+            return
+        with self._pending_lock:
+            pending = self._pending.get(user_id)
+            if pending is None:
+                pending = self._pending[user_id] = _PendingWrite(entry.revision)
+            pending.ops.append(op)
+            pending.history = entry.history.copy()
+        self._ensure_writer()
+
+    def _requeue(self, user_id, pending):
+        """寫入失敗時放回待寫入區，排在期間新增的更新之前（呼叫端需持有 _pending_lock）"""
+        newer = self._pending.get(user_id)
+        if newer is None:
+            self._pending[user_id] = pending
+        else:
+            newer.ops[:0] = pending.ops
+            newer.base_revision = pending.base_revision
+
+    def _resolve_conflict(self, user_id, pending, attempts=5):
+        """
+        其他 worker 已更新過這位使用者：重新載入後端的歷史，套用本程序的更新後以新版本為條件再寫入
+
+        返回:
+            tuple: (寫入的歷史, 新版本)，重試次數用完時返回 None
+        """
+        for _ in range(attempts):
+            self._count("reloads")
+            loaded = self.backend.load(user_id)
+            history, base_revision = loaded if loaded else ([], None)
+            merged = _apply_ops(HistoryBuffer.from_wire(history, pending.history.capacity), pending.ops)
+            revision = uuid.uuid4().hex
+            if not self.backend.save_many([(user_id, merged.to_wire(), base_revision, revision)]):
+                return merged, revision
+        return None
+
+    def flush(self):
+        """
+        把待寫入的歷史批次寫入後端
+
+        返回:
+            int: 寫入的使用者數
+        """
+        if self.backend is None:
+            return 0
+        with self._flush_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            items = [(user_id, entry.history.to_wire(), entry.base_revision, uuid.uuid4().hex)
+                     for user_id, entry in pending.items()]
+            written = {}
+            failed = 0
+            try:
+                conflicts = self.backend.save_many(items)
+                for user_id, _, _, revision in items:
+                    if user_id not in conflicts:
+                        written[user_id] = (pending[user_id].history, revision)
+                for user_id in conflicts:
+                    resolved = self._resolve_conflict(user_id, pending[user_id])
+                    if resolved is None:
+                        raise RuntimeError(f"使用者 {user_id} 的對話歷史持續被其他 worker 更新")
+                    written[user_id] = resolved
+            except Exception as e:
+                # 沒寫入的放回待寫入區，下次再試（排在期間新增的更新之前）
+                with self._pending_lock:
+                    for user_id, entry in pending.items():
+                        if user_id not in written:
+                            self._requeue(user_id, entry)
+                            failed += 1
+                self._count("write_errors")
+                logger.error(f"寫入對話歷史失敗，稍後重試: {str(e)}")
+
+            now = time.time()
+            for user_id, (history, revision) in written.items():
+                stripe = self._stripe(user_id)
+                with stripe.lock:
+                    entry = stripe.entries.get(user_id)
+                    with self._pending_lock:
+                        newer = self._pending.get(user_id)
+                        if newer is not None:
+                            # 寫入期間又有新的對話輪：以剛寫入的內容為基準重新套用
+                            history = _apply_ops(history.copy(), newer.ops)
+                            newer.base_revision = revision
+                            newer.history = history.copy()
+                    if entry is not None:
+                        entry.history = history.copy()
+                        entry.revision = revision
+                        entry.validated_at = now
+            if written:
+                self._count("writes", len(written))
+                self._count("flushes")
+            return len(written)
+
+    def _ensure_writer(self):
+        """第一次寫入時啟動背景寫入執行緒（每個程序一條）"""
+        if self._writer_pid == os.getpid():
+            return
+        with self._counters_lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+
+        def writer_loop():
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error(f"對話歷史寫入執行緒發生錯誤: {str(e)}")
+
+        threading.Thread(target=writer_loop, name="conversation-writer", daemon=True).start()
+
+    def append_turn(self, user_id, query, response, max_turns=None):
+        """
+        加入一輪對話並標記使用者為活躍對話狀態
+
+        參數:
+            user_id: 使用者 ID
+            query: 使用者的問題
+            response: AI 的回應
+            max_turns: 最多保留的對話輪數，預設為 self.max_turns
+        """
+        self._ensure_sweeper()
+        if self.backend is not None:
+            # 先載入（或比對）後端的歷史；寫入時若其他 worker 仍先更新過，flush 會重新載入後再套用這一輪
+            self._current_history(user_id)
+        now = time.time()
+        stripe = self._stripe(user_id)
+        op = ("turn", query, response, (max_turns or self.max_turns) * 2)  # 一輪對話有兩條紀錄
+        with stripe.lock:
+            entry = self._touch(stripe, user_id, now)
+            _apply_ops(entry.history, [op])
+            entry.active_since = entry.active_since or now
+            self._mark_pending(user_id, entry, op)
+
+    def clear_history(self, user_id):
+        """
+        清除使用者的對話歷史
+
+        返回:
+            bool: 是否有歷史被清除
+        """
+        if self.backend is not None:
+            # 記憶體中沒有這位使用者時（例如重啟後）先從後端載入，後端保存的歷史也要一併清除
+            self._current_history(user_id)
+        stripe = self._stripe(user_id)
+        with stripe.lock:
+            entry = stripe.entries.get(user_id)
+            if not entry or not entry.history:
+                return False
+            entry.history.clear()
+            self._mark_pending(user_id, entry, ("clear",))
+            return True
+
+    def start_conversation(self, user_id):
+        """將使用者標記為活躍對話狀態（並更新最後互動時間）"""
+        self._ensure_sweeper()
+        now = time.time()
+        stripe = self._stripe(user_id)
+        with stripe.lock:
+            entry = self._touch(stripe, user_id, now)
+            entry.active_since = entry.active_since or now
+
+    def end_conversation(self, user_id):
+        """
+        結束使用者的活躍對話狀態（保留對話歷史）
+
+        返回:
+            bool: 使用者原本是否處於活躍對話狀態
+        """
+        stripe = self._stripe(user_id)
+        with stripe.lock:
+            entry = stripe.entries.get(user_id)
+            if not entry or entry.active_since is None:
+                return False
+            entry.active_since = None
+            return True
+
+    def is_active(self, user_id, timeout, now=None):
+        """
+        檢查使用者是否處於活躍對話狀態，超過 timeout 秒沒有互動時自動結束對話
+
+        返回:
+            tuple: (是否活躍, 距上次互動的秒數；不在對話中時為 None)
+        """
+        now = time.time() if now is None else now
+        stripe = self._stripe(user_id)
+        with stripe.lock:
+            entry = stripe.entries.get(user_id)
+            if not entry or entry.active_since is None:
+                return False, None
+            idle = now - entry.last_activity
+            if idle > timeout:
+                entry.active_since = None
+                return False, idle
+            return True, idle
+
+    def sweep(self, now=None):
+        """
+        移除閒置超過 ttl 的使用者
+
+        返回:
+            int: 移除的使用者數
+        """
+        cutoff = (time.time() if now is None else now) - self.ttl
+        removed = 0
+        for stripe in self._stripes:
+            with stripe.lock:
+                entries = stripe.entries
+                while entries:
+                    user_id, entry = next(iter(entries.items()))
+                    if entry.last_activity > cutoff:
+                        break
+                    del entries[user_id]
+                    removed += 1
+        self._count("expired", removed)
+        return removed
+
+    def _ensure_sweeper(self):
+        """第一次寫入時啟動背景清理執行緒（每個程序一條，fork 後的子程序會重新啟動）"""
+        if self._sweeper_pid == os.getpid():
+            return
+        with self._counters_lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+
+        def sweep_loop():
+            last_purge = 0
+            while True:
+                time.sleep(self.sweep_interval)
+                try:
+                    removed = self.sweep()
+                    if removed:
+                        logger.info(f"已清除 {removed} 位閒置使用者的對話狀態")
+                    if self.backend is not None and time.time() - last_purge > 3600:
+                        purged = self.backend.purge(time.time() - self.retention_seconds)
+                        last_purge = time.time()
+                        if purged:
+                            logger.info(f"已從後端刪除 {purged} 筆過期的對話歷史")
+                except Exception as e:
+                    logger.error(f"清理對話狀態時發生錯誤: {str(e)}")
+
+        threading.Thread(target=sweep_loop, name="conversation-sweeper", daemon=True).start()
+
+    def __len__(self):
+        return sum(len(stripe.entries) for stripe in self._stripes)
+
+    def estimate_bytes(self):
+        """估計對話狀態佔用的記憶體（使用者 ID、狀態物件、歷史緩衝區與訊息字串）"""
+        total = 0
+        for stripe in self._stripes:
+            with stripe.lock:
+                total += sys.getsizeof(stripe.entries)
+                for user_id, entry in stripe.entries.items():
+                    total += sys.getsizeof(user_id) + sys.getsizeof(entry) + entry.history.memory_size()
+        return total
+
+    def get_stats(self):
+        """
+        獲取儲存統計
+
+        返回:
+            dict: 使用者數、活躍對話數、上限設定、估計記憶體用量與淘汰計數
+        """
+        users = active = 0
+        for stripe in self._stripes:
+            with stripe.lock:
+                users += len(stripe.entries)
+                active += sum(1 for entry in stripe.entries.values() if entry.active_since is not None)
+        with self._counters_lock:
+            counters = dict(self._counters)
+            backend_counters = dict(self._backend_counters)
+        with self._pending_lock:
+            pending = len(self._pending)
+        return {
+            "users": users,
+            "active_conversations": active,
+            "max_users": self.max_users,
+            "ttl": self.ttl,
+            "stripes": len(self._stripes),
+            "estimated_bytes": self.estimate_bytes(),
+            "counters": counters,
+            "backend": {
+                "type": type(self.backend).__name__ if self.backend is not None else "memory",
+                "pending_writes": pending,
+                "counters": backend_counters,
+            },
+        }
+
+    def render_prometheus(self, prefix="conversation_store"):
+        """以 Prometheus 文字格式輸出儲存指標"""
+        stats = self.get_stats()
+        lines = [
+            f"# TYPE {prefix}_users gauge",
+            f"{prefix}_users {stats['users']}",
+            f"# TYPE {prefix}_active_conversations gauge",
+            f"{prefix}_active_conversations {stats['active_conversations']}",
+            f"# TYPE {prefix}_estimated_bytes gauge",
+            f"{prefix}_estimated_bytes {stats['estimated_bytes']}",
+            f"# TYPE {prefix}_evictions_total counter",
+        ]
+        for reason, value in stats["counters"].items():
+            lines.append(f'{prefix}_evictions_total{{reason="{reason}"}} {value}')
+        if self.backend is not None:
+            lines.append(f"# TYPE {prefix}_pending_writes gauge")
+            lines.append(f"{prefix}_pending_writes {stats['backend']['pending_writes']}")
+            lines.append(f"# TYPE {prefix}_backend_operations_total counter")
+            for operation, value in stats["backend"]["counters"].items():
+                lines.append(f'{prefix}_backend_operations_total{{operation="{operation}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+def _create_backend():
+    """依 CONVERSATION_BACKEND 建立持久化後端（sqlite 或 memory），失敗時只存在記憶體"""
+    kind = os.getenv("CONVERSATION_BACKEND", "sqlite").lower()
+    if kind == "memory":
+        return None
+    try:
+        return SQLiteHistoryBackend(os.getenv("CONVERSATION_DB"))
+    except Exception as e:
+        logger.error(f"初始化對話歷史資料庫失敗，對話歷史只保存在記憶體中: {str(e)}")
+        return None
+
+
+# 全域對話狀態儲存實例
+conversation_store = ConversationStore(
+    max_users=int(os.getenv("CONVERSATION_MAX_USERS", "10000")),
+    ttl=int(os.getenv("CONVERSATION_TTL_SECONDS", "86400")),
+    backend=_create_backend()
+)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+配額感知降級策略模組
+根據剩餘的每日 Gemini 配額與最近的 429 錯誤次數，逐步降低 API 使用量：
+
+等級 0 (normal)              : 正常運作
+等級 1 (rules_classification): 意圖分類改用規則，停止 404 回退模型探測
+等級 2 (reduced_tokens)      : 另外縮減 max_output_tokens
+等級 3 (cache_only)          : 只提供緩存回應，不再呼叫模型
+等級 4 (backup_only)         : 直接使用備用回應
+"""
+
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 導入流量限制器
+try:
+    from src.rate_limiter import gemini_limiter
+except ImportError:
+    try:
+        from rate_limiter import gemini_limiter
+    except ImportError:
+        gemini_limiter = None
+        logger.warning("無法導入流量限制器，降級策略將固定為正常等級")
+
+LEVEL_NORMAL = 0
+LEVEL_RULES_CLASSIFICATION = 1
+LEVEL_REDUCED_TOKENS = 2
+LEVEL_CACHE_ONLY = 3
+LEVEL_BACKUP_ONLY = 4
+
+LEVEL_NAMES = {
+    LEVEL_NORMAL: "normal",
+    LEVEL_RULES_CLASSIFICATION: "rules_classification",
+    LEVEL_REDUCED_TOKENS: "reduced_tokens",
+    LEVEL_CACHE_ONLY: "cache_only",
+    LEVEL_BACKUP_ONLY: "backup_only",
+}
+
+# 進入各等級的條件：(等級, 剩餘配額比例低於此值, 或最近 429 次數達到此值)
+DEFAULT_THRESHOLDS = [
+    (LEVEL_BACKUP_ONLY, 0.05, 8),
+    (LEVEL_CACHE_ONLY, 0.15, 5),
+    (LEVEL_REDUCED_TOKENS, 0.30, 3),
+    (LEVEL_RULES_CLASSIFICATION, 0.50, 1),
+]
+
+
+class DegradationPolicy:
+    """
+    配額感知降級策略
+
+    等級上升時立即生效；等級下降時每次只降一級，
+    且需在目前等級停留至少 recovery_seconds 秒，避免在臨界值附近來回切換
+    """
+
+    def __init__(self, limiter=None, thresholds=None, error_window=300,
+                 recovery_seconds=120, reduced_max_tokens=128):
+        """
+        初始化降級策略
+
+        參數:
+            limiter: 提供剩餘配額與 429 統計的流量限制器
+            thresholds: 進入各等級的條件，預設為 DEFAULT_THRESHOLDS
+            error_window: 統計 429 錯誤的時間範圍（秒）
+            recovery_seconds: 每降一級前需停留的秒數
+            reduced_max_tokens: 等級 2 以上的 max_output_tokens 上限
+        """
+        self.limiter = limiter
+        self.thresholds = sorted(thresholds or DEFAULT_THRESHOLDS, key=lambda t: t[0], reverse=True)
+        self.error_window = error_window
+        self.recovery_seconds = recovery_seconds
+        self.reduced_max_tokens = reduced_max_tokens
+
+        self._lock = threading.Lock()
+        self._level = LEVEL_NORMAL
+        self._level_since = time.monotonic()
+        self._last_inputs = {"remaining_ratio": 1.0, "recent_429": 0}
+
+    def _target_level(self, remaining_ratio, recent_errors):
+        """根據目前的配額狀況計算目標等級"""
+        for level, min_ratio, max_errors in self.thresholds:
+            if remaining_ratio < min_ratio or recent_errors >= max_errors:
+                return level
+        return LEVEL_NORMAL
+
+    def current_level(self):
+        """
+        獲取目前的降級等級
+
+        返回:
+            int: 0 ~ 4
+        """
+        if self.limiter is None:
+            return LEVEL_NORMAL
+
+        remaining_ratio = self.limiter.get_remaining_ratio()
+        recent_errors = self.limiter.count_recent_quota_errors(self.error_window)
+        target = self._target_level(remaining_ratio, recent_errors)
+
+        with self._lock:
+            self._last_inputs = {"remaining_ratio": remaining_ratio, "recent_429": recent_errors}
+            now = time.monotonic()
+
+            if target > self._level:
+                logger.warning(f"降級等級上升: {LEVEL_NAMES[self._level]} -> {LEVEL_NAMES[target]} "
+                               f"(剩餘配額 {remaining_ratio:.0%}, 最近 429 次數 {recent_errors})")
+                self._level = target
+                self._level_since = now
+            elif target < self._level and now - self._level_since >= self.recovery_seconds:
+                new_level = self._level - 1
+                logger.info(f"降級等級恢復: {LEVEL_NAMES[self._level]} -> {LEVEL_NAMES[new_level]}")
+                self._level = new_level
+                self._level_since = now
+
+            return self._level
+
+    def allow_model_classification(self):
+        """是否允許使用 Gemini 進行意圖分類"""
+        return self.current_level() < LEVEL_RULES_CLASSIFICATION
+
+    def allow_fallback_probes(self):
+        """是否允許在模型 404 時嘗試其他回退模型"""
+        return self.current_level() < LEVEL_RULES_CLASSIFICATION
+
+    def max_output_tokens(self, default=None):
+        """
+        獲取目前允許的 max_output_tokens
+
+        參數:
+            default: 正常情況下的設定值（None 表示不限制）
+
+        返回:
+            int 或 None
+        """
+        if self.current_level() < LEVEL_REDUCED_TOKENS:
+            return default
+        if default is None:
+            return self.reduced_max_tokens
+        return min(default, self.reduced_max_tokens)
+
+    def cache_only(self):
+        """是否只能提供緩存回應"""
+        return self.current_level() >= LEVEL_CACHE_ONLY
+
+    def backup_only(self):
+        """是否直接使用備用回應"""
+        return self.current_level() >= LEVEL_BACKUP_ONLY
+
+    def get_status(self):
+        """
+        獲取降級狀態，用於診斷端點
+
+        返回:
+            dict: 等級、名稱及判斷依據
+        """
+        level = self.current_level()
+        with self._lock:
+            inputs = dict(self._last_inputs)
+            since = round(time.monotonic() - self._level_since, 1)
+        return {
+            "level": level,
+            "name": LEVEL_NAMES[level],
+            "seconds_at_level": since,
+            "remaining_ratio": round(inputs["remaining_ratio"], 3),
+            "recent_429": inputs["recent_429"],
+            "error_window_seconds": self.error_window,
+        }
+
+
+# 全域降級策略實例
+degradation_policy = DegradationPolicy(gemini_limiter)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+回覆傳送策略模組
+LINE 的 reply token 免費且只需一次往返，push 則會計入每月的推播配額。
+本模組依緩存命中、規則意圖與最近的處理時間估計回答何時完成：
+
+- 一律不再先送「讓我想想...」，保留 reply token 給真正的回答
+- 預計來不及在預算內完成時，另外在一對一聊天中顯示 LINE 的載入動畫（plan 只決定這一點）
+- 傳送時 reply token 仍在有效期限內就先用 reply，失敗或過期才改用 push
+"""
+
+import os
+import math
+import time
+import logging
+import threading
+from collections import deque
+
+from linebot.v3.messaging import ShowLoadingAnimationRequest
+
+logger = logging.getLogger(__name__)
+
+# 導入共用的 LINE API 客戶端與訊息傳送器
+try:
+    from src.line_client import get_messaging_api
+    from src.line_sender import line_sender, MAX_MESSAGES_PER_REQUEST
+except ImportError:
+    from line_client import get_messaging_api
+    from line_sender import line_sender, MAX_MESSAGES_PER_REQUEST
+
+# 導入持久化推送佇列（push 失敗時排程重試）
+try:
+    from src.outbound_queue import outbound_queue
+except ImportError:
+    try:
+        from outbound_queue import outbound_queue
+    except ImportError:
+        outbound_queue = None
+
+# 導入緩存與意圖分類器（用於估計處理時間）
+try:
+    from src.response_cache import response_cache
+except ImportError:
+    try:
+        from response_cache import response_cache
+    except ImportError:
+        response_cache = None
+
+try:
+    from src.intent_classifier import intent_classifier
+except ImportError:
+    try:
+        from intent_classifier import intent_classifier
+    except ImportError:
+        intent_classifier = None
+
+# 處理路徑分類
+PATH_CACHE = "cache"   # 緩存命中
+PATH_LOCAL = "local"   # 待辦、儲存、查看已儲存內容等不需要生成回應的意圖
+PATH_MODEL = "model"   # 需要 Gemini 生成回應
+
+# 沒有歷史資料時的預設估計秒數
+DEFAULT_ESTIMATES = {
+    PATH_CACHE: 1.0,
+    PATH_LOCAL: 3.0,
+    PATH_MODEL: 12.0,
+}
+
+# 不需要生成回應的規則意圖
+LOCAL_INTENTS = {"todo", "save_content"}
+
+# 花生助手直接回答的查詢類型（其他查詢會搜尋記憶後交給 Gemini 生成回應）
+LOCAL_QUERY_TYPES = {"help", "knowledge", "content"}
+
+# reply token 超過此秒數就不再嘗試（LINE 並未保證確切的有效期限，保守估計）
+REPLY_TOKEN_MAX_AGE = 50
+
+# 載入動畫的最長秒數（LINE 限制為 5~60 秒，且需為 5 的倍數）
+MAX_LOADING_SECONDS = 60
+
+
+class DeliveryPolicy:
+    """依預估完成時間選擇 reply 或 push 的傳送策略"""
+
+    def __init__(self, reply_budget=None, percentile=0.9, sample_size=200):
+        """
+        初始化傳送策略
+
+        參數:
+            reply_budget: 預計在多少秒內完成才直接以 reply token 回答，預設讀取 LINE_REPLY_BUDGET_SECONDS
+            percentile: 以處理時間的哪個百分位數作為估計值
+            sample_size: 每個處理路徑保留的處理時間樣本數
+        """
+        self.reply_budget = reply_budget or float(os.getenv("LINE_REPLY_BUDGET_SECONDS", "20"))
+        self.percentile = percentile
+        self._lock = threading.Lock()
+        self._samples = {path: deque(maxlen=sample_size) for path in DEFAULT_ESTIMATES}
+        self._counters = {"reply": 0, "push": 0, "overflow_push": 0, "reply_failed": 0, "loading": 0,
+                          "planned_reply": 0, "planned_loading": 0}
+
+    def classify_path(self, query):
+        """
+        預測訊息的處理路徑
+
+        參數:
+            query: 去除觸發前綴後的訊息
+
+        返回:
+            str: cache / local / model
+        """
+        if response_cache is not None:
+            try:
+                if response_cache.get(query):
+                    return PATH_CACHE
+            except Exception:
+                pass
+        if intent_classifier is not None:
+            result = intent_classifier.classify_with_rules(query)
+            intent = result.get("intent")
+            if intent in LOCAL_INTENTS or (intent == "query" and result.get("queryType") in LOCAL_QUERY_TYPES):
+                return PATH_LOCAL
+        return PATH_MODEL
+
+    def estimate(self, path):
+        """
+        估計指定處理路徑的完成秒數（最近樣本的百分位數，沒有樣本時使用預設值）
+
+        參數:
+            path: 處理路徑
+
+        返回:
+            float: 秒數
+        """
+        with self._lock:
+            samples = sorted(self._samples[path])
+        if not samples:
+            return DEFAULT_ESTIMATES[path]
+        return samples[min(int(self.percentile * len(samples)), len(samples) - 1)]
+
+    def plan(self, query, received_at=None):
+        """
+        決定是否需要顯示載入動畫（傳送方式由 deliver 依 reply token 實際經過的時間決定）
+
+        參數:
+            query: 去除觸發前綴後的訊息
+            received_at: 事件的時間戳（epoch 秒），用於計算 reply token 已經過的時間
+
+        返回:
+            dict: path（處理路徑）、estimate（預估秒數）、show_loading（預計超過預算，需要顯示載入動畫）
+        """
+        path = self.classify_path(query)
+        estimate = self.estimate(path)
+        token_age = max(time.time() - received_at, 0) if received_at else 0
+        show_loading = token_age + estimate > self.reply_budget
+        with self._lock:
+            self._counters["planned_loading" if show_loading else "planned_reply"] += 1
+        logger.info(f"傳送策略: 路徑={path}, 預估 {estimate:.1f} 秒, token 已經過 {token_age:.1f} 秒, "
+                    f"{'顯示載入動畫' if show_loading else '不顯示載入動畫'}")
+        return {"path": path, "estimate": estimate, "show_loading": show_loading}
+
+    def executed_path(self, planned, used_model):
+        """
+        依實際執行的處理決定處理時間要記錄到哪個路徑（預測錯誤時不能把模型的延遲算進本地路徑）
+
+        參數:
+            planned: plan 預測的處理路徑
+            used_model: 是否實際呼叫了 Gemini 生成回應
+
+        返回:
+            str: cache / local / model
+        """
+        if not used_model:
+            return PATH_LOCAL
+        return PATH_CACHE if planned == PATH_CACHE else PATH_MODEL
+
+    def record(self, path, seconds):
+        """記錄一次實際處理時間"""
+        with self._lock:
+            self._samples[path].append(seconds)
+
+    def show_loading(self, chat_id, seconds=None):
+        """
+        顯示 LINE 載入動畫（僅支援一對一聊天，群組與聊天室會略過）
+
+        參數:
+            chat_id: 使用者 ID
+            seconds: 顯示秒數，預設依 reply_budget 推算
+        """
+        if not chat_id or not chat_id.startswith("U"):
+            return False
+        seconds = seconds or self.reply_budget
+        loading_seconds = int(min(max(5, math.ceil(seconds / 5) * 5), MAX_LOADING_SECONDS))
+        try:
+            get_messaging_api().show_loading_animation(
+                ShowLoadingAnimationRequest(chatId=chat_id, loadingSeconds=loading_seconds)
+            )
+            with self._lock:
+                self._counters["loading"] += 1
+            return True
+        except Exception as e:
+            logger.warning(f"顯示載入動畫失敗: {str(e)}")
+            return False
+
+    def deliver(self, chat_id, reply_token, messages, received_at=None):
+        """
+        傳送回答：reply token 仍在有效期限內時優先使用 reply，失敗或過期才改用 push
+
+        reply 一次最多 5 則，其餘的訊息以 push 補送；reply 成功後補送失敗不會重送已回覆的部分
+
+        參數:
+            chat_id: 推送對象（使用者、群組或聊天室 ID）
+            reply_token: 尚未使用的 reply token（已使用時傳入 None）
+            messages: 訊息物件列表
+            received_at: 事件的時間戳（epoch 秒）
+
+        返回:
+            str: "reply"（至少前 5 則以 reply 送出）或 "push"
+        """
+        token_age = max(time.time() - received_at, 0) if received_at else 0
+
+        if reply_token and token_age < REPLY_TOKEN_MAX_AGE:
+            try:
+                line_sender.reply(reply_token, messages[:MAX_MESSAGES_PER_REQUEST])
+            except Exception as e:
+                logger.warning(f"reply token 回覆失敗（已經過 {token_age:.1f} 秒），改用 push: {str(e)}")
+                with self._lock:
+                    self._counters["reply_failed"] += 1
+            else:
+                with self._lock:
+                    self._counters["reply"] += 1
+                overflow = messages[MAX_MESSAGES_PER_REQUEST:]
+                if overflow:
+                    try:
+                        self._push(chat_id, overflow)
+                        with self._lock:
+                            self._counters["overflow_push"] += 1
+                    except Exception as e:
+                        logger.error(f"補送其餘 {len(overflow)} 則訊息失敗: {str(e)}")
+                return "reply"
+
+        self._push(chat_id, messages)
+        with self._lock:
+            self._counters["push"] += 1
+        return "push"
+
+    def _push(self, chat_id, messages):
+        """推送訊息（有持久化佇列時交給佇列重試）"""
+        if outbound_queue is not None:
+            outbound_queue.push(chat_id, messages)
+        else:
+            line_sender.push(chat_id, messages)
+
+    def get_stats(self):
+        """
+        獲取傳送統計
+
+        返回:
+            dict: 各路徑的估計秒數與樣本數、計數器
+        """
+        paths = {path: {"estimate_seconds": round(self.estimate(path), 2),
+                        "samples": len(self._samples[path])}
+                 for path in DEFAULT_ESTIMATES}
+        with self._lock:
+            return {"reply_budget_seconds": self.reply_budget, "paths": paths, "counters": dict(self._counters)}
+
+
+# 全域傳送策略實例
+delivery_policy = DeliveryPolicy()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+持久化 webhook 事件佇列模組
+以 SQLite (WAL) 保存收到的 LINE 事件，提供至少一次 (at-least-once) 的處理保證：
+
+- 以 webhookEventId 去除 LINE 重送 (deliveryContext.isRedelivery) 造成的重複事件
+- 處理中的事件持有租約 (lease)，程序重啟後租約到期的事件會被重新處理
+- 失敗的事件以指數退避重試，超過次數後移入 dead_letters 表
+- 同一排序鍵（使用者）的事件依寫入順序處理：較早的事件尚未完成前，較晚的事件不會被領取
+- 放進訊息合併緩衝區的事件標記為 buffered（defer）：不擋住同一使用者較晚的事件，
+  整批處理完成後才標記完成；程序重啟後租約到期的 buffered 事件會被重新處理
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+# 導入共用的 SQLite 連線（每個執行緒、每個程序各自一條）
+try:
+    from src.sqlite_connection import ThreadLocalConnection
+except ImportError:
+    from sqlite_connection import ThreadLocalConnection
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = "pending"
+STATUS_PROCESSING = "processing"
+STATUS_BUFFERED = "buffered"
+STATUS_DONE = "done"
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               '.cache', 'webhook_events.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id TEXT UNIQUE,
+    body TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    lease_expires_at REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_events_status_next ON events (status, next_attempt_at);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id TEXT,
+    body TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    failed_at REAL NOT NULL
+);
+"""
+
+
+class DurableEventQueue:
+    """
+    SQLite 持久化事件佇列
+
+    新事件寫入後會立即交給工作池處理；寫入時同時設定一段「可見延遲」，
+    只有在這段時間內沒有被領取（例如程序在排入記憶體佇列後就重啟）時，
+    恢復執行緒才會重新派送，避免與正常流程重複派送
+    """
+
+    def __init__(self, db_path=None, lease_seconds=180, max_attempts=5, base_backoff=5,
+                 max_backoff=300, visibility_delay=30, retention_seconds=86400):
+        """
+        初始化事件佇列
+
+        參數:
+            db_path: SQLite 檔案路徑，預設為 .cache/webhook_events.db
+            lease_seconds: 處理事件的租約秒數，需大於單一事件的最長處理時間
+            max_attempts: 最多嘗試次數，超過後移入 dead_letters
+            base_backoff: 重試退避的基礎秒數
+            max_backoff: 重試退避的最大秒數
+            visibility_delay: 新事件未被領取多久後由恢復執行緒重新派送
+            retention_seconds: 已完成事件保留多久以供去重
+        """
+        self.db_path = db_path or DEFAULT_DB_PATH
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.visibility_delay = visibility_delay
+        self.retention_seconds = retention_seconds
+
+        self._connect = ThreadLocalConnection(self.db_path, row_factory=sqlite3.Row)
+        self._lock = threading.Lock()
+        self._recovery_pid = None
+        self._counters = {"enqueued": 0, "duplicates": 0, "redeliveries": 0, "completed": 0,
+                          "retried": 0, "dead_lettered": 0, "recovered": 0}
+
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        self._migrate(conn)
+        logger.info(f"持久化事件佇列已初始化: {self.db_path}")
+
+    def _migrate(self, conn):
+        """為舊版資料庫補上排序鍵欄位"""
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(events)")}
+        if "ordering_key" not in columns:
+            conn.execute("ALTER TABLE events ADD COLUMN ordering_key TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_events_ordering ON events (ordering_key, status, id)")
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._counters[key] += amount
+
+    def enqueue(self, event_id, body, is_redelivery=False, ordering_key=None):
+        """
+        寫入一個事件
+
+        參數:
+            event_id: webhookEventId（沒有時傳入 None，不做去重）
+            body: 只包含該事件的請求體文字
+            is_redelivery: deliveryContext.isRedelivery
+            ordering_key: 排序鍵（使用者 ID 等），相同鍵的事件依序處理
+
+        返回:
+            int 或 None: 事件的資料列 id；重複事件返回 None
+        """
+        now = time.time()
+        conn = self._connect()
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO events (event_id, ordering_key, body, status, next_attempt_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (event_id, ordering_key, body, STATUS_PENDING, now + self.visibility_delay, now, now)
+        )
+        if cursor.rowcount == 0:
+            self._count("duplicates")
+            if is_redelivery:
+                self._count("redeliveries")
+            logger.info(f"忽略重複的 webhook 事件: {event_id} (重送: {is_redelivery})")
+            return None
+
+        self._count("enqueued")
+        return cursor.lastrowid
+
+    def claim(self, row_id):
+        """
+        領取指定事件並取得租約
+
+        參數:
+            row_id: 事件的資料列 id
+
+        返回:
+            dict 或 None: 事件資料；已被其他工作者領取、已完成，
+                或同一排序鍵還有較早的事件未完成時返回 None
+        """
+        now = time.time()
+        conn = self._connect()
+        cursor = conn.execute(
+            "UPDATE events SET status = ?, attempts = attempts + 1, lease_expires_at = ?, updated_at = ? "
+            "WHERE id = ? AND (status = ? OR (status IN (?, ?) AND lease_expires_at <= ?)) "
+            "AND (ordering_key IS NULL OR NOT EXISTS ("
+            "    SELECT 1 FROM events AS earlier WHERE earlier.ordering_key = events.ordering_key "
+            "    AND earlier.id < events.id AND earlier.status NOT IN (?, ?)))",
+            (STATUS_PROCESSING, now + self.lease_seconds, now,
+             row_id, STATUS_PENDING, STATUS_PROCESSING, STATUS_BUFFERED, now, STATUS_DONE, STATUS_BUFFERED)
+        )
+        if cursor.rowcount == 0:
+            # 若是被較早的事件擋住，讓恢復執行緒在下一輪重新派送
+            conn.execute(
+                "UPDATE events SET next_attempt_at = ? WHERE id = ? AND status = ? AND next_attempt_at > ?",
+                (now, row_id, STATUS_PENDING, now)
+            )
+            return None
+        row = conn.execute("SELECT id, event_id, body, attempts FROM events WHERE id = ?", (row_id,)).fetchone()
+        return dict(row) if row else None
+
+    def defer(self, row_ids):
+        """
+        標記事件已放進訊息合併緩衝區（處理函數返回後不要標記完成），並延長租約
+
+        buffered 的事件不會擋住同一排序鍵較晚的事件；整批處理完成後由呼叫端 complete 或 fail
+
+        參數:
+            row_ids: 事件的資料列 id 列表
+        """
+        now = time.time()
+        self._connect().executemany(
+            "UPDATE events SET status = ?, lease_expires_at = ?, updated_at = ? WHERE id = ? AND status IN (?, ?)",
+            [(STATUS_BUFFERED, now + self.lease_seconds, now, row_id, STATUS_PROCESSING, STATUS_BUFFERED)
+             for row_id in row_ids]
+        )
+
+    def complete(self, row_id):
+        """標記事件處理完成"""
+        now = time.time()
+        self._connect().execute(
+            "UPDATE events SET status = ?, lease_expires_at = NULL, updated_at = ? WHERE id = ?",
+            (STATUS_DONE, now, row_id)
+        )
+        self._count("completed")
+
+    def fail(self, row_id, error):
+        """
+        標記事件處理失敗：以指數退避排程重試，超過次數則移入 dead_letters
+
+        參數:
+            row_id: 事件的資料列 id
+            error: 錯誤訊息
+        """
+        now = time.time()
+        conn = self._connect()
+        row = conn.execute("SELECT event_id, body, attempts FROM events WHERE id = ?", (row_id,)).fetchone()
+        if row is None:
+            return
+
+        if row["attempts"] >= self.max_attempts:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT INTO dead_letters (event_id, body, attempts, last_error, failed_at) VALUES (?, ?, ?, ?, ?)",
+                    (row["event_id"], row["body"], row["attempts"], str(error), now)
+                )
+                # 保留事件列（狀態為 done）以繼續擋下之後的重送
+                conn.execute(
+                    "UPDATE events SET status = ?, lease_expires_at = NULL, last_error = ?, updated_at = ? WHERE id = ?",
+                    (STATUS_DONE, str(error), now, row_id)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._count("dead_lettered")
+            logger.error(f"事件 {row['event_id']} 嘗試 {row['attempts']} 次仍失敗，已移入 dead_letters: {error}")
+            return
+
+        backoff = min(self.base_backoff * (2 ** (row["attempts"] - 1)), self.max_backoff)
+        conn.execute(
+            "UPDATE events SET status = ?, next_attempt_at = ?, lease_expires_at = NULL, last_error = ?, updated_at = ? "
+            "WHERE id = ?",
+            (STATUS_PENDING, now + backoff, str(error), now, row_id)
+        )
+        self._count("retried")
+        logger.warning(f"事件 {row['event_id']} 處理失敗，{backoff} 秒後重試 (第 {row['attempts']} 次): {error}")
+
+    def due_events(self, limit=50):
+        """
+        找出需要重新派送的事件：到期的重試、未被領取的新事件，以及租約已過期的處理中事件
+
+        被選出的事件會再延後一段可見延遲，避免在工作池消化前被重複派送
+
+        返回:
+            list: (資料列 id, 排序鍵) 的列表，依寫入順序排列
+        """
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, ordering_key FROM events WHERE (status = ? AND next_attempt_at <= ?) "
+                "OR (status IN (?, ?) AND lease_expires_at <= ?) ORDER BY id LIMIT ?",
+                (STATUS_PENDING, now, STATUS_PROCESSING, STATUS_BUFFERED, now, limit)
+            ).fetchall()
+            row_ids = [row["id"] for row in rows]
+            conn.executemany(
+                "UPDATE events SET status = ?, next_attempt_at = ?, lease_expires_at = NULL, updated_at = ? WHERE id = ?",
+                [(STATUS_PENDING, now + self.visibility_delay, now, row_id) for row_id in row_ids]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [(row["id"], row["ordering_key"]) for row in rows]
+
+    def purge_completed(self):
+        """刪除超過保留期限的已完成事件"""
+        cutoff = time.time() - self.retention_seconds
+        cursor = self._connect().execute(
+            "DELETE FROM events WHERE status = ? AND updated_at < ?", (STATUS_DONE, cutoff)
+        )
+        return cursor.rowcount
+
+    def start_recovery(self, submit_func, interval=10):
+        """
+        啟動恢復執行緒（每個程序一條），定期把需要重新派送的事件交給 submit_func
+
+        參數:
+            submit_func: 接收 (資料列 id, 排序鍵) 的派送函數
+            interval: 檢查間隔（秒）
+        """
+        with self._lock:
+            if self._recovery_pid == os.getpid():
+                return
+            self._recovery_pid = os.getpid()
+
+        def recovery_loop():
+            last_purge = 0
+            while True:
+                try:
+                    for row_id, ordering_key in self.due_events():
+                        self._count("recovered")
+                        submit_func(row_id, ordering_key)
+                    if time.time() - last_purge > 3600:
+                        purged = self.purge_completed()
+                        last_purge = time.time()
+                        if purged:
+                            logger.info(f"已清除 {purged} 筆過期的已完成事件")
+                except Exception as e:
+                    logger.error(f"事件恢復執行緒發生錯誤: {str(e)}")
+                time.sleep(interval)
+
+        threading.Thread(target=recovery_loop, name="event-queue-recovery", daemon=True).start()
+        logger.info("事件恢復執行緒已啟動")
+
+    def get_stats(self):
+        """
+        獲取佇列統計
+
+        返回:
+            dict: 各狀態的事件數、dead letter 數與計數器
+        """
+        conn = self._connect()
+        by_status = {row["status"]: row["n"] for row in
+                     conn.execute("SELECT status, COUNT(*) AS n FROM events GROUP BY status")}
+        dead_letters = conn.execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0]
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            "pending": by_status.get(STATUS_PENDING, 0),
+            "processing": by_status.get(STATUS_PROCESSING, 0),
+            "buffered": by_status.get(STATUS_BUFFERED, 0),
+            "done": by_status.get(STATUS_DONE, 0),
+            "dead_letters": dead_letters,
+            "counters": counters,
+        }
+
+    def render_prometheus(self, prefix="webhook_event_queue"):
+        """以 Prometheus 文字格式輸出佇列指標"""
+        stats = self.get_stats()
+        lines = [f"# TYPE {prefix}_events gauge"]
+        for status in (STATUS_PENDING, STATUS_PROCESSING, STATUS_BUFFERED, STATUS_DONE):
+            lines.append(f'{prefix}_events{{status="{status}"}} {stats[status]}')
+        lines.append(f"# TYPE {prefix}_dead_letters gauge")
+        lines.append(f"{prefix}_dead_letters {stats['dead_letters']}")
+        lines.append(f"# TYPE {prefix}_operations_total counter")
+        for key, value in stats["counters"].items():
+            lines.append(f'{prefix}_operations_total{{operation="{key}"}} {value}')
+        return "\n".join(lines) + "\n"
@@ -13,21 +13,39 @@ from dotenv import load_dotenv
 
 # 嘗試導入流量限制器
 try:
-    from rate_limiter import gemini_limiter
+    from rate_limiter import gemini_limiter, LANE_CHAT
     USE_RATE_LIMITER = True
     logger = logging.getLogger(__name__)
     logger.info("已啟用 Gemini API 流量限制器")
 except ImportError:
     try:
-        from src.rate_limiter import gemini_limiter
+        from src.rate_limiter import gemini_limiter, LANE_CHAT
         USE_RATE_LIMITER = True
         logger = logging.getLogger(__name__)
         logger.info("已啟用 Gemini API 流量限制器 (從 src 導入)")
     except ImportError:
         USE_RATE_LIMITER = False
+        LANE_CHAT = "chat"
         logger = logging.getLogger(__name__)
         logger.warning("流量限制器導入失敗，將不使用流量控制功能")
 
+# 嘗試導入降級策略與回應緩存
+try:
+    from degradation_policy import degradation_policy
+except ImportError:
+    try:
+        from src.degradation_policy import degradation_policy
+    except ImportError:
+        degradation_policy = None
+
+try:
+    from response_cache import response_cache
+except ImportError:
+    try:
+        from src.response_cache import response_cache
+    except ImportError:
+        response_cache = None
+
 def init_genai():
     """初始化 Google Generative AI API"""
     api_key = os.getenv('GEMINI_API_KEY')
@@ -44,7 +62,7 @@ def init_genai():
         logger.error(f"初始化 Gemini API 時發生錯誤: {str(e)}")
         return False
 
-def get_gemini_response(prompt, conversation_history=None, max_retries=5, retry_delay=3):
+def get_gemini_response(prompt, conversation_history=None, max_retries=5, retry_delay=3, lane=LANE_CHAT):
     """
     獲取 Gemini 的回應，包含重試機制和配額限制處理
     
@@ -53,6 +71,7 @@ def get_gemini_response(prompt, conversation_history=None, max_retries=5, retry_
         conversation_history: 對話歷史記錄，用於維持上下文 (選填)
         max_retries: 最大重試次數 (默認為 5)
         retry_delay: 重試前的等待秒數 (默認為 3)
+        lane: 流量限制器的優先級通道 (默認為 chat)
         
     返回:
         回應文本，若有錯誤則返回錯誤訊息或備用回應
@@ -68,6 +87,23 @@ def get_gemini_response(prompt, conversation_history=None, max_retries=5, retry_
         logger.warning(f"在 Gemini 服務中檢測到圖片生成請求: {prompt[:30]}...")
         return "抱歉，我目前不支援圖片生成功能。我可以幫您回答文字問題或提供其他服務。"
     
+    # 配額感知降級：依序改用緩存與備用回應
+    if degradation_policy and degradation_policy.backup_only():
+        logger.warning("配額降級中，直接使用備用回應")
+        return get_backup_response(prompt)
+    if degradation_policy and degradation_policy.cache_only():
+        cached_response = response_cache.get(prompt) if response_cache else None
+        if cached_response:
+            logger.info("配額降級中，使用緩存回應")
+            return cached_response
+        logger.warning("配額降級中且無緩存，使用備用回應")
+        return get_backup_response(prompt)
+    
+    # 依降級等級決定輸出長度上限與是否探測回退模型
+    max_output_tokens = degradation_policy.max_output_tokens() if degradation_policy else None
+    generation_config = {"max_output_tokens": max_output_tokens} if max_output_tokens else None
+    allow_fallback_probes = degradation_policy.allow_fallback_probes() if degradation_policy else True
+    
     # 初始化 Gemini API
     if not init_genai():
         logger.error("Gemini API 初始化失敗")
@@ -98,15 +134,16 @@ def get_gemini_response(prompt, conversation_history=None, max_retries=5, retry_
                         logger.info(f"使用對話歷史，長度: {len(conversation_history)}")
                         # 將完整的對話歷史直接傳給 generate_content
                         # 包括當前的問題
-                        response = model.generate_content(conversation_history + [{"role": "user", "parts": [prompt]}])
+                        response = model.generate_content(conversation_history + [{"role": "user", "parts": [prompt]}],
+                                                          generation_config=generation_config)
                         return response.text
                     else:
                         # 單次回應
                         logger.info("沒有對話歷史，使用單次查詢")
-                        response = model.generate_content(prompt)
+                        response = model.generate_content(prompt, generation_config=generation_config)
                         return response.text
                 except Exception as e:
-                    if "404" in str(e) and (model_name != models[-1]):
+                    if "404" in str(e) and (model_name != models[-1]) and allow_fallback_probes:
                         # 如果是模型不存在錯誤，且不是最後一個模型，則嘗試下一個模型
                         logger.warning(f"模型 {model_name} 不可用: {str(e)}")
                         continue
@@ -116,7 +153,7 @@ def get_gemini_response(prompt, conversation_history=None, max_retries=5, retry_
         
         # 使用流量限制器執行請求
         result, error = gemini_limiter.execute_with_rate_limit(
-            execute_api_request, max_retries=max_retries
+            execute_api_request, max_retries=max_retries, lane=lane
         )
         
         if result:
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+精簡的對話歷史表示模組
+原本每則訊息都存成 {"role": ..., "parts": [text]}（一個 dict 加一個 list），
+每輪對話後再以 [-MAX_HISTORY*2:] 切片，整個列表每次都重新配置。
+
+HistoryBuffer 是每位使用者一個固定容量的環形緩衝區：
+訊息文字放在一個列表中，角色以一個位元組的代碼存在 bytearray，
+新增與淘汰最舊的訊息都是 O(1)，只有在組 Gemini 請求時才轉換為 wire format
+"""
+
+import sys
+
+# 角色代碼
+ROLE_USER = 0
+ROLE_MODEL = 1
+
+ROLE_NAMES = ("user", "model")
+ROLE_CODES = {name: code for code, name in enumerate(ROLE_NAMES)}
+
+
+class HistoryBuffer:
+    """固定容量的對話訊息環形緩衝區"""
+
+    __slots__ = ("capacity", "_texts", "_roles", "_start")
+
+    def __init__(self, capacity):
+        """
+        參數:
+            capacity: 最多保留的訊息數（一輪對話有兩則訊息）
+        """
+        self.capacity = capacity
+        self._texts = []
+        self._roles = bytearray()
+        self._start = 0  # 緩衝區填滿後，最舊訊息的位置
+
+    def __len__(self):
+        return len(self._texts)
+
+    def __bool__(self):
+        return bool(self._texts)
+
+    def append(self, role, text):
+        """
+        新增一則訊息，超過容量時覆蓋最舊的訊息
+
+        參數:
+            role: ROLE_USER / ROLE_MODEL，或 "user" / "model"
+            text: 訊息文字
+        """
+        code = ROLE_CODES[role] if isinstance(role, str) else role
+        if len(self._texts) < self.capacity:
+            self._texts.append(text)
+            self._roles.append(code)
+            return
+        self._texts[self._start] = text
+        self._roles[self._start] = code
+        self._start = (self._start + 1) % self.capacity
+
+    def append_turn(self, query, response):
+        """新增一輪對話（使用者的問題與模型的回應）"""
+        self.append(ROLE_USER, query)
+        self.append(ROLE_MODEL, response)
+
+    def clear(self):
+        """清除所有訊息"""
+        self._texts = []
+        self._roles = bytearray()
+        self._start = 0
+
+    def resize(self, capacity):
+        """調整容量（縮小時保留最新的訊息）"""
+        if capacity == self.capacity:
+            return
+        items = list(self)[-capacity:] if capacity else []
+        self.capacity = capacity
+        self._texts = [text for _, text in items]
+        self._roles = bytearray(code for code, _ in items)
+        self._start = 0
+
+    def __iter__(self):
+        """依時間順序產生 (角色代碼, 文字)"""
+        texts, roles, size = self._texts, self._roles, len(self._texts)
+        for offset in range(size):
+            index = (self._start + offset) % size
+            yield roles[index], texts[index]
+
+    def copy(self):
+        """返回內容相同的新緩衝區"""
+        other = HistoryBuffer(self.capacity)
+        other._texts = list(self._texts)
+        other._roles = bytearray(self._roles)
+        other._start = self._start
+        return other
+
+    def to_wire(self):
+        """轉換為 Gemini 的歷史格式：[{"role": ..., "parts": [text]}, ...]"""
+        return [{"role": ROLE_NAMES[code], "parts": [text]} for code, text in self]
+
+    @classmethod
+    def from_wire(cls, history, capacity):
+        """
+        由 Gemini 格式的歷史建立緩衝區（超過容量時只保留最新的訊息）
+
+        參數:
+            history: [{"role": ..., "parts": [text]}, ...]
+            capacity: 緩衝區容量
+        """
+        buffer = cls(capacity)
+        for message in history[-capacity:] if capacity else ():
+            parts = message.get("parts") or [""]
+            buffer.append(ROLE_CODES.get(message.get("role"), ROLE_USER), parts[0])
+        return buffer
+
+    def memory_size(self, include_texts=True):
+        """估計佔用的位元組數（include_texts 為 False 時只計算結構本身）"""
+        size = sys.getsizeof(self) + sys.getsizeof(self._texts) + sys.getsizeof(self._roles)
+        if include_texts:
+            size += sum(sys.getsizeof(text) for text in self._texts)
+        return size
+
+
+if __name__ == "__main__":
+    # 記憶體基準測試：十萬位使用者、每人保留 10 輪對話（python src/history_buffer.py）
+    import gc
+    import time
+    import tracemalloc
+
+    USERS = 100_000
+    MAX_TURNS = 10
+    TURNS_PER_USER = 15  # 超過上限，包含淘汰最舊訊息的情況
+    # 訊息文字在兩種表示中都相同，這裡共用字串物件，只比較容器本身的開銷
+    QUERIES = [f"問題 {i}：明天台北天氣如何？" for i in range(TURNS_PER_USER)]
+    RESPONSES = [f"回答 {i}：明天台北多雲時晴，氣溫 22 到 28 度。" for i in range(TURNS_PER_USER)]
+
+    def build_legacy():
+        """原本的 list of dict 加切片"""
+        histories = {}
+        for user in range(USERS):
+            history = []
+            for query, response in zip(QUERIES, RESPONSES):
+                history.append({"role": "user", "parts": [query]})
+                history.append({"role": "model", "parts": [response]})
+                if len(history) > MAX_TURNS * 2:
+                    history = history[-MAX_TURNS * 2:]
+            histories[f"U{user:032x}"] = history
+        return histories
+
+    def build_buffers():
+        """HistoryBuffer 環形緩衝區"""
+        histories = {}
+        for user in range(USERS):
+            buffer = HistoryBuffer(MAX_TURNS * 2)
+            for query, response in zip(QUERIES, RESPONSES):
+                buffer.append_turn(query, response)
+            histories[f"U{user:032x}"] = buffer
+        return histories
+
+    for name, build in (("原本的 list of dict", build_legacy), ("HistoryBuffer", build_buffers)):
+        gc.collect()
+        tracemalloc.start()
+        started = time.perf_counter()
+        histories = build()
+        elapsed = time.perf_counter() - started
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name}: {current / 1024 / 1024:.1f} MiB（每位使用者 {current / USERS:.0f} bytes），"
+              f"建立耗時 {elapsed:.2f} 秒")
+        del histories
+
+    # 轉換為 wire format 的成本（每次組請求只轉換一位使用者）
+    buffer = HistoryBuffer(MAX_TURNS * 2)
+    for query, response in zip(QUERIES, RESPONSES):
+        buffer.append_turn(query, response)
+    number = 100_000
+    started = time.perf_counter()
+    for _ in range(number):
+        buffer.to_wire()
+    print(f"to_wire（{len(buffer)} 則訊息）: 每次 {(time.perf_counter() - started) / number * 1e6:.2f} µs")
@@ -26,6 +26,25 @@ except ImportError:
     GEMINI_AVAILABLE = False
     logger.warning("Gemini API 未安裝，意圖分類將使用基於規則的方法")
 
+# 導入流量限制器（意圖分類使用 classification 通道，配額緊張時優先被淘汰）
+try:
+    from src.rate_limiter import gemini_limiter, LANE_CLASSIFICATION
+except ImportError:
+    try:
+        from rate_limiter import gemini_limiter, LANE_CLASSIFICATION
+    except ImportError:
+        gemini_limiter = None
+        LANE_CLASSIFICATION = "classification"
+
+# 導入降級策略（配額不足時第一步就是停止使用 Gemini 分類）
+try:
+    from src.degradation_policy import degradation_policy
+except ImportError:
+    try:
+        from degradation_policy import degradation_policy
+    except ImportError:
+        degradation_policy = None
+
 
 class IntentClassifier:
     """意圖分類器類別"""
@@ -63,15 +82,37 @@ class IntentClassifier:
         
         # 優先使用 Gemini API 進行分類
         if self.model:
-            try:
-                return self._classify_with_gemini(message)
-            except Exception as e:
-                logger.error(f"使用 Gemini API 分類失敗: {e}")
-                logger.info("改用基於規則的分類")
+            if degradation_policy and not degradation_policy.allow_model_classification():
+                logger.info("配額降級中，意圖分類改用基於規則的分類")
+            elif gemini_limiter and not gemini_limiter.wait_if_needed(lane=LANE_CLASSIFICATION):
+                logger.info("意圖分類通道配額不足，改用基於規則的分類")
+            else:
+                try:
+                    result = self._classify_with_gemini(message)
+                    if gemini_limiter:
+                        gemini_limiter.record_success()
+                    return result
+                except Exception as e:
+                    logger.error(f"使用 Gemini API 分類失敗: {e}")
+                    if "429" in str(e) and gemini_limiter:
+                        gemini_limiter.record_quota_error(str(e))
+                    logger.info("改用基於規則的分類")
         
         # 使用基於規則的分類作為備援
         return self._classify_with_rules(message)
     
+    def classify_with_rules(self, message: str) -> Dict:
+        """
+        只使用規則進行意圖分類（不呼叫 API，用於快速預估處理路徑）
+        
+        Args:
+            message: 用戶訊息
+            
+        Returns:
+            Dict: 與 classify_intent 相同格式的分類結果
+        """
+        return self._classify_with_rules(message.strip())
+    
     def _classify_with_gemini(self, message: str) -> Dict:
         """使用 Gemini API 進行意圖分類"""
         
@@ -187,7 +228,8 @@ class IntentClassifier:
         query_keywords = ['推薦', '建議', '如何', '什麼', '哪些', '怎樣', '為什麼', '可以告訴我', '我想知道']
         recommendation_keywords = ['推薦', '介紹一些', '有什麼好的']
         feedback_keywords = ['建議', '意見', '看法', '想法']
-        history_keywords = ['之前', '以前', '過去', '上次', '聊過什麼']
+        history_keywords = ['之前', '以前', '過去', '上次', '聊過什麼', '上週', '上禮拜', '上星期', '昨天', '前天', '做了什麼', '聊了什麼']
+        history_query_keywords = ['聊過', '問過', '聊了什麼', '做了什麼', '做過什麼']
         # 幫助和功能查詢關鍵字（優先級最高）
         help_keywords = ['你會什麼', '有什麼功能', '可以做什麼', '會做什麼', '能做什麼', '怎麼用', '使用說明', '使用教學', '教學', '說明', 'help', '幫助', '功能列表', '功能清單', '指令列表']
         # 知識查詢關鍵字（加入單字查詢，優先度較高）
@@ -238,6 +280,14 @@ class IntentClassifier:
                 result["confidence"] = 0.9
                 return result
         
+        # 明確詢問過往對話或做過的事（例如「我之前聊過台南嗎」），即使沒有一般的查詢關鍵字
+        for keyword in history_query_keywords:
+            if keyword in message:
+                result["intent"] = "query"
+                result["queryType"] = "chat_history"
+                result["confidence"] = 0.85
+                return result
+        
         is_query = any(keyword in message for keyword in query_keywords)
         
         if is_query:
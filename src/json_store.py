@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+JSON 文件寫回快取模組
+ContentManager、LocalMemoryManager 與 LinkStorage 都把每位使用者的資料存成一個 JSON 檔，
+原本每次讀取都 json.load 整個檔案、每次寫入都 json.dump(indent=2) 整個檔案。
+
+本模組提供共用的寫回 (write-back) 快取：
+- 常用的文件保留在記憶體中（依最近使用淘汰，只淘汰已寫入的文件）
+- 寫入只更新記憶體並標記為待寫入，由背景執行緒定期批次寫入；
+  待寫入的文件數達到上限時立即喚醒背景執行緒，程序結束時也會寫入
+- 同一使用者連續多次操作只需要寫一次檔案（先寫入暫存檔再 os.replace，不會留下寫到一半的檔案）
+- 每次寫入檔案都在 {path}.lock（同時作為 fcntl.flock 的鎖）寫入新的隨機修訂 (revision)，
+  讀取時比對修訂，其他 worker 更新過的檔案會重新載入；不使用修改時間與大小判斷
+  （同一個時間刻度內寫入、大小相同的兩個版本無法分辨）
+- 寫入時若檔案的修訂與載入時不同，在檔案鎖下重新讀取並合併：
+  以載入時的內容為基準，只套用這個 worker 新增、修改與刪除的項目（列表以 item["id"] 為鍵），
+  其他 worker 的修改不會被覆蓋；還沒有修訂的舊檔案一律重新讀取並合併
+"""
+
+import os
+import json
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows 沒有 fcntl，只在單一程序下使用
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class _Document:
+    """快取中的一份文件"""
+
+    __slots__ = ("data", "dirty", "revision", "version", "base")
+
+    def __init__(self, data, revision, version, dirty=False, base=None):
+        self.data = data
+        self.dirty = dirty
+        self.revision = revision  # 載入或寫入時檔案的修訂，檔案不存在或還沒有修訂時為 None
+        self.version = version  # 內容每次改變（寫入或重新載入）時遞增
+        self.base = base  # 載入或寫入時檔案的內容（合併其他 worker 的修改時作為基準）
+
+
+def _read_revision(path):
+    """返回檔案目前的修訂（記錄在 {path}.lock），檔案不存在或還沒有修訂時返回 None"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(f"{path}.lock", 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+class WriteBackJsonStore:
+    """以檔案路徑為鍵的 JSON 文件寫回快取"""
+
+    def __init__(self, max_documents=1000, flush_interval=2.0, max_dirty=50):
+        """
+        初始化快取
+
+        參數:
+            max_documents: 記憶體中最多保留的文件數
+            flush_interval: 背景寫入的間隔（秒）
+            max_dirty: 待寫入的文件數達到此數量時立即寫入
+        """
+        self.max_documents = max_documents
+        self.flush_interval = flush_interval
+        self.max_dirty = max_dirty
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._documents = OrderedDict()  # path -> _Document
+        self._dirty = set()
+        self._flusher_pid = None
+        self._wakeup = None
+        self._next_version = 0
+        self._counters = {"hits": 0, "loads": 0, "reloads": 0, "saves": 0, "writes": 0,
+                          "flushes": 0, "merges": 0, "write_errors": 0, "evictions": 0}
+        atexit.register(self.flush)
+
+    def load(self, path, default=list):
+        """
+        讀取文件
+
+        參數:
+            path: JSON 檔案路徑
+            default: 檔案不存在或無法解析時產生預設值的函數
+
+        返回:
+            文件內容的淺複本（呼叫端修改列表不會影響快取，修改後需呼叫 save）
+        """
+        return self.load_with_version(path, default)[0]
+
+    def load_with_version(self, path, default=list):
+        """
+        讀取文件與它的版本（版本相同表示內容沒有改變，可用來判斷衍生的索引是否需要更新）
+
+        返回:
+            tuple: (文件內容的淺複本, 版本)；無法解析時版本為 None
+        """
+        # 先讀修訂再讀檔案：寫入端先取代檔案才更新修訂，讀到的內容不會比修訂舊
+        revision = _read_revision(path)
+        with self._lock:
+            document = self._documents.get(path)
+            if document is not None and (document.dirty or (revision is not None and document.revision == revision)):
+                self._documents.move_to_end(path)
+                self._counters["hits"] += 1
+                return _shallow_copy(document.data), document.version
+            self._counters["reloads" if document is not None else "loads"] += 1
+
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = default()
+        except Exception as e:
+            logger.error(f"載入 JSON 檔案失敗: {path}: {e}")
+            return default(), None
+
+        with self._lock:
+            current = self._documents.get(path)
+            # 讀取檔案期間若有其他執行緒寫入，以記憶體中待寫入的版本為準
+            if current is not None and current.dirty:
+                return _shallow_copy(current.data), current.version
+            document = _Document(data, revision, self._new_version(), base=data)
+            self._documents[path] = document
+            self._documents.move_to_end(path)
+            self._evict()
+            return _shallow_copy(data), document.version
+
+    def _new_version(self):
+        """產生新的版本號（呼叫端需持有鎖）"""
+        self._next_version += 1
+        return self._next_version
+
+    def save(self, path, data):
+        """
+        寫入文件（延後寫入檔案）
+
+        參數:
+            path: JSON 檔案路徑
+            data: 新的文件內容
+        """
+        with self._lock:
+            document = self._documents.get(path)
+            if document is None:
+                document = _Document(data, None, self._new_version(), dirty=True)
+                self._documents[path] = document
+            else:
+                document.data = data
+                document.dirty = True
+                document.version = self._new_version()
+            self._documents.move_to_end(path)
+            self._dirty.add(path)
+            self._counters["saves"] += 1
+            dirty_count = len(self._dirty)
+            self._evict()
+        wakeup = self._ensure_flusher()
+        if dirty_count >= self.max_dirty:
+            wakeup.set()
+
+    def _evict(self):
+        """超過容量時淘汰最久未使用、且已寫入檔案的文件（呼叫端需持有鎖）"""
+        if len(self._documents) <= self.max_documents:
+            return
+        for path in list(self._documents):
+            if len(self._documents) <= self.max_documents:
+                break
+            if not self._documents[path].dirty:
+                del self._documents[path]
+                self._counters["evictions"] += 1
+
+    def flush(self):
+        """
+        把所有待寫入的文件寫入檔案
+
+        返回:
+            int: 寫入的檔案數
+        """
+        with self._flush_lock:
+            with self._lock:
+                # 寫入完成前文件仍標記為待寫入，讀取不會以檔案的舊內容取代它
+                batch = []
+                for path in self._dirty:
+                    document = self._documents.get(path)
+                    if document is not None:
+                        batch.append((path, document, document.data, document.base, document.revision,
+                                      document.version))
+                self._dirty.clear()
+
+            written = 0
+            for path, document, data, base, loaded_revision, version in batch:
+                try:
+                    with _locked(path) as lock:
+                        merged = data
+                        if os.path.exists(path) and (loaded_revision is None or
+                                                     _read_revision(path) != loaded_revision):
+                            # 載入後被其他 worker 寫入過（或無法確定）：只套用這個 worker 的修改
+                            with open(path, 'r', encoding='utf-8') as f:
+                                merged = _merge(base, data, json.load(f))
+                            with self._lock:
+                                self._counters["merges"] += 1
+                        _write_atomic(path, merged)
+                        revision = lock.write_revision()
+                except Exception as e:
+                    logger.error(f"寫入 JSON 檔案失敗，稍後重試: {path}: {e}")
+                    with self._lock:
+                        self._counters["write_errors"] += 1
+                        self._dirty.add(path)
+                    continue
+                with self._lock:
+                    # 之後的修改都以這次寫入的內容為基準。合併過其他 worker 的修改時，
+                    # 記憶體中的內容與檔案不同：不直接取代（呼叫端可能正以舊的內容修改），
+                    # 清除修訂讓下次讀取重新載入、下次寫入再合併
+                    document.base = data
+                    document.revision = revision if merged is data else None
+                    if document.version == version:
+                        document.dirty = False
+                    else:
+                        self._dirty.add(path)  # 寫入期間又被修改
+                written += 1
+
+            if batch:
+                with self._lock:
+                    self._counters["writes"] += written
+                    self._counters["flushes"] += 1
+            return written
+
+    def _ensure_flusher(self):
+        """啟動背景寫入執行緒（每個程序一條，fork 後的子程序會重新啟動），返回喚醒用的 Event"""
+        if self._flusher_pid == os.getpid():
+            return self._wakeup
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return self._wakeup
+            wakeup = threading.Event()
+            self._wakeup = wakeup
+            self._flusher_pid = os.getpid()
+
+        def flush_loop():
+            while True:
+                wakeup.wait(self.flush_interval)
+                wakeup.clear()
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error(f"JSON 寫入執行緒發生錯誤: {str(e)}")
+
+        threading.Thread(target=flush_loop, name="json-store-flusher", daemon=True).start()
+        return wakeup
+
+    def get_stats(self):
+        """
+        獲取快取統計
+
+        返回:
+            dict: 快取的文件數、待寫入的文件數與計數器
+        """
+        with self._lock:
+            return {
+                "documents": len(self._documents),
+                "dirty": len(self._dirty),
+                "counters": dict(self._counters),
+            }
+
+
+def _shallow_copy(data):
+    """列表與 dict 返回淺複本，其他型別直接返回"""
+    if isinstance(data, list):
+        return list(data)
+    if isinstance(data, dict):
+        return dict(data)
+    return data
+
+
+def _item_key(item):
+    """列表項目的鍵：有 id 的 dict 以 id 為鍵，其他以內容為鍵"""
+    if isinstance(item, dict) and "id" in item:
+        return "id", item["id"]
+    return "value", json.dumps(item, ensure_ascii=False, sort_keys=True)
+
+
+def _merge(base, ours, theirs):
+    """
+    三方合併：以 base 為基準，把 ours 的修改（新增、修改、刪除）套用到 theirs 上
+
+    列表以 _item_key 對應項目，dict 以鍵對應；其他型別或型別不一致時以 ours 為準
+    """
+    if isinstance(ours, list) and isinstance(theirs, list):
+        base_items = {_item_key(item): item for item in base} if isinstance(base, list) else {}
+        our_items = {_item_key(item): item for item in ours}
+        merged = []
+        seen = set()
+        for item in theirs:
+            key = _item_key(item)
+            seen.add(key)
+            if key in our_items:
+                # 這個 worker 修改過的項目以這個 worker 的為準
+                merged.append(our_items[key] if our_items[key] != base_items.get(key) else item)
+            elif key not in base_items:
+                merged.append(item)  # 其他 worker 新增的項目
+            # 否則是這個 worker 刪除的項目
+        for key, item in our_items.items():
+            # 這個 worker 新增（或修改後被其他 worker 刪除）的項目
+            if key not in seen and (key not in base_items or item != base_items[key]):
+                merged.append(item)
+        return merged
+    if isinstance(ours, dict) and isinstance(theirs, dict):
+        base = base if isinstance(base, dict) else {}
+        merged = dict(theirs)
+        for key in set(base) | set(ours):
+            if key not in ours:
+                merged.pop(key, None)
+            elif key not in base or ours[key] != base[key]:
+                merged[key] = ours[key]
+        return merged
+    return ours
+
+
+class _locked:
+    """在 {path}.lock 上取得獨占的 flock，讓各 worker 依序讀取、合併與寫入同一個檔案"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.file = open(f"{self.path}.lock", 'a+', encoding='utf-8')
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def write_revision(self):
+        """檔案取代後記錄新的修訂（必須在寫入檔案之後，讀取端才不會以新的修訂快取舊的內容）"""
+        revision = os.urandom(16).hex()
+        self.file.seek(0)
+        self.file.truncate()
+        self.file.write(revision)
+        self.file.flush()
+        return revision
+
+    def __exit__(self, *exc):
+        # 關閉檔案會一併釋放 flock
+        self.file.close()
+        return False
+
+
+def _write_atomic(path, data):
+    """先寫入暫存檔再取代原檔案"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+# 全域 JSON 文件快取實例
+json_store = WriteBackJsonStore(
+    max_documents=int(os.getenv("JSON_STORE_MAX_DOCUMENTS", "1000")),
+    flush_interval=float(os.getenv("JSON_STORE_FLUSH_SECONDS", "2"))
+)
+
+
+if __name__ == "__main__":
+    # 多程序測試：4 個程序同時新增與刪除同一個檔案的項目，最後不能遺失其他程序的修改（python src/json_store.py）
+    import tempfile
+    import multiprocessing
+
+    def worker(path, name):
+        store = WriteBackJsonStore(flush_interval=0.01)
+        for i in range(200):
+            items = store.load(path)
+            items.append({"id": f"{name}-{i}"})
+            items = [item for item in items if item["id"] != f"{name}-{i - 1}" or i % 2]
+            store.save(path, items)
+            if i % 7 == 0:
+                store.flush()
+        store.flush()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "items.json")
+        processes = [multiprocessing.Process(target=worker, args=(path, f"p{n}")) for n in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        with open(path, encoding="utf-8") as f:
+            ids = [item["id"] for item in json.load(f)]
+        expected = {f"p{n}-{i}" for n in range(4) for i in range(200) if i % 2 == 0 or i == 199}
+        assert len(ids) == len(set(ids)), "重複的項目"
+        assert set(ids) == expected, f"遺失 {len(expected - set(ids))} 筆，多出 {len(set(ids) - expected)} 筆"
+        print(f"OK: {len(ids)} 筆")
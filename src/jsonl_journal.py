@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+"""
+只附加 (append-only) 的 JSONL 日誌模組
+原本 ContentManager 每儲存一則內容都要重寫整個 JSON 檔，成本隨使用者累積的內容數增加。
+
+日誌格式是每行一筆操作：
+- {"op": "gen", "id": "..."}：第一行，檔案的世代（隨機產生，每次壓縮都會換新）
+- {"op": "put", "item": {...}}：新增或取代一個項目（以 item["id"] 為鍵）
+- {"op": "del", "id": "..."}：刪除項目（墓碑）
+
+載入時依序套用所有操作，在記憶體中建立目前的項目（materialized view）；
+之後只讀取檔案新增的部分，其他 worker 附加的操作也會被套用。
+新增與刪除都只附加一行，是 O(1)。
+被取代或刪除的操作（垃圾）佔比超過門檻時，由背景執行緒壓縮：只把目前的項目重寫成新的日誌檔。
+附加與壓縮都在檔案鎖（fcntl.flock）下進行，壓縮後仍開著舊檔案的 worker 會重新開啟。
+檔案以第一行的世代識別，不使用 inode（壓縮時 os.replace 釋放的 inode 會被檔案系統重複使用）；
+讀取世代與新增的部分都使用同一個已開啟的檔案，不會讀到兩個不同的檔案。
+"""
+
+import os
+import json
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows 沒有 fcntl，只在單一程序下使用
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# 至少有這麼多行、且垃圾佔比超過門檻時才壓縮
+COMPACT_MIN_RECORDS = 64
+COMPACT_GARBAGE_RATIO = 0.5
+
+
+class _JournalView:
+    """一個日誌檔在記憶體中的目前狀態"""
+
+    __slots__ = ("items", "offset", "generation", "records", "version", "lock")
+
+    def __init__(self):
+        self.items = OrderedDict()  # id -> item，依第一次新增的順序
+        self.offset = 0  # 已套用到檔案的哪個位置（位元組）
+        self.generation = None  # 目前讀取的檔案的世代，壓縮後會換成新檔案
+        self.records = 0  # 檔案中的操作行數（不含世代行）
+        self.version = 0  # 項目每次改變（套用新的操作或重新載入）時遞增
+        self.lock = threading.Lock()
+
+    @property
+    def garbage_ratio(self):
+        """被取代或刪除的操作佔所有行數的比例"""
+        if not self.records:
+            return 0.0
+        return (self.records - len(self.items)) / self.records
+
+    def reset(self):
+        self.items = OrderedDict()
+        self.offset = 0
+        self.generation = None
+        self.records = 0
+
+    def apply(self, line):
+        """套用一行操作"""
+        try:
+            record = json.loads(line)
+        except ValueError:
+            logger.error(f"略過無法解析的日誌行: {line[:100]!r}")
+            self.records += 1
+            return
+        if record.get("op") == "gen":
+            return
+        self.records += 1
+        if record.get("op") == "put":
+            item = record.get("item") or {}
+            self.items[item.get("id")] = item
+        elif record.get("op") == "del":
+            self.items.pop(record.get("id"), None)
+
+
+class JsonlJournalStore:
+    """以檔案路徑為鍵的 JSONL 日誌集合"""
+
+    def __init__(self, max_views=1000):
+        """
+        初始化日誌集合
+
+        參數:
+            max_views: 記憶體中最多保留的日誌數（依最近使用淘汰，淘汰後下次讀取時重新載入）
+        """
+        self.max_views = max_views
+        self._lock = threading.Lock()
+        self._views = OrderedDict()  # path -> _JournalView
+        self._compact_queue = set()
+        self._compactor_pid = None
+        self._wakeup = None
+        self._next_version = 0
+        self._counters = {"loads": 0, "tail_reads": 0, "appends": 0, "compactions": 0, "errors": 0}
+
+    def _get_view(self, path):
+        with self._lock:
+            view = self._views.get(path)
+            if view is None:
+                view = _JournalView()
+                self._views[path] = view
+                while len(self._views) > self.max_views:
+                    self._views.popitem(last=False)
+            else:
+                self._views.move_to_end(path)
+            return view
+
+    def _new_version(self):
+        """產生新的版本號（所有日誌共用，遞增）"""
+        with self._lock:
+            self._next_version += 1
+            return self._next_version
+
+    def _sync(self, view, f):
+        """
+        把檔案新增的部分套用到 view（呼叫端需持有 view.lock）
+
+        世代與新增的部分都從同一個已開啟的檔案 f 讀取；世代改變（壓縮過）或檔案變短時整個重新載入
+        """
+        f.seek(0)
+        generation = _parse_generation(f.readline())
+        size = os.fstat(f.fileno()).st_size
+        if view.offset and generation == view.generation and size >= view.offset:
+            if size == view.offset:
+                return
+            self._counters["tail_reads"] += 1
+        else:
+            view.reset()
+            view.generation = generation
+            view.version = self._new_version()
+            self._counters["loads"] += 1
+
+        f.seek(view.offset)
+        data = f.read()
+        # 只套用完整的行，寫到一半的最後一行留到下次
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            if line.strip():
+                view.apply(line.decode('utf-8'))
+        if end:
+            view.offset += end
+            view.version = self._new_version()
+
+    def _sync_path(self, path, view):
+        """開啟 path 並同步 view，檔案不存在時清空 view（呼叫端需持有 view.lock）"""
+        try:
+            with open(path, 'rb') as f:
+                self._sync(view, f)
+        except FileNotFoundError:
+            if view.offset or not view.version:
+                view.reset()
+                view.version = self._new_version()
+
+    def load(self, path):
+        """
+        讀取日誌目前的項目
+
+        參數:
+            path: 日誌檔路徑
+
+        返回:
+            list: 依新增順序排列的項目（新的列表，呼叫端可自由排序）
+        """
+        return self.load_with_version(path)[0]
+
+    def load_with_version(self, path):
+        """
+        讀取日誌目前的項目與版本（版本相同表示項目沒有改變，可用來判斷衍生的索引是否需要更新；
+        版本只會遞增，較大的版本代表較新的內容）
+
+        返回:
+            tuple: (項目列表, 版本)
+        """
+        view = self._get_view(path)
+        with view.lock:
+            try:
+                self._sync_path(path, view)
+            except Exception as e:
+                self._counters["errors"] += 1
+                logger.error(f"載入日誌失敗: {path}: {e}")
+            return list(view.items.values()), view.version
+
+    def append(self, path, item):
+        """新增或取代一個項目（item 需要有 "id"）"""
+        self._append(path, {"op": "put", "item": item})
+
+    def delete(self, path, item_id):
+        """
+        刪除項目
+
+        返回:
+            bool: 項目是否存在
+        """
+        view = self._get_view(path)
+        with view.lock:
+            self._sync_path(path, view)
+            if item_id not in view.items:
+                return False
+        self._append(path, {"op": "del", "id": item_id})
+        return True
+
+    def _append(self, path, record):
+        line = _encode(record)
+        view = self._get_view(path)
+        with view.lock:
+            with _open_locked(path) as f:
+                # 鎖定後先讀入其他 worker 附加的部分，讓 offset 與檔案一致
+                self._sync(view, f)
+                if view.offset == 0:
+                    # 新檔案：先寫入世代行
+                    generation = _new_generation()
+                    f.write(_encode({"op": "gen", "id": generation}))
+                    view.generation = generation
+                    view.offset = f.tell()
+                f.write(line)
+                f.flush()
+            view.apply(line.decode('utf-8'))
+            view.offset += len(line)
+            view.version = self._new_version()
+            self._counters["appends"] += 1
+            needs_compaction = (view.records >= COMPACT_MIN_RECORDS
+                                and view.garbage_ratio > COMPACT_GARBAGE_RATIO)
+        if needs_compaction:
+            with self._lock:
+                self._compact_queue.add(path)
+            self._ensure_compactor().set()
+
+    def compact(self, path):
+        """
+        把日誌重寫為只包含目前項目、世代換新的檔案
+
+        返回:
+            bool: 是否有壓縮
+        """
+        view = self._get_view(path)
+        with view.lock:
+            if not os.path.exists(path):
+                return False
+            with _open_locked(path) as f:
+                self._sync(view, f)
+                if view.records == len(view.items):
+                    return False
+                before = view.records
+                _write_journal(path, view.items.values())
+                # 舊檔案的鎖在離開 with 時釋放，等待中的 worker 會發現檔案已被取代而重新開啟
+                self._sync_path(path, view)
+            self._counters["compactions"] += 1
+            logger.info(f"日誌已壓縮: {path}, {before} -> {view.records} 行")
+            return True
+
+    def import_items(self, path, items):
+        """把既有的項目寫成新的日誌檔（用於從舊格式遷移，日誌已存在時不做任何事）"""
+        view = self._get_view(path)
+        with view.lock:
+            if os.path.exists(path):
+                return
+            _write_journal(path, items)
+            view.reset()
+
+    def compact_pending(self):
+        """壓縮所有等待中的日誌"""
+        with self._lock:
+            paths = list(self._compact_queue)
+            self._compact_queue.clear()
+        for path in paths:
+            try:
+                self.compact(path)
+            except Exception as e:
+                self._counters["errors"] += 1
+                logger.error(f"壓縮日誌失敗: {path}: {e}")
+
+    def _ensure_compactor(self):
+        """啟動背景壓縮執行緒（每個程序一條，fork 後的子程序會重新啟動），返回喚醒用的 Event"""
+        if self._compactor_pid == os.getpid():
+            return self._wakeup
+        with self._lock:
+            if self._compactor_pid == os.getpid():
+                return self._wakeup
+            wakeup = threading.Event()
+            self._wakeup = wakeup
+            self._compactor_pid = os.getpid()
+
+        def compact_loop():
+            while True:
+                wakeup.wait()
+                wakeup.clear()
+                self.compact_pending()
+
+        threading.Thread(target=compact_loop, name="journal-compactor", daemon=True).start()
+        return wakeup
+
+    def get_stats(self):
+        """
+        獲取日誌統計
+
+        返回:
+            dict: 記憶體中的日誌數、等待壓縮的日誌數與計數器
+        """
+        with self._lock:
+            return {
+                "views": len(self._views),
+                "pending_compactions": len(self._compact_queue),
+                "counters": dict(self._counters),
+            }
+
+
+def _encode(record):
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode('utf-8')
+
+
+def _new_generation():
+    return os.urandom(16).hex()
+
+
+def _parse_generation(line):
+    """解析第一行的世代，沒有世代行（舊版的日誌或空檔案）時返回 None"""
+    if not line.startswith(b'{"op":"gen"'):
+        return None
+    try:
+        return json.loads(line).get("id")
+    except ValueError:
+        return None
+
+
+def _write_journal(path, items):
+    """以新的世代把項目寫成日誌檔（先寫入暫存檔再取代原檔案）"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_encode({"op": "gen", "id": _new_generation()}))
+        for item in items:
+            f.write(_encode({"op": "put", "item": item}))
+    os.replace(tmp_path, path)
+
+
+class _open_locked:
+    """以讀寫附加模式開啟檔案並取得獨占的 flock；檔案在等待鎖時被壓縮取代的話，重新開啟新檔案"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        while True:
+            f = open(self.path, 'a+b')
+            if fcntl is None:
+                self.file = f
+                return f
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                # 兩個檔案此時都開著，(st_dev, st_ino) 不會被重複使用
+                opened = os.fstat(f.fileno())
+                current = os.stat(self.path)
+                if (opened.st_dev, opened.st_ino) == (current.st_dev, current.st_ino):
+                    self.file = f
+                    return f
+            except FileNotFoundError:
+                pass
+            f.close()
+
+    def __exit__(self, *exc):
+        # 關閉檔案會一併釋放 flock
+        self.file.close()
+        return False
+
+
+# 全域 JSONL 日誌實例
+jsonl_journal = JsonlJournalStore()
+atexit.register(jsonl_journal.compact_pending)
+
+
+if __name__ == "__main__":
+    # 多程序測試（python src/jsonl_journal.py）：
+    # 四個程序同時新增、刪除並頻繁壓縮同一個日誌，最後每個程序的 view 都要與重新載入的結果一致，
+    # 也不能讀到被截斷的日誌行
+    import sys
+    import tempfile
+    import multiprocessing
+
+    PROCESSES = 4
+    OPERATIONS = 300
+    COMPACT_MIN_RECORDS = 8  # 讓壓縮（以及 inode 被重複使用）頻繁發生
+
+    class _ErrorCounter(logging.Handler):
+        def __init__(self):
+            super().__init__(logging.ERROR)
+            self.count = 0
+
+        def emit(self, record):
+            self.count += 1
+
+    def worker(path, number, barrier, results):
+        errors = _ErrorCounter()
+        logger.addHandler(errors)
+        alive = []
+        for i in range(OPERATIONS):
+            item_id = f"{number}-{i}"
+            jsonl_journal.append(path, {"id": item_id, "v": i})
+            alive.append(item_id)
+            if i % 2:
+                jsonl_journal.delete(path, alive.pop(0))
+            if i % 25 == 0:
+                jsonl_journal.compact(path)
+            if i % 7 == 0:
+                jsonl_journal.load(path)
+        jsonl_journal.compact_pending()
+        barrier.wait()
+        own = jsonl_journal.load(path)
+        fresh = JsonlJournalStore().load(path)
+        results.put((number, alive, own == fresh, errors.count))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "journal.jsonl")
+        context = multiprocessing.get_context("fork")
+        barrier = context.Barrier(PROCESSES)
+        results = context.Queue()
+        processes = [context.Process(target=worker, args=(path, number, barrier, results))
+                     for number in range(PROCESSES)]
+        for process in processes:
+            process.start()
+        reports = [results.get(timeout=120) for _ in processes]
+        for process in processes:
+            process.join()
+
+        expected = sorted(item_id for _, alive, _, _ in reports for item_id in alive)
+        actual = sorted(item["id"] for item in JsonlJournalStore().load(path))
+        failures = []
+        if actual != expected:
+            failures.append(f"項目不一致：預期 {len(expected)} 筆，實際 {len(actual)} 筆")
+        for number, _, consistent, error_count in sorted(reports):
+            if not consistent:
+                failures.append(f"程序 {number} 的 view 與重新載入的結果不一致")
+            if error_count:
+                failures.append(f"程序 {number} 記錄了 {error_count} 個錯誤")
+        if failures:
+            print("\n".join(failures))
+            sys.exit(1)
+        print(f"{PROCESSES} 個程序、各 {OPERATIONS} 次操作：{len(actual)} 筆項目，所有 view 一致")
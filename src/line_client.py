@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+LINE Messaging API 客戶端模組
+提供整個程序共用、執行緒安全的 MessagingApi，避免每次呼叫都建立新的連線池與 TLS 連線
+"""
+
+import os
+import logging
+import threading
+from linebot.v3.messaging import Configuration, ApiClient, MessagingApi
+
+logger = logging.getLogger(__name__)
+
+# 連線池大小：需涵蓋 webhook 工作池的執行緒數，額外保留給請求執行緒與排程任務
+DEFAULT_POOL_MAXSIZE = 10
+
+
+class LineClient:
+    """
+    共用的 LINE Messaging API 客戶端
+
+    底層的 urllib3 PoolManager 是執行緒安全的，連線會以 keep-alive 重複使用；
+    fork 之後子程序會在第一次使用時重新建立自己的連線池
+    """
+
+    def __init__(self, access_token=None, pool_maxsize=None):
+        """
+        初始化客戶端（實際連線在第一次使用時才建立）
+
+        參數:
+            access_token: Channel access token，預設讀取環境變數 LINE_CHANNEL_ACCESS_TOKEN
+            pool_maxsize: 連線池大小，預設讀取環境變數 LINE_POOL_MAXSIZE
+        """
+        self._access_token = access_token
+        self._pool_maxsize = pool_maxsize
+        self._lock = threading.Lock()
+        self._api_client = None
+        self._messaging_api = None
+        self._pid = None
+
+    def configure(self, access_token=None, pool_maxsize=None):
+        """
+        更新設定，下一次使用時以新的設定重新建立連線
+
+        參數:
+            access_token: Channel access token
+            pool_maxsize: 連線池大小
+        """
+        with self._lock:
+            if access_token is not None:
+                self._access_token = access_token
+            if pool_maxsize is not None:
+                self._pool_maxsize = pool_maxsize
+            self._close_locked()
+
+    def _close_locked(self):
+        """關閉目前的連線池（需在持有鎖時呼叫）"""
+        if self._api_client is not None and self._pid == os.getpid():
+            try:
+                self._api_client.close()
+            except Exception as e:
+                logger.debug(f"關閉 LINE API 連線池時發生錯誤: {str(e)}")
+        self._api_client = None
+        self._messaging_api = None
+        self._pid = None
+
+    def reset_after_fork(self):
+        """在 fork 出的子程序中捨棄繼承的連線池（不關閉，避免影響父程序的連線）"""
+        self._lock = threading.Lock()
+        self._api_client = None
+        self._messaging_api = None
+        self._pid = None
+
+    def get_messaging_api(self):
+        """
+        獲取共用的 MessagingApi
+
+        返回:
+            MessagingApi
+
+        例外:
+            ValueError: 未設定 channel access token
+        """
+        if self._messaging_api is not None and self._pid == os.getpid():
+            return self._messaging_api
+
+        with self._lock:
+            if self._messaging_api is not None and self._pid == os.getpid():
+                return self._messaging_api
+
+            access_token = self._access_token or os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
+            if not access_token:
+                raise ValueError("未設定 LINE_CHANNEL_ACCESS_TOKEN")
+
+            configuration = Configuration(access_token=access_token)
+            configuration.connection_pool_maxsize = (
+                self._pool_maxsize or int(os.getenv('LINE_POOL_MAXSIZE', DEFAULT_POOL_MAXSIZE))
+            )
+            self._api_client = ApiClient(configuration)
+            self._messaging_api = MessagingApi(self._api_client)
+            self._pid = os.getpid()
+            logger.info(f"LINE API 連線池已建立 (大小 {configuration.connection_pool_maxsize}, pid {self._pid})")
+            return self._messaging_api
+
+
+# 全域 LINE 客戶端實例
+line_client = LineClient()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=line_client.reset_after_fork)
+
+
+def get_messaging_api():
+    """獲取整個程序共用的 MessagingApi"""
+    return line_client.get_messaging_api()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+LINE 訊息傳送模組
+將多段回答打包成最少的 API 呼叫：每次 reply/push 最多包含 5 則訊息，
+相同內容要送給多位使用者時改用 multicast（每次最多 500 位）。
+所有呼叫都經過權杖桶限速，取代原本各處固定的 time.sleep(0.5)
+"""
+
+import os
+import time
+import logging
+import threading
+
+from linebot.v3.messaging import (
+    ReplyMessageRequest, PushMessageRequest, MulticastRequest, TextMessage
+)
+
+logger = logging.getLogger(__name__)
+
+# 導入共用的 LINE API 客戶端
+try:
+    from src.line_client import get_messaging_api
+except ImportError:
+    from line_client import get_messaging_api
+
+# LINE Messaging API 的限制
+MAX_MESSAGES_PER_REQUEST = 5      # 每次 reply/push/multicast 最多 5 則訊息
+MAX_MULTICAST_RECIPIENTS = 500    # 每次 multicast 最多 500 位使用者
+MAX_TEXT_LENGTH = 5000            # 每則文字訊息最多 5000 字元
+
+# 預設每秒最多呼叫次數（遠低於 LINE 的上限，避免短時間大量推送被拒絕）
+DEFAULT_RATE_PER_SECOND = 20
+
+
+def split_text(text, max_length=MAX_TEXT_LENGTH):
+    """
+    將長文字分割成多段
+
+    參數:
+        text: 文字內容
+        max_length: 每段最多字元數
+
+    返回:
+        list: 文字段落列表
+    """
+    return [text[i:i + max_length] for i in range(0, len(text), max_length)] or [text]
+
+
+def text_messages(text, max_length=MAX_TEXT_LENGTH):
+    """
+    將文字轉為 TextMessage 列表（超過長度限制時自動分段）
+
+    參數:
+        text: 文字內容
+        max_length: 每則訊息最多字元數
+
+    返回:
+        list: TextMessage 列表
+    """
+    return [TextMessage(text=part) for part in split_text(text, max_length)]
+
+
+def chunk(items, size):
+    """將列表切成每組最多 size 個元素"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def plan_requests(recipients, messages):
+    """
+    將「多位對象 × 多則訊息」拆成最少的 API 請求
+
+    使用者 ID 以 multicast 合併（只有一位時用 push）；群組與聊天室 ID 逐一 push
+
+    參數:
+        recipients: 對象 ID 列表
+        messages: 訊息物件列表
+
+    返回:
+        list: (kind, target, 訊息批次) 的列表
+    """
+    recipients = list(dict.fromkeys(r for r in recipients if r))
+    users = [r for r in recipients if r.startswith("U")]
+    others = [r for r in recipients if not r.startswith("U")]
+    if len(users) == 1:
+        others = users + others
+        users = []
+
+    batches = chunk(messages, MAX_MESSAGES_PER_REQUEST)
+    requests = [("multicast", user_batch, batch)
+                for user_batch in chunk(users, MAX_MULTICAST_RECIPIENTS) for batch in batches]
+    requests += [("push", recipient, batch) for recipient in others for batch in batches]
+    return requests
+
+
+class TokenBucket:
+    """
+    權杖桶限速器（執行緒安全）
+
+    每秒補充 rate 個權杖，最多累積 capacity 個；權杖不足時呼叫端會等待
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        初始化限速器
+
+        參數:
+            rate: 每秒補充的權杖數
+            capacity: 權杖上限（允許的瞬間突發量），預設等於 rate
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.total_wait = 0.0
+
+    def acquire(self, tokens=1):
+        """
+        取得權杖，不足時等待
+
+        參數:
+            tokens: 需要的權杖數
+
+        返回:
+            float: 等待的秒數
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    self.total_wait += waited
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def penalize(self, seconds):
+        """
+        清空權杖並暫停發放一段時間（例如收到 429 時），讓所有呼叫端一起退避
+
+        參數:
+            seconds: 暫停秒數
+        """
+        with self._lock:
+            self._tokens = min(self._tokens, 0.0) - seconds * self.rate
+            self._updated = time.monotonic()
+
+
+class LineSender:
+    """打包並限速的 LINE 訊息傳送器"""
+
+    def __init__(self, rate_per_second=None):
+        """
+        初始化傳送器
+
+        參數:
+            rate_per_second: 每秒最多呼叫次數，預設讀取環境變數 LINE_API_RATE_PER_SECOND
+        """
+        rate = rate_per_second or float(os.getenv("LINE_API_RATE_PER_SECOND", DEFAULT_RATE_PER_SECOND))
+        self.bucket = TokenBucket(rate)
+        self._lock = threading.Lock()
+        self._counters = {"reply_calls": 0, "push_calls": 0, "multicast_calls": 0, "messages": 0}
+
+    def _count(self, kind, messages):
+        with self._lock:
+            self._counters[kind] += 1
+            self._counters["messages"] += len(messages)
+
+    def send_batch(self, kind, target, messages, retry_key=None):
+        """
+        送出單一次 push 或 multicast 呼叫（經過限速）
+
+        參數:
+            kind: "push" 或 "multicast"
+            target: push 為對象 ID，multicast 為使用者 ID 列表（最多 500 位）
+            messages: 訊息物件列表（最多 5 則）
+            retry_key: X-Line-Retry-Key（UUID），重試同一請求時使用相同的值可避免重複送達
+        """
+        self.bucket.acquire()
+        line_bot_api = get_messaging_api()
+        if kind == "multicast":
+            line_bot_api.multicast(MulticastRequest(to=target, messages=messages), x_line_retry_key=retry_key)
+        else:
+            line_bot_api.push_message(PushMessageRequest(to=target, messages=messages), x_line_retry_key=retry_key)
+        self._count(f"{kind}_calls", messages)
+
+    def reply(self, reply_token, messages, fallback_to=None):
+        """
+        以 reply token 回覆訊息
+
+        reply token 只能使用一次，因此前 5 則以 reply 送出；超過的部分
+        需要提供 fallback_to 才會以 push 補送
+
+        參數:
+            reply_token: reply token
+            messages: 訊息物件列表
+            fallback_to: 超過 5 則時補送的對象 ID
+
+        返回:
+            int: API 呼叫次數
+        """
+        first, rest = messages[:MAX_MESSAGES_PER_REQUEST], messages[MAX_MESSAGES_PER_REQUEST:]
+        self.bucket.acquire()
+        get_messaging_api().reply_message(ReplyMessageRequest(reply_token=reply_token, messages=first))
+        self._count("reply_calls", first)
+
+        if not rest:
+            return 1
+        if not fallback_to:
+            logger.warning(f"回覆訊息超過 {MAX_MESSAGES_PER_REQUEST} 則，捨棄其餘 {len(rest)} 則")
+            return 1
+        return 1 + self.push(fallback_to, rest)
+
+    def push(self, to, messages):
+        """
+        推送訊息給單一對象，每次呼叫最多包含 5 則
+
+        參數:
+            to: 使用者、群組或聊天室 ID
+            messages: 訊息物件列表
+
+        返回:
+            int: API 呼叫次數
+        """
+        batches = chunk(messages, MAX_MESSAGES_PER_REQUEST)
+        for batch in batches:
+            self.send_batch("push", to, batch)
+        return len(batches)
+
+    def multicast(self, recipients, messages):
+        """
+        將相同的訊息送給多位使用者
+
+        只有一位使用者時改用 push；multicast 不支援群組與聊天室 ID，
+        這類對象會逐一 push
+
+        參數:
+            recipients: 對象 ID 列表
+            messages: 訊息物件列表
+
+        返回:
+            int: API 呼叫次數
+        """
+        requests = plan_requests(recipients, messages)
+        for kind, target, batch in requests:
+            self.send_batch(kind, target, batch)
+        return len(requests)
+
+    def get_stats(self):
+        """
+        獲取傳送統計
+
+        返回:
+            dict: 各類呼叫次數、訊息數與限速等待的總秒數
+        """
+        with self._lock:
+            return {
+                "rate_per_second": self.bucket.rate,
+                "rate_limit_wait_seconds": round(self.bucket.total_wait, 3),
+                "counters": dict(self._counters),
+            }
+
+
+def parse_recipients(value):
+    """
+    解析以逗號分隔的對象 ID（例如 LINE_USER_ID 環境變數）
+
+    參數:
+        value: 字串
+
+    返回:
+        list: 對象 ID 列表
+    """
+    return [item.strip() for item in (value or "").split(",") if item.strip()]
+
+
+# 全域傳送器實例
+line_sender = LineSender()
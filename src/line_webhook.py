@@ -13,19 +13,10 @@ import sys
 import logging
 import time
 import traceback
-from datetime import datetime
 from dotenv import load_dotenv
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, jsonify
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    ReplyMessageRequest,
-    PushMessageRequest,
-    TextMessage
-)
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 
 # 設置系統路徑
@@ -33,20 +24,38 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
 
-# 設定日誌
+# 設定日誌（結構化、非同步輸出，同時寫入檔案）
+try:
+    from src.logging_setup import setup_logging
+except ImportError:
+    from logging_setup import setup_logging
+
 log_path = os.path.join(parent_dir, 'logs', 'line_webhook.log')
 # 確保 logs 資料夾存在
 os.makedirs(os.path.dirname(log_path), exist_ok=True)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_path),
-        logging.StreamHandler()
-    ]
-)
+setup_logging(log_file=log_path)
 logger = logging.getLogger(__name__)
 
+# 導入觸發詞比對
+try:
+    from src.trigger_matcher import match_trigger
+except ImportError:
+    from trigger_matcher import match_trigger
+
+# 導入共用的 LINE 訊息傳送器與推送佇列
+try:
+    from src.line_sender import line_sender, text_messages, split_text
+    from src.outbound_queue import outbound_queue, RESULT_SENT, RESULT_DEAD
+except ImportError:
+    from line_sender import line_sender, text_messages, split_text
+    from outbound_queue import outbound_queue, RESULT_SENT, RESULT_DEAD
+
+# 導入對話狀態儲存
+try:
+    from src.conversation_store import conversation_store
+except ImportError:
+    from conversation_store import conversation_store
+
 # 導入 Gemini 服務
 try:
     from src.gemini_service import get_gemini_response
@@ -65,16 +74,9 @@ load_dotenv()
 app = Flask(__name__)
 
 # 設置 LINE Bot API
-configuration = Configuration(access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
 handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
 
-# 對話歷史紀錄儲存
-# 使用使用者ID作為鍵，儲存該使用者的對話歷史
-conversation_histories = {}
-
-# 對話狀態追蹤
-# 使用使用者ID作為鍵，紀錄用戶是否正在進行連續對話及最後互動時間
-active_conversations = {}
+# 對話歷史與連續對話狀態存放在 conversation_store（有使用者數量上限與閒置逾時）
 
 # 連續對話超時時間（秒）
 CONVERSATION_TIMEOUT = 300  # 5分鐘無互動後結束對話
@@ -96,8 +98,7 @@ def webhook():
             
         # 獲取請求主體
         body = request.get_data(as_text=True)
-        logger.info("接收到 webhook 事件: %s", body)
-        logger.info("請求標頭: %s", dict(request.headers))
+        logger.debug("接收到 webhook 事件: %s", body)
 
         # 處理 webhook 請求主體
         try:
@@ -130,7 +131,7 @@ def handle_text_message(event):
     """處理文字訊息"""
     try:
         logger.info(f"=== 開始處理文字訊息 ===")
-        logger.info(f"收到訊息: {event}")
+        logger.debug("收到訊息: %s", event)
         
         user_id = event.source.user_id
         user_message = event.message.text
@@ -170,7 +171,7 @@ def handle_text_message(event):
             logger.info(f"提取的查詢: {query}")
             
             # 獲取或初始化對話歷史
-            conversation_history = conversation_histories.get(user_id, [])
+            conversation_history = conversation_store.get_history(user_id)
             
             try:
                 # 調用帶有緩存的 AI 回應函數
@@ -245,179 +246,21 @@ def is_image_generation_request(message):
     return False
 
 def is_ai_request(message):
-    """檢查是否為 AI 對話請求 (最終版: 僅檢測訊息開頭或帶允許前導字符的關鍵字)
-    
-    判斷邏輯：
-    1. 訊息以 'AI:', 'ai:', '@ai' 開頭
-    2. 訊息以 '小幫手', '花生' 關鍵字開頭或帶有允許的前導字符
-    3. 對於正在進行中的對話，第二句之後不需要關鍵字
-    """
-    if not message:
-        return False
-    
-    # 添加詳細日誌以診斷問題
-    logger.info(f"檢測訊息是否為AI請求: '{message}'")
-    
-    # 嘗試處理可能的特殊字符或編碼問題
-    normalized_message = message
-    try:
-        # 先嘗試規範化字符
-        import unicodedata
-        normalized_message = unicodedata.normalize('NFKC', message)
-        if normalized_message != message:
-            logger.info(f"已規範化訊息: '{normalized_message}'")
-    except Exception as e:
-        logger.error(f"規範化訊息時出錯: {str(e)}")
-    
-    # 去除前後空格，便於檢查句首關鍵字
-    trimmed_message = normalized_message.strip()
-    message_lower = trimmed_message.lower()
-    
-    # 1. 檢查常見的AI前綴 (必須在句首)
-    if (message_lower.startswith(('ai:', 'ai：')) or 
-        message_lower.startswith(('@ai', '@ai ')) or 
-        message_lower.startswith('ai ') or 
-        message_lower == 'ai'):
-        logger.info("識別為AI請求: 前綴匹配")
-        return True
-    
-    # 2. 檢查中文關鍵字是否在句首或帶有允許的前導字符
-    keywords = ['小幫手', '花生']
-    
-    # 允許的前導字符列表
-    allowed_prefixes = ['!', '！', ',', '，', '。', '.', '?', '？', ' ', '　', ':', '：', '@', '#', '$', '%', '、', '~', '～']
-    
-    for keyword in keywords:
-        # 檢查關鍵字是否在句首
-        if trimmed_message.startswith(keyword):
-            logger.info(f"識別為AI請求: 檢測到句首關鍵字 '{keyword}'")
-            return True
-        
-        # 檢查是否有允許的前導字符後接關鍵字
-        if len(trimmed_message) > 1:
-            # 處理只有一個前導字符的情況
-            first_char = trimmed_message[0]
-            if first_char in allowed_prefixes and trimmed_message[1:].startswith(keyword):
-                logger.info(f"識別為AI請求: 檢測到帶前導字符的關鍵字 '{keyword}', 前導字符: '{first_char}'")
-                return True
-            
-            # 處理有前導字符和空格的情況 (如 ". 小幫手")
-            if len(trimmed_message) > 2 and first_char in allowed_prefixes:
-                # 特殊處理點號+空格情況 
-                if first_char == '.' and trimmed_message[1] == ' ' and trimmed_message[2:].startswith(keyword):
-                    logger.info(f"識別為AI請求: 檢測到特殊點號和空格前導的關鍵字 '{keyword}'")
-                    return True
-                
-                # 正常處理其他前導字符+空格情況
-                if trimmed_message[1] == ' ' and trimmed_message[2:].startswith(keyword):
-                    logger.info(f"識別為AI請求: 檢測到帶前導字符和空格的關鍵字 '{keyword}', 前導字符: '{first_char} '")
-                    return True
-    
-    # 3. 進行字符級別的檢查 (花生)
-    flower_char = '花'
-    life_char = '生'
-    
-    # 直接在句首的「花生」
-    if trimmed_message.startswith(flower_char) and len(trimmed_message) > 1:
-        if trimmed_message[1] == life_char:
-            logger.info(f"識別為AI請求: 通過字符級別檢測到句首 '花生' 關鍵字")
-            return True
-    
-    # 允許的前導字符後的「花生」
-    if len(trimmed_message) > 2 and trimmed_message[0] in allowed_prefixes:
-        # 一個前導字符的情況
-        if trimmed_message[1] == flower_char and trimmed_message[2] == life_char:
-            logger.info(f"識別為AI請求: 通過字符級別檢測到帶前導字符的 '花生' 關鍵字")
-            return True
-            
-        # 前導字符+空格的情況 (如 ". 花生")
-        elif trimmed_message[1] == ' ' and len(trimmed_message) > 3:
-            if trimmed_message[2] == flower_char and trimmed_message[3] == life_char:
-                logger.info(f"識別為AI請求: 通過字符級別檢測到帶前導字符和空格的 '花生' 關鍵字")
-                return True
-    
-    # 所有檢查都未通過
-    logger.info("非AI請求: 未檢測到句首或帶允許前導字符的觸發關鍵字")
-    return False
+    """檢查是否為AI請求（訊息開頭為 AI 前綴，或帶允許前導字符的「小幫手」、「花生」）"""
+    trigger = match_trigger(message)
+    logger.debug(f"觸發詞比對結果: {trigger.kind or '非AI請求'}")
+    return trigger.is_trigger
 
 def extract_query(message):
-    """從訊息中提取實際查詢內容 (最終版: 適配句首關鍵字檢測)"""
-    message = message.strip()
-    
-    # 1. 處理明確的前綴
-    if message.lower().startswith('ai:'):
-        return message[3:].strip()
-    elif message.lower().startswith('ai：'):  # 中文冒號
-        return message[3:].strip()
-    elif message.lower().startswith('@ai'):
-        return message[3:].strip()
-    elif message.lower().startswith('ai '):
-        return message[3:].strip()
-    
-    # 2. 處理「小幫手」和「花生」關鍵字 (只考慮句首或帶允許的前導字符)
-    keywords = ['小幫手', '花生']
-    allowed_prefixes = ['!', '！', ',', '，', '。', '.', '?', '？', ' ', '　', ':', '：', '@', '#', '$', '%', '、', '~', '～']
-    
-    for keyword in keywords:
-        # 如果關鍵字在開頭，移除它
-        if message.startswith(keyword):
-            return message[len(keyword):].strip()
-        
-        # 處理有前導字符的情況
-        if len(message) > 1:
-            first_char = message[0]
-            # 單個前導字符
-            if first_char in allowed_prefixes and message[1:].startswith(keyword):
-                return message[1 + len(keyword):].strip()
-            
-            # 前導字符+空格的情況 (如 ". 小幫手")
-            if len(message) > 2 and first_char in allowed_prefixes and message[1] == ' ':
-                if message[2:].startswith(keyword):
-                    return message[2 + len(keyword):].strip()
-    
-    # 3. 處理「花生」字符級別檢測
-    flower_char = '花'
-    life_char = '生'
-    
-    # 直接在句首的「花生」
-    if message.startswith(flower_char) and len(message) > 1:
-        if message[1] == life_char:
-            return message[2:].strip()
-    
-    # 允許的前導字符後的「花生」
-    if len(message) > 2 and message[0] in allowed_prefixes:
-        # 一個前導字符的情況
-        if message[1] == flower_char and message[2] == life_char:
-            return message[3:].strip()
-        
-        # 前導字符+空格的情況
-        elif message[1] == ' ' and len(message) > 3:
-            if message[2] == flower_char and message[3] == life_char:
-                return message[4:].strip()
-    
-    # 如果沒有找到關鍵字或無法提取，則使用整個訊息
-    return message
+    """從訊息中提取實際查詢內容（去除觸發詞與開頭的分隔符號）"""
+    return match_trigger(message).query
 
 def update_conversation_history(user_id, query, response):
     """更新使用者的對話歷史記錄
     
-    保留最近的對話歷史，數量由 MAX_HISTORY 常數決定
+    保留最近的對話歷史，數量由 MAX_HISTORY 常數決定，並更新對話狀態 (設定最新活動時間)
     """
-    # MAX_HISTORY 已在全域定義
-    
-    if user_id not in conversation_histories:
-        conversation_histories[user_id] = []
-    
-    # 添加新的對話
-    conversation_histories[user_id].append({"role": "user", "parts": [query]})
-    conversation_histories[user_id].append({"role": "model", "parts": [response]})
-    
-    # 如果歷史紀錄太長，移除最舊的對話
-    if len(conversation_histories[user_id]) > MAX_HISTORY * 2:  # 一輪對話有兩條紀錄
-        conversation_histories[user_id] = conversation_histories[user_id][-MAX_HISTORY*2:]
-        
-    # 更新對話狀態 (設定最新活動時間)
-    start_conversation(user_id)
+    conversation_store.append_turn(user_id, query, response, MAX_HISTORY)
 
 def get_processing_message():
     """產生處理中狀態訊息"""
@@ -443,44 +286,16 @@ def push_message_to_user(user_id, message):
         return False
         
     try:
-        logger.info(f"開始推送訊息給用戶 {user_id}")
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            
-            # 如果消息太長，分段發送
-            if len(message) > 5000:
-                logger.info(f"訊息過長 ({len(message)} 字符)，進行分段")
-                messages = split_long_message(message)
-                
-                # 發送第一段
-                response = line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=messages[0])]
-                    )
-                )
-                logger.info(f"成功推送第一段訊息")
-                
-                # 發送剩餘段落
-                for i, msg in enumerate(messages[1:], 1):
-                    time.sleep(0.5)  # 避免發送太快
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text=msg)]
-                        )
-                    )
-                    logger.info(f"成功推送第 {i+1} 段訊息")
-            else:
-                logger.info(f"推送訊息，長度 {len(message)} 字符")
-                response = line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=message)]
-                    )
-                )
-                logger.info(f"成功推送訊息")
-                
+        logger.info(f"開始推送訊息給用戶 {user_id}，長度 {len(message)} 字符")
+        # 過長的訊息會分段，每次呼叫最多打包 5 段；暫時失敗的請求會留在佇列中重送
+        result = outbound_queue.push(user_id, text_messages(message))
+        if result == RESULT_SENT:
+            logger.info("成功推送訊息")
+        elif result == RESULT_DEAD:
+            logger.error("推送訊息失敗，已保存到 dead_letters")
+            return False
+        else:
+            logger.warning("推送訊息暫時失敗，已排程重試")
         return True
     except Exception as e:
         logger.error(f"推送訊息時發生錯誤: {str(e)}")
@@ -499,32 +314,9 @@ def reply_to_user(reply_token, message):
         
     try:
         logger.info(f"開始回覆訊息，reply_token: {reply_token[:10] if len(reply_token) > 10 else reply_token}...")
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            
-            # 如果消息太長，分段發送
-            if len(message) > 5000:
-                logger.info(f"訊息過長 ({len(message)} 字符)，進行分段")
-                messages = split_long_message(message)
-                logger.info(f"分為 {len(messages)} 段，發送第一段")
-                
-                response = line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[TextMessage(text=messages[0])]
-                    )
-                )
-                logger.info(f"成功發送第一段回覆")
-            else:
-                logger.info(f"發送訊息，長度 {len(message)} 字符")
-                response = line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[TextMessage(text=message)]
-                    )
-                )
-                logger.info(f"成功發送回覆")
-                
+        # 過長的訊息會分段，一次 reply 最多帶 5 段
+        line_sender.reply(reply_token, text_messages(message))
+        logger.info(f"成功發送回覆，長度 {len(message)} 字符")
         return True
     except Exception as e:
         logger.error(f"回覆訊息時發生錯誤: {str(e)}")
@@ -533,7 +325,7 @@ def reply_to_user(reply_token, message):
 
 def split_long_message(message, max_length=5000):
     """將長訊息分割成多個部分"""
-    return [message[i:i+max_length] for i in range(0, len(message), max_length)]
+    return split_text(message, max_length)
 
 def get_help_message():
     """產生使用說明訊息"""
@@ -554,35 +346,26 @@ def get_help_message():
 
 def clear_user_history(user_id):
     """清除特定用戶的對話歷史"""
-    if user_id in conversation_histories:
-        del conversation_histories[user_id]
-        return True
-    return False
+    return conversation_store.clear_history(user_id)
 
 def check_active_conversation(user_id, current_time):
     """檢查用戶是否處於活躍對話狀態"""
-    if user_id in active_conversations:
-        last_activity_time = active_conversations[user_id]
-        # 檢查是否超時
-        if current_time - last_activity_time <= CONVERSATION_TIMEOUT:
-            logger.info(f"用戶 {user_id} 處於活躍對話狀態，剩餘時間: {CONVERSATION_TIMEOUT - (current_time - last_activity_time):.1f} 秒")
-            return True
-        else:
-            # 超時自動結束對話
-            logger.info(f"用戶 {user_id} 對話已超時，自動結束")
-            end_conversation(user_id)
-            return False
-    return False
+    active, idle = conversation_store.is_active(user_id, CONVERSATION_TIMEOUT, current_time)
+    if active:
+        logger.info(f"用戶 {user_id} 處於活躍對話狀態，剩餘時間: {CONVERSATION_TIMEOUT - idle:.1f} 秒")
+    elif idle is not None:
+        # 超時自動結束對話
+        logger.info(f"用戶 {user_id} 對話已超時，自動結束")
+    return active
 
 def start_conversation(user_id):
     """將用戶標記為活躍對話狀態"""
-    active_conversations[user_id] = time.time()
+    conversation_store.start_conversation(user_id)
     logger.info(f"用戶 {user_id} 開始/繼續對話")
 
 def end_conversation(user_id):
     """結束用戶的對話狀態"""
-    if user_id in active_conversations:
-        del active_conversations[user_id]
+    if conversation_store.end_conversation(user_id):
         logger.info(f"用戶 {user_id} 結束對話")
     # 可選：根據需求決定是否要清除對話歷史
     # clear_user_history(user_id)
@@ -6,13 +6,24 @@
 """
 
 import os
-import json
 import logging
 import re
 from typing import Dict, Optional, List
 
 logger = logging.getLogger(__name__)
 
+# 導入 JSON 文件寫回快取
+try:
+    from src.json_store import json_store
+except ImportError:
+    from json_store import json_store
+
+# 導入 n-gram 倒排索引
+try:
+    from src.ngram_index import NgramIndexCache
+except ImportError:
+    from ngram_index import NgramIndexCache
+
 # 導入 Gemini API
 try:
     import google.generativeai as genai
@@ -21,6 +32,16 @@ except ImportError:
     GEMINI_AVAILABLE = False
     logger.warning("Gemini API 未安裝，連結分析功能將受限")
 
+# 導入流量限制器（連結分析屬於背景工作，配額緊張時最先被淘汰）
+try:
+    from src.rate_limiter import gemini_limiter, LANE_BACKGROUND
+except ImportError:
+    try:
+        from rate_limiter import gemini_limiter, LANE_BACKGROUND
+    except ImportError:
+        gemini_limiter = None
+        LANE_BACKGROUND = "background"
+
 
 class LinkAnalyzer:
     """連結分析器"""
@@ -94,6 +115,13 @@ class LinkAnalyzer:
                 "url": url
             }
         
+        if gemini_limiter and not gemini_limiter.wait_if_needed(lane=LANE_BACKGROUND):
+            return {
+                "success": False,
+                "error": "API 配額不足，連結分析暫停",
+                "url": url
+            }
+        
         try:
             # 構建提示詞
             if user_query:
@@ -167,6 +195,13 @@ class LinkAnalyzer:
                 "urls": urls
             }
         
+        if gemini_limiter and not gemini_limiter.wait_if_needed(lane=LANE_BACKGROUND):
+            return {
+                "success": False,
+                "error": "API 配額不足，連結分析暫停",
+                "urls": urls
+            }
+        
         # 限制處理的連結數量
         urls = urls[:5]  # 最多處理 5 個連結
         
@@ -277,6 +312,8 @@ class LinkStorage:
             storage_dir: 連結儲存目錄
         """
         self.storage_dir = storage_dir
+        # 每位用戶一個關鍵字索引，連結有變動時增量更新
+        self._search_index = NgramIndexCache()
         os.makedirs(storage_dir, exist_ok=True)
         logger.info(f"連結儲存管理器已初始化，儲存目錄: {storage_dir}")
     
@@ -286,29 +323,23 @@ class LinkStorage:
     
     def _load_links(self, user_id: str) -> List[Dict]:
         """載入用戶的連結"""
-        file_path = self._get_user_file(user_id)
-        
-        if not os.path.exists(file_path):
-            return []
-        
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"載入連結失敗: {e}")
-            return []
+        return json_store.load(self._get_user_file(user_id), default=list)
     
     def _save_links(self, user_id: str, links: List[Dict]) -> bool:
         """儲存用戶的連結"""
-        file_path = self._get_user_file(user_id)
-        
-        try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(links, f, ensure_ascii=False, indent=2)
-            return True
-        except Exception as e:
-            logger.error(f"儲存連結失敗: {e}")
-            return False
+        # 只更新寫回快取，由 json_store 的背景執行緒批次寫入檔案
+        json_store.save(self._get_user_file(user_id), links)
+        return True
+    
+    @staticmethod
+    def _search_text(link: Dict) -> str:
+        """關鍵字查詢比對的文字：標題、摘要、網址與標籤（以換行分隔，關鍵字不會跨欄位比對）"""
+        return "\n".join([
+            link.get("title") or "",
+            link.get("summary") or "",
+            link.get("url") or "",
+            " ".join(link.get("tags", []))
+        ])
     
     def save_link(self, user_id: str, url: str, title: Optional[str] = None,
                  summary: Optional[str] = None, tags: Optional[List[str]] = None) -> Dict:
@@ -358,18 +389,15 @@ class LinkStorage:
         Returns:
             Dict: 查詢結果
         """
-        links = self._load_links(user_id)
+        links, version = json_store.load_with_version(self._get_user_file(user_id), default=list)
         
         # 過濾條件
         if keyword:
-            keyword_lower = keyword.lower()
-            links = [
-                link for link in links
-                if keyword_lower in link.get("title", "").lower() or
-                   keyword_lower in link.get("summary", "").lower() or
-                   keyword_lower in link.get("url", "").lower() or
-                   keyword_lower in " ".join(link.get("tags", [])).lower()
-            ]
+            index = self._search_index.get(user_id, version, lambda: (
+                (link.get("id", position), self._search_text(link), link)
+                for position, link in enumerate(links)
+            ))
+            links = [index.get(link_id) for link_id in index.find(keyword)]
         
         # 按時間排序（最新的在前）
         links.sort(key=lambda x: x.get("saved_at", ""), reverse=True)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+日誌設定模組
+取代各入口各自的 logging.basicConfig，提供：
+
+- 非同步輸出：請求執行緒只把紀錄放進佇列 (QueueHandler)，
+  格式化與寫入終端機/檔案都在背景的 QueueListener 執行緒完成
+- 結構化 JSON 格式（LOG_FORMAT=text 時維持原本的文字格式）
+- DEBUG 等高流量紀錄依比例取樣 (LOG_SAMPLE_RATE)
+- 遮蔽 reply token、access token 與使用者訊息內容，並截斷過長的訊息 (LOG_MAX_MESSAGE_CHARS)
+"""
+
+import os
+import re
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# LogRecord 的標準屬性，其餘屬性（logger.info(..., extra={...})）會輸出為 JSON 欄位
+_RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+# 需要遮蔽的內容：(正規表示式, 取代內容)
+REDACTION_PATTERNS = [
+    # webhook 請求體與事件中的使用者訊息內容
+    (re.compile(r'("text"\s*:\s*")((?:[^"\\]|\\.)*)(")'), lambda m: f'{m.group(1)}<{len(m.group(2))} chars>{m.group(3)}'),
+    (re.compile(r"(\btext=')((?:[^'\\]|\\.)*)(')"), lambda m: f"{m.group(1)}<{len(m.group(2))} chars>{m.group(3)}"),
+    # reply token
+    (re.compile(r'("replyToken"\s*:\s*"|\breply_token=\')([^"\']{8})[^"\']*'), r'\1\2…'),
+    # Bearer token / channel access token
+    (re.compile(r'(Bearer\s+)[A-Za-z0-9+/=._-]+'), r'\1<redacted>'),
+]
+
+
+def redact(message, max_chars=None):
+    """
+    遮蔽敏感內容並截斷過長的訊息
+
+    參數:
+        message: 日誌訊息
+        max_chars: 最多保留的字元數（None 或 0 表示不截斷）
+
+    返回:
+        str: 處理後的訊息
+    """
+    for pattern, replacement in REDACTION_PATTERNS:
+        message = pattern.sub(replacement, message)
+    if max_chars and len(message) > max_chars:
+        message = f"{message[:max_chars]}…（已截斷，共 {len(message)} 字元）"
+    return message
+
+
+class JsonFormatter(logging.Formatter):
+    """將日誌紀錄輸出為單行 JSON"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """依比例取樣低於指定等級的紀錄（INFO 以上的紀錄一律保留）"""
+
+    def __init__(self, rate=1.0, max_level=logging.DEBUG):
+        """
+        參數:
+            rate: 保留比例（0~1）
+            max_level: 取樣套用的最高等級
+        """
+        super().__init__()
+        self.rate = rate
+        self.max_level = max_level
+
+    def filter(self, record):
+        return record.levelno > self.max_level or self.rate >= 1 or random.random() < self.rate
+
+
+class RedactingQueueHandler(logging.handlers.QueueHandler):
+    """
+    放入佇列前先合併參數、遮蔽敏感內容與截斷訊息
+
+    只做字串處理，JSON 格式化與 I/O 都留給背景的 QueueListener
+    """
+
+    def __init__(self, log_queue, max_chars=None):
+        super().__init__(log_queue)
+        self.max_chars = max_chars
+
+    def prepare(self, record):
+        message = redact(record.getMessage(), self.max_chars)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record = logging.makeLogRecord(vars(record))
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class _LoggingPipeline:
+    """目前程序的日誌佇列與背景輸出執行緒"""
+
+    def __init__(self):
+        self.queue_handler = None
+        self.listener = None
+        self.handlers = []
+
+    def start(self):
+        """建立新的佇列與背景執行緒（fork 後的子程序也會呼叫）"""
+        log_queue = queue.SimpleQueue()
+        if self.queue_handler is not None:
+            self.queue_handler.queue = log_queue
+        self.listener = logging.handlers.QueueListener(log_queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+        return log_queue
+
+    def stop(self):
+        """停止背景執行緒（會先輸出佇列中剩餘的紀錄）"""
+        if self.listener is not None:
+            try:
+                self.listener.stop()
+            except Exception:
+                pass
+            self.listener = None
+
+    def restart_after_fork(self):
+        """子程序沒有繼承背景執行緒，需要重新啟動"""
+        if self.queue_handler is not None:
+            self.listener = None
+            self.start()
+
+
+_pipeline = _LoggingPipeline()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_pipeline.restart_after_fork)
+atexit.register(_pipeline.stop)
+
+
+def setup_logging(level=None, log_file=None, log_format=None, sample_rate=None, max_chars=None):
+    """
+    設定根日誌記錄器（可重複呼叫，後一次的設定會取代前一次）
+
+    參數:
+        level: 日誌等級，預設讀取 LOG_LEVEL（INFO）
+        log_file: 額外寫入的日誌檔路徑
+        log_format: "json" 或 "text"，預設讀取 LOG_FORMAT（json）
+        sample_rate: DEBUG 紀錄的保留比例，預設讀取 LOG_SAMPLE_RATE（0.1）
+        max_chars: 單筆訊息最多字元數，預設讀取 LOG_MAX_MESSAGE_CHARS（1000，0 表示不截斷）
+
+    返回:
+        logging.Logger: 根日誌記錄器
+    """
+    level = level or os.getenv("LOG_LEVEL", "INFO").upper()
+    log_format = (log_format or os.getenv("LOG_FORMAT", "json")).lower()
+    sample_rate = float(os.getenv("LOG_SAMPLE_RATE", "0.1")) if sample_rate is None else sample_rate
+    max_chars = int(os.getenv("LOG_MAX_MESSAGE_CHARS", "1000")) if max_chars is None else max_chars
+
+    formatter = JsonFormatter() if log_format == "json" else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+        handlers.append(logging.FileHandler(log_file, encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    _pipeline.stop()
+    for handler in _pipeline.handlers:
+        handler.close()
+    _pipeline.handlers = handlers
+    log_queue = _pipeline.start()
+    queue_handler = RedactingQueueHandler(log_queue, max_chars)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+    _pipeline.queue_handler = queue_handler
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    return root
@@ -16,30 +16,24 @@ import sys
 import requests
 from dotenv import load_dotenv
 from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
     TextMessage,
-    ImageMessage,
-    PushMessageRequest
+    ImageMessage
 )
 import schedule
 
 # 設置 Python Path 以便能夠導入其他模組
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
-# 設定日誌
+# 設定日誌（結構化、非同步輸出，同時寫入檔案）
+try:
+    from src.logging_setup import setup_logging
+except ImportError:
+    from logging_setup import setup_logging
+
 log_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'logs', 'morning_post.log')
 # 確保 logs 資料夾存在
 os.makedirs(os.path.dirname(log_path), exist_ok=True)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_path),
-        logging.StreamHandler()
-    ]
-)
+setup_logging(log_file=log_path)
 logger = logging.getLogger(__name__)
 
 # 從其他模組導入功能
@@ -89,6 +83,27 @@ except ImportError:
         from weather_service import WeatherService
         logger.info("使用原始版天氣服務")
 
+# 導入共用的 LINE API 客戶端與訊息傳送器
+try:
+    from src.line_client import get_messaging_api
+    from src.line_sender import parse_recipients
+    from src.outbound_queue import outbound_queue, RESULT_DEAD, RESULT_QUEUED
+except ImportError:
+    from line_client import get_messaging_api
+    from line_sender import parse_recipients
+    from outbound_queue import outbound_queue, RESULT_DEAD, RESULT_QUEUED
+
+# 導入流量限制器（早安問候使用最高優先級的 broadcast 通道，不會被對話流量擠掉）
+try:
+    from src.rate_limiter import gemini_limiter, LANE_BROADCAST
+except ImportError:
+    try:
+        from rate_limiter import gemini_limiter, LANE_BROADCAST
+    except ImportError:
+        gemini_limiter = None
+        LANE_BROADCAST = "broadcast"
+        logger.warning("無法導入流量限制器，早安問候將不使用流量控制")
+
 # 載入環境變數
 load_dotenv()
 
@@ -257,6 +272,11 @@ def generate_ai_greeting(weather_info=None):
         greeting = None
         for attempt in range(max_retries):
             try:
+                # 透過 broadcast 通道取得配額
+                if gemini_limiter and not gemini_limiter.wait_if_needed(lane=LANE_BROADCAST):
+                    logger.warning("Gemini 每日配額已用盡，將使用預設問候語")
+                    return None
+                
                 # 初始化生成式模型
                 model = genai.GenerativeModel(model_name)
                 
@@ -282,6 +302,8 @@ def generate_ai_greeting(weather_info=None):
                     )
                 
                 if response and hasattr(response, 'text'):
+                    if gemini_limiter:
+                        gemini_limiter.record_success()
                     greeting = response.text.strip()
                     
                     # 確保開頭有「早安」
@@ -317,6 +339,8 @@ def generate_ai_greeting(weather_info=None):
                 
                 # 配額限制錯誤，實施指數退避
                 if "429" in error_str:
+                    if gemini_limiter:
+                        gemini_limiter.record_quota_error(error_str)
                     retry_delay = base_delay * (2 ** attempt)
                     logger.warning(f"API 配額限制，等待 {retry_delay} 秒後重試")
                     time.sleep(retry_delay)
@@ -551,7 +575,7 @@ def send_morning_message():
     8. 清理超過 7 天的舊圖片檔案
     環境變數需求：
         LINE_CHANNEL_ACCESS_TOKEN: LINE Bot 頻道存取權杖
-        LINE_USER_ID: 目標使用者 ID
+        LINE_USER_ID: 目標使用者 ID（多位使用者以逗號分隔，會以 multicast 一次送出）
         CWB_API_KEY: 中央氣象局 API 金鑰（可選）
         GEMINI_API_KEY: Google Gemini API 金鑰（可選）
     錯誤處理：
@@ -653,16 +677,12 @@ def send_morning_message():
         else:
             logger.info("Gemini API 未啟用或未初始化，將使用預設問候語")
         
-        # 設定 LINE Bot API
-        configuration = Configuration(access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
-        if not configuration.access_token:
-            raise ValueError("未設定 LINE_CHANNEL_ACCESS_TOKEN")
-
-        api_client = ApiClient(configuration)
-        line_bot_api = MessagingApi(api_client)
+        # 確認 LINE Bot API 可用（使用共用的連線池，未設定 token 時會拋出 ValueError）
+        get_messaging_api()
         
         LINE_USER_ID = os.getenv('LINE_USER_ID')
-        if not LINE_USER_ID:
+        recipients = parse_recipients(LINE_USER_ID)
+        if not recipients:
             raise ValueError("未設定 LINE_USER_ID")
             
         # 準備訊息
@@ -912,28 +932,23 @@ def send_morning_message():
                                     logger.warning(f"無法識別的圖片訊息格式: {msg}")
                     
                         # 發送訊息
-                        logger.info(f"發送訊息到用戶: {LINE_USER_ID}")
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=LINE_USER_ID,
-                                messages=valid_messages
-                            )
-                        )
-                        logger.info(f"成功發送 {len(valid_messages)} 則訊息到 LINE")
-                        logger.info(f"成功發送早安貼文，時間: {datetime.now()}")
+                        logger.info(f"發送訊息到 {len(recipients)} 位用戶")
+                        result = outbound_queue.multicast(recipients, valid_messages)
+                        if result == RESULT_DEAD:
+                            raise ValueError("LINE 拒絕了早安貼文，已保存到 dead_letters")
+                        if result == RESULT_QUEUED:
+                            logger.warning("早安貼文暫時無法送出，已排程重試")
+                        else:
+                            logger.info(f"成功發送 {len(valid_messages)} 則訊息到 LINE")
+                            logger.info(f"成功發送早安貼文，時間: {datetime.now()}")
                     except Exception as format_error:
                         logger.error(f"訊息格式錯誤: {str(format_error)}")
                         # 嘗試只發送文字訊息
                         text_only = [msg for msg in valid_messages if isinstance(msg, TextMessage)]
                         if text_only:
                             logger.info("嘗試只發送文字訊息...")
-                            line_bot_api.push_message(
-                                PushMessageRequest(
-                                    to=LINE_USER_ID,
-                                    messages=text_only
-                                )
-                            )
-                            logger.info(f"成功發送 {len(text_only)} 則文字訊息到 LINE")
+                            if outbound_queue.multicast(recipients, text_only) != RESULT_DEAD:
+                                logger.info(f"已發送 {len(text_only)} 則文字訊息到 LINE")
                 else:
                     logger.error("沒有有效的訊息可發送")
             else:
@@ -944,13 +959,8 @@ def send_morning_message():
             # 嘗試使用備用方法發送文字訊息
             try:
                 fallback_message = TextMessage(text=f"早安！{current_time}\n\n今天的圖片無法顯示，但仍祝您有美好的一天！")
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=LINE_USER_ID,
-                        messages=[fallback_message]
-                    )
-                )
-                logger.info("成功發送備用文字訊息")
+                if outbound_queue.multicast(recipients, [fallback_message]) != RESULT_DEAD:
+                    logger.info("已發送備用文字訊息")
             except Exception as fallback_error:
                 logger.error(f"發送備用訊息也失敗了: {str(fallback_error)}")
             # 不要在這裡拋出異常，讓程式能夠繼續執行
@@ -995,6 +1005,9 @@ def main():
     
     logger.info("排程已啟動：平日 07:00、週末 08:00")
     
+    # 重送先前推送失敗的訊息
+    outbound_queue.start_worker()
+    
     while True:
         pending_jobs = schedule.get_jobs()
         next_run = min([job.next_run for job in pending_jobs]) if pending_jobs else None
@@ -1051,6 +1064,19 @@ if __name__ == "__main__":
                 
                 deleted = clean_old_images(max_age_days=max_age_days)
                 logger.info(f"圖片清理完成: 已刪除 {deleted} 張超過 {max_age_days} 天的舊圖片")
+            elif sys.argv[1] == "--dead-letters":
+                logger.info("==== 無法送達的推送 (dead letters) ====")
+                for item in outbound_queue.list_dead_letters():
+                    failed_at = datetime.fromtimestamp(item["failed_at"]).strftime('%Y-%m-%d %H:%M:%S')
+                    print(f"#{item['id']} {failed_at} {item['kind']} -> {item['target']} "
+                          f"(嘗試 {item['attempts']} 次): {item['last_error']}")
+            elif sys.argv[1] == "--replay-dead-letters":
+                logger.info("==== 重送無法送達的推送 ====")
+                # 可指定 dead letter id，未指定時重送全部
+                ids = [int(arg) for arg in sys.argv[2:]] or None
+                replayed = outbound_queue.replay_dead_letters(ids)
+                results = outbound_queue.process_due()
+                logger.info(f"已重新排入 {replayed} 筆，立即重送結果: {results}")
         else:
             logger.info("==== 開始發送早安訊息 ====")
             # 立即發送一次訊息
@@ -8,9 +8,23 @@ Mem0 記憶管理模組
 import os
 import logging
 import json
+import asyncio
+import aiohttp
 from typing import List, Dict, Optional
 from datetime import datetime
 
+# 導入 JSON 文件寫回快取
+try:
+    from src.json_store import json_store
+except ImportError:
+    from json_store import json_store
+
+# 導入 n-gram 倒排索引
+try:
+    from src.ngram_index import NgramIndexCache
+except ImportError:
+    from ngram_index import NgramIndexCache
+
 logger = logging.getLogger(__name__)
 
 # Mem0 API 設定
@@ -32,11 +46,54 @@ class Mem0Manager:
         self.api_url = MEM0_API_URL
         self.enabled = bool(self.api_key)
         
+        # 共用的 aiohttp 連線池（綁定在建立它的事件迴圈上）
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_loop = None
+        
         if not self.enabled:
             logger.warning("Mem0 API 金鑰未設定，記憶功能將被禁用")
         else:
             logger.info("Mem0 記憶管理器已初始化")
     
+    def _get_session(self) -> aiohttp.ClientSession:
+        """
+        取得目前事件迴圈的共用 session，迴圈改變（例如在測試中使用 asyncio.run）時重新建立
+        
+        Returns:
+            aiohttp.ClientSession
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            self._session = aiohttp.ClientSession(
+                headers={"Authorization": f"Token {self.api_key}"},
+                timeout=aiohttp.ClientTimeout(total=10)
+            )
+            self._session_loop = loop
+        return self._session
+    
+    async def _request(self, method: str, path: str, **kwargs):
+        """
+        發送 Mem0 API 請求
+        
+        Args:
+            method: HTTP 方法
+            path: API 路徑（相對於 api_url）
+            **kwargs: 傳給 aiohttp 的參數（json, params 等）
+            
+        Returns:
+            tuple: (HTTP 狀態碼, 回應文字)
+        """
+        session = self._get_session()
+        async with session.request(method, f"{self.api_url}{path}", **kwargs) as response:
+            return response.status, await response.text()
+    
+    async def close(self):
+        """關閉共用的 aiohttp session"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._session_loop = None
+    
     async def add_memory(self, user_id: str, content: str, metadata: Optional[Dict] = None) -> Dict:
         """
         新增記憶
@@ -54,13 +111,6 @@ class Mem0Manager:
             return {"success": False, "error": "Mem0 API 未啟用"}
         
         try:
-            import requests
-            
-            headers = {
-                "Authorization": f"Token {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
             payload = {
                 "messages": [{"role": "user", "content": content}],
                 "user_id": user_id,
@@ -70,20 +120,15 @@ class Mem0Manager:
             if metadata:
                 payload["metadata"] = metadata
             
-            response = requests.post(
-                f"{self.api_url}/memories/",
-                headers=headers,
-                json=payload,
-                timeout=10
-            )
+            status, text = await self._request("POST", "/memories/", json=payload)
             
-            if response.status_code == 200 or response.status_code == 201:
-                result = response.json()
+            if status == 200 or status == 201:
+                result = json.loads(text)
                 logger.info(f"成功新增記憶: user_id={user_id}")
                 return {"success": True, "data": result}
             else:
-                logger.error(f"新增記憶失敗: status={response.status_code}, response={response.text}")
-                return {"success": False, "error": f"HTTP {response.status_code}"}
+                logger.error(f"新增記憶失敗: status={status}, response={text}")
+                return {"success": False, "error": f"HTTP {status}"}
         
         except Exception as e:
             logger.error(f"新增記憶時發生錯誤: {e}")
@@ -106,34 +151,22 @@ class Mem0Manager:
             return {"success": False, "error": "Mem0 API 未啟用", "memories": []}
         
         try:
-            import requests
-            
-            headers = {
-                "Authorization": f"Token {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
             payload = {
                 "query": query,
                 "user_id": user_id,
                 "limit": limit
             }
             
-            response = requests.post(
-                f"{self.api_url}/memories/search/",
-                headers=headers,
-                json=payload,
-                timeout=10
-            )
+            status, text = await self._request("POST", "/memories/search/", json=payload)
             
-            if response.status_code == 200:
-                result = response.json()
+            if status == 200:
+                result = json.loads(text)
                 memories = result.get("results", [])
                 logger.info(f"搜尋記憶成功: user_id={user_id}, found={len(memories)}")
                 return {"success": True, "memories": memories}
             else:
-                logger.error(f"搜尋記憶失敗: status={response.status_code}, response={response.text}")
-                return {"success": False, "error": f"HTTP {response.status_code}", "memories": []}
+                logger.error(f"搜尋記憶失敗: status={status}, response={text}")
+                return {"success": False, "error": f"HTTP {status}", "memories": []}
         
         except Exception as e:
             logger.error(f"搜尋記憶時發生錯誤: {e}")
@@ -154,27 +187,16 @@ class Mem0Manager:
             return {"success": False, "error": "Mem0 API 未啟用", "memories": []}
         
         try:
-            import requests
+            status, text = await self._request("GET", "/memories/", params={"user_id": user_id})
             
-            headers = {
-                "Authorization": f"Token {self.api_key}"
-            }
-            
-            response = requests.get(
-                f"{self.api_url}/memories/",
-                headers=headers,
-                params={"user_id": user_id},
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
+            if status == 200:
+                result = json.loads(text)
                 memories = result.get("results", [])
                 logger.info(f"獲取所有記憶成功: user_id={user_id}, count={len(memories)}")
                 return {"success": True, "memories": memories}
             else:
-                logger.error(f"獲取記憶失敗: status={response.status_code}, response={response.text}")
-                return {"success": False, "error": f"HTTP {response.status_code}", "memories": []}
+                logger.error(f"獲取記憶失敗: status={status}, response={text}")
+                return {"success": False, "error": f"HTTP {status}", "memories": []}
         
         except Exception as e:
             logger.error(f"獲取記憶時發生錯誤: {e}")
@@ -195,24 +217,14 @@ class Mem0Manager:
             return {"success": False, "error": "Mem0 API 未啟用"}
         
         try:
-            import requests
-            
-            headers = {
-                "Authorization": f"Token {self.api_key}"
-            }
-            
-            response = requests.delete(
-                f"{self.api_url}/memories/{memory_id}/",
-                headers=headers,
-                timeout=10
-            )
+            status, text = await self._request("DELETE", f"/memories/{memory_id}/")
             
-            if response.status_code == 200 or response.status_code == 204:
+            if status == 200 or status == 204:
                 logger.info(f"成功刪除記憶: memory_id={memory_id}")
                 return {"success": True}
             else:
-                logger.error(f"刪除記憶失敗: status={response.status_code}, response={response.text}")
-                return {"success": False, "error": f"HTTP {response.status_code}"}
+                logger.error(f"刪除記憶失敗: status={status}, response={text}")
+                return {"success": False, "error": f"HTTP {status}"}
         
         except Exception as e:
             logger.error(f"刪除記憶時發生錯誤: {e}")
@@ -257,6 +269,8 @@ class LocalMemoryManager:
             storage_dir: 記憶儲存目錄
         """
         self.storage_dir = storage_dir
+        # 每位用戶一個關鍵字索引，記憶有變動時增量更新
+        self._search_index = NgramIndexCache()
         os.makedirs(storage_dir, exist_ok=True)
         logger.info(f"本地記憶管理器已初始化，儲存目錄: {storage_dir}")
     
@@ -266,29 +280,13 @@ class LocalMemoryManager:
     
     def _load_memories(self, user_id: str) -> List[Dict]:
         """載入用戶的記憶"""
-        file_path = self._get_user_file(user_id)
-        
-        if not os.path.exists(file_path):
-            return []
-        
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"載入記憶失敗: {e}")
-            return []
+        return json_store.load(self._get_user_file(user_id), default=list)
     
     def _save_memories(self, user_id: str, memories: List[Dict]) -> bool:
         """儲存用戶的記憶"""
-        file_path = self._get_user_file(user_id)
-        
-        try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(memories, f, ensure_ascii=False, indent=2)
-            return True
-        except Exception as e:
-            logger.error(f"儲存記憶失敗: {e}")
-            return False
+        # 只更新寫回快取，由 json_store 的背景執行緒批次寫入檔案
+        json_store.save(self._get_user_file(user_id), memories)
+        return True
     
     def add_memory(self, user_id: str, content: str, metadata: Optional[Dict] = None) -> Dict:
         """新增記憶"""
@@ -310,20 +308,14 @@ class LocalMemoryManager:
             return {"success": False, "error": "儲存失敗"}
     
     def search_memory(self, user_id: str, query: str, limit: int = 5) -> Dict:
-        """搜尋記憶（簡單的關鍵字匹配）"""
-        memories = self._load_memories(user_id)
-        
-        # 簡單的關鍵字搜尋
-        query_lower = query.lower()
-        matching_memories = []
-        
-        for memory in memories:
-            memory_text = memory.get("memory", "").lower()
-            if query_lower in memory_text:
-                matching_memories.append(memory)
+        """搜尋記憶（依查詢詞元的命中程度排序，完整包含查詢的記憶排最前面）"""
+        memories, version = json_store.load_with_version(self._get_user_file(user_id), default=list)
         
-        # 限制結果數量
-        matching_memories = matching_memories[:limit]
+        index = self._search_index.get(user_id, version, lambda: (
+            (memory.get("id", position), memory.get("memory", ""), memory)
+            for position, memory in enumerate(memories)
+        ))
+        matching_memories = [index.get(memory_id) for memory_id, _ in index.search(query, limit=limit)]
         
         logger.info(f"本地記憶搜尋完成: user_id={user_id}, found={len(matching_memories)}")
         return {"success": True, "memories": matching_memories}
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+訊息合併（debounce）模組
+使用者常把一個問題拆成兩三則訊息快速送出，逐則處理會造成多次意圖分類與 Gemini 請求，
+也會得到好幾個片段的回答。本模組在每個使用者的訊息之間設一個短暫的時間窗口：
+窗口內陸續到達的訊息會合併成一次處理
+
+處理函數不會等待窗口結束（同一使用者的後續訊息排在同一個工作通道中，
+等待會造成死結）；訊息先放進緩衝區，由背景執行緒在窗口結束後送出合併結果。
+緩衝區只存在記憶體中：app 搭配持久化事件佇列使用時，緩衝中的事件要等整批處理完成後才標記完成，
+程序在窗口內重啟時由佇列重新處理；沒有持久化佇列時該批訊息會遺失。預設為關閉
+"""
+
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class _Burst:
+    """一個使用者尚未送出的訊息批次"""
+
+    __slots__ = ("texts", "payloads", "started_at", "deadline")
+
+    def __init__(self, now, deadline):
+        self.texts = []
+        self.payloads = []
+        self.started_at = now
+        self.deadline = deadline
+
+
+class MessageDebouncer:
+    """
+    依鍵（例如 (聊天室, 使用者)）合併短時間內連續到達的訊息
+
+    每則新訊息都會把送出時間延後 window 秒，但整批最多延後 max_delay 秒，
+    避免使用者持續輸入時遲遲得不到回應
+    """
+
+    def __init__(self, on_flush, window_ms=0, max_delay_ms=None, flush_workers=4):
+        """
+        初始化合併器
+
+        參數:
+            on_flush: 送出合併結果的函數，接收 (key, texts, payloads)
+            window_ms: 合併窗口（毫秒），0 表示停用
+            max_delay_ms: 一批訊息從第一則開始最多延後的毫秒數，預設為窗口的 4 倍
+            flush_workers: 執行 on_flush 的執行緒數量
+        """
+        self.on_flush = on_flush
+        self.window = max(window_ms, 0) / 1000.0
+        self.max_delay = (max_delay_ms / 1000.0) if max_delay_ms else self.window * 4
+        self.flush_workers = flush_workers
+
+        self._cond = threading.Condition()
+        self._bursts = {}
+        self._pid = None
+        self._executor = None
+        self._counters = {"messages": 0, "merged": 0, "flushes": 0}
+
+    @property
+    def enabled(self):
+        """是否啟用合併"""
+        return self.window > 0
+
+    def _ensure_started(self):
+        """確保目前程序的送出執行緒已啟動（需在持有鎖時呼叫，fork 後會重新建立）"""
+        if self._pid == os.getpid():
+            return
+        self._bursts = {}
+        self._executor = ThreadPoolExecutor(max_workers=self.flush_workers, thread_name_prefix="debounce-flush")
+        threading.Thread(target=self._flush_loop, name="debounce-timer", daemon=True).start()
+        self._pid = os.getpid()
+        logger.info(f"訊息合併已啟用: 窗口 {self.window * 1000:.0f} ms, 最長延後 {self.max_delay * 1000:.0f} ms")
+
+    def is_open(self, key):
+        """
+        檢查指定鍵是否有尚未送出的批次（用於合併沒有觸發前綴的後續訊息）
+
+        參數:
+            key: 合併鍵
+
+        返回:
+            bool
+        """
+        if not self.enabled:
+            return False
+        with self._cond:
+            return self._pid == os.getpid() and key in self._bursts
+
+    def add(self, key, text, payload=None):
+        """
+        加入一則訊息
+
+        參數:
+            key: 合併鍵
+            text: 訊息文字
+            payload: 送出時一併交給 on_flush 的資料（例如 reply token）
+
+        返回:
+            bool: True 表示開啟了新的批次，False 表示合併到既有批次
+        """
+        now = time.monotonic()
+        with self._cond:
+            self._ensure_started()
+            self._counters["messages"] += 1
+            burst = self._bursts.get(key)
+            started = burst is None
+            if started:
+                burst = _Burst(now, now + self.window)
+                self._bursts[key] = burst
+            else:
+                self._counters["merged"] += 1
+                burst.deadline = min(now + self.window, burst.started_at + self.max_delay)
+            burst.texts.append(text)
+            burst.payloads.append(payload)
+            self._cond.notify()
+            return started
+
+    def _flush_loop(self):
+        """背景執行緒：送出窗口已結束的批次"""
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                due = [key for key, burst in self._bursts.items() if burst.deadline <= now]
+                ready = [(key, self._bursts.pop(key)) for key in due]
+                if not ready:
+                    next_deadline = min((b.deadline for b in self._bursts.values()), default=None)
+                    self._cond.wait(None if next_deadline is None else max(next_deadline - now, 0))
+                    continue
+                self._counters["flushes"] += len(ready)
+
+            for key, burst in ready:
+                if len(burst.texts) > 1:
+                    logger.info(f"合併 {len(burst.texts)} 則連續訊息為一次處理")
+                self._executor.submit(self._run_flush, key, burst)
+
+    def _run_flush(self, key, burst):
+        """執行 on_flush 並記錄錯誤"""
+        try:
+            self.on_flush(key, burst.texts, burst.payloads)
+        except Exception as e:
+            logger.error(f"送出合併訊息時發生錯誤: {str(e)}", exc_info=True)
+
+    def get_stats(self):
+        """
+        獲取合併統計
+
+        返回:
+            dict: 是否啟用、窗口設定、目前開啟的批次數與計數器
+        """
+        with self._cond:
+            return {
+                "enabled": self.enabled,
+                "window_ms": round(self.window * 1000),
+                "max_delay_ms": round(self.max_delay * 1000),
+                "open_bursts": len(self._bursts) if self._pid == os.getpid() else 0,
+                "counters": dict(self._counters),
+            }
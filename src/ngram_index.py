@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+中文 n-gram 倒排索引模組
+內容、連結、本地記憶與對話紀錄的關鍵字搜尋原本都是對每個項目做一次 `in` 子字串比對，
+成本隨項目數線性增加，記憶搜尋也只能把整個查詢當成一個子字串比對。
+
+NgramIndex 把每份文件切成詞元（中文以相鄰兩字與三字為一組，英數字以單字為單位）並建立倒排索引：
+- find：子字串查詢，先以查詢中一定會出現在文件裡的詞元取交集縮小範圍，再以原字串確認，
+  結果與逐一 `in` 比對相同
+- search：多詞排序查詢，依文件包含多少查詢詞元（以 IDF 加權）排序，完整包含查詢字串的排最前面
+- add / remove / sync：隨儲存與刪除增量更新，不需要重建
+
+NgramIndexCache 為每位使用者保留一個索引，以資料的版本判斷是否需要同步；
+同步在每個索引自己的鎖下進行，已套用較新的版本時不會再以較舊的資料覆蓋
+"""
+
+import re
+import math
+import threading
+from collections import OrderedDict
+
+_CJK_RUN_RE = re.compile(r"[㐀-鿿豈-﫿]+")
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+NGRAM_SIZES = (2, 3)
+
+
+def tokenize(text):
+    """
+    將文字切成索引用的詞元：中文以相鄰兩字與三字為一組 (bigram / trigram)，英數字以單字為單位（轉小寫）
+
+    只有一個字的中文片段保留為單字詞元
+    """
+    tokens = set()
+    for run in _CJK_RUN_RE.findall(text):
+        if len(run) == 1:
+            tokens.add(run)
+            continue
+        for size in NGRAM_SIZES:
+            tokens.update(run[i:i + size] for i in range(len(run) - size + 1))
+    tokens.update(_WORD_RE.findall(text.lower()))
+    return tokens
+
+
+def required_tokens(query):
+    """
+    返回任何包含 query 子字串的文字一定也會有的詞元
+
+    中文片段的 n-gram 一定出現在文件中；英數字單字只有前後都被其他字元隔開時才確定是完整的單字
+    （在查詢開頭或結尾的可能只是文件中較長單字的一部分）。
+    沒有這樣的詞元時（例如只有一個中文字或部分英文單字）返回空集合，呼叫端需要逐一比對
+    """
+    query = query.lower()
+    tokens = set()
+    for run in _CJK_RUN_RE.findall(query):
+        if len(run) >= 3:
+            tokens.update(run[i:i + 3] for i in range(len(run) - 2))
+        elif len(run) == 2:
+            tokens.add(run)
+    for match in _WORD_RE.finditer(query):
+        if match.start() > 0 and match.end() < len(query):
+            tokens.add(match.group())
+    return tokens
+
+
+class NgramIndex:
+    """一組文件（通常是一位使用者的項目）的倒排索引，所有方法都是執行緒安全的"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings = {}  # 詞元 -> set(文件 ID)
+        self._texts = {}  # 文件 ID -> 小寫的文字
+        self._tokens = {}  # 文件 ID -> 詞元（刪除時使用）
+        self._documents = {}  # 文件 ID -> 呼叫端的原始項目
+        self._order = {}  # 文件 ID -> 加入的順序
+        self._next_order = 0
+
+    def __len__(self):
+        return len(self._texts)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._texts
+
+    def add(self, doc_id, text, document=None):
+        """
+        新增或取代一份文件
+
+        參數:
+            doc_id: 文件 ID
+            text: 要索引的文字
+            document: 查詢時一併返回的原始項目（可選）
+        """
+        text = text.lower()
+        with self._lock:
+            if doc_id in self._texts:
+                if self._texts[doc_id] == text:
+                    self._documents[doc_id] = document
+                    return
+                self._remove_postings(doc_id)
+            else:
+                self._order[doc_id] = self._next_order
+                self._next_order += 1
+            tokens = frozenset(tokenize(text))
+            self._texts[doc_id] = text
+            self._tokens[doc_id] = tokens
+            self._documents[doc_id] = document
+            for token in tokens:
+                self._postings.setdefault(token, set()).add(doc_id)
+
+    def remove(self, doc_id):
+        """刪除文件（不存在時不做任何事）"""
+        with self._lock:
+            if doc_id not in self._texts:
+                return
+            self._remove_postings(doc_id)
+            del self._texts[doc_id], self._tokens[doc_id], self._documents[doc_id], self._order[doc_id]
+
+    def _remove_postings(self, doc_id):
+        for token in self._tokens[doc_id]:
+            postings = self._postings.get(token)
+            if postings is not None:
+                postings.discard(doc_id)
+                if not postings:
+                    del self._postings[token]
+
+    def sync(self, documents):
+        """
+        以目前的文件集合更新索引：刪除已不存在的文件，只為新增或內容改變的文件重新切詞
+
+        參數:
+            documents: [(文件 ID, 文字, 原始項目)]，依加入順序排列
+        """
+        with self._lock:
+            seen = set()
+            for doc_id, text, document in documents:
+                seen.add(doc_id)
+                self.add(doc_id, text, document)
+            for doc_id in [doc_id for doc_id in self._texts if doc_id not in seen]:
+                self.remove(doc_id)
+
+    def get(self, doc_id):
+        """返回文件的原始項目"""
+        return self._documents.get(doc_id)
+
+    def find(self, query):
+        """
+        子字串查詢（不分大小寫）
+
+        返回:
+            list: 包含 query 的文件 ID，依加入順序排列
+        """
+        query = query.lower()
+        with self._lock:
+            tokens = required_tokens(query)
+            if tokens:
+                candidates = None
+                for token in sorted(tokens, key=lambda t: len(self._postings.get(t, ()))):
+                    postings = self._postings.get(token)
+                    if not postings:
+                        return []
+                    candidates = set(postings) if candidates is None else candidates & postings
+                    if not candidates:
+                        return []
+            else:
+                candidates = self._texts
+            # n-gram 可能跨越不同位置湊出，最後以原字串確認
+            matches = [doc_id for doc_id in candidates if query in self._texts[doc_id]]
+            matches.sort(key=self._order.__getitem__)
+            return matches
+
+    def search(self, query, limit=None, min_score=0.3):
+        """
+        多詞排序查詢
+
+        每個查詢詞元（中文只用 bigram，trigram 只用於 find 縮小範圍）以 IDF 加權，
+        文件的分數是它包含的詞元權重佔查詢總權重的比例；完整包含查詢字串的文件分數再加 1
+
+        參數:
+            query: 查詢文字
+            limit: 最多返回幾筆
+            min_score: 最低分數（0 到 1）
+
+        返回:
+            list: [(文件 ID, 分數)]，依分數由高到低、同分時依加入順序排列
+        """
+        query = query.strip().lower()
+        tokens = {token for token in tokenize(query) if not (len(token) == 3 and _CJK_RUN_RE.fullmatch(token))}
+        if not tokens:
+            return []
+        with self._lock:
+            total_docs = len(self._texts)
+            scores = {}
+            total_weight = 0.0
+            for token in tokens:
+                postings = self._postings.get(token, ())
+                weight = math.log(1 + total_docs / (len(postings) or 1))
+                total_weight += weight
+                for doc_id in postings:
+                    scores[doc_id] = scores.get(doc_id, 0.0) + weight
+            # 完整包含查詢字串的文件（例如只有一個字的查詢）即使沒有命中詞元也要列入
+            exact = set(self.find(query))
+            for doc_id in exact:
+                scores.setdefault(doc_id, 0.0)
+            results = []
+            for doc_id, score in scores.items():
+                score /= total_weight
+                if doc_id in exact:
+                    score += 1
+                if score >= min_score:
+                    results.append((doc_id, score))
+            results.sort(key=lambda item: (-item[1], self._order[item[0]]))
+            return results[:limit] if limit else results
+
+
+class NgramIndexCache:
+    """以鍵（例如使用者或檔案路徑）保留索引，資料版本改變時增量同步"""
+
+    def __init__(self, max_entries=256):
+        """
+        參數:
+            max_entries: 記憶體中最多保留的索引數（依最近使用淘汰）
+        """
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> [版本, NgramIndex, 同步用的鎖]
+
+    def get(self, key, version, documents):
+        """
+        取得與資料版本一致的索引
+
+        參數:
+            key: 索引的鍵
+            version: 資料的版本（遞增的數字，比已套用的版本新時才呼叫 documents 同步；None 表示每次都同步）
+            documents: 返回 [(文件 ID, 文字, 原始項目)] 的函數
+
+        返回:
+            NgramIndex
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = [None, NgramIndex(), threading.Lock()]
+                self._entries[key] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(key)
+        index = entry[1]
+        if version is None or entry[0] != version:
+            with entry[2]:
+                # 等待期間其他執行緒可能已套用相同或更新的版本
+                if version is None or entry[0] is None or entry[0] < version:
+                    index.sync(documents())
+                    entry[0] = version
+        return index
+
+
+if __name__ == "__main__":
+    # 基準測試：一位使用者 5,000 則內容，比較逐一 `in` 比對與索引查詢（python src/ngram_index.py）
+    import random
+    import time
+
+    random.seed(0)
+    WORDS = ["台北", "台南", "咖啡", "拉麵", "演唱會", "讀書會", "React", "Python", "慢跑", "瑜伽",
+             "電影", "展覽", "市集", "火鍋", "早午餐", "會議", "報告", "旅行", "海邊", "登山"]
+    texts = [f"{random.choice(WORDS)}和{random.choice(WORDS)}的{random.choice(WORDS)}筆記 {i}"
+             for i in range(5000)]
+    index = NgramIndex()
+    started = time.perf_counter()
+    for position, text in enumerate(texts):
+        index.add(position, text)
+    print(f"建立索引: {len(texts)} 則，{(time.perf_counter() - started) * 1000:.1f} ms")
+
+    for query in ("演唱會", "台南的拉麵", "python", "海"):
+        lowered = query.lower()
+        number = 200
+        started = time.perf_counter()
+        for _ in range(number):
+            expected = [i for i, text in enumerate(texts) if lowered in text.lower()]
+        scan = (time.perf_counter() - started) / number
+        started = time.perf_counter()
+        for _ in range(number):
+            found = index.find(query)
+        indexed = (time.perf_counter() - started) / number
+        assert found == expected
+        print(f"find({query!r}): {len(found)} 筆，逐一比對 {scan * 1e6:.0f} µs，索引 {indexed * 1e6:.0f} µs")
+
+    ranked = index.search("台南 拉麵 筆記", limit=3)
+    print(f"search('台南 拉麵 筆記'): {[(texts[doc_id], round(score, 2)) for doc_id, score in ranked]}")
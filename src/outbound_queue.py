@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+"""
+持久化 LINE 推送佇列模組
+push/multicast 失敗時（429、5xx、逾時）不再只是記錄錯誤後遺失訊息：
+
+- 每個 API 請求（最多 5 則訊息）先寫入 SQLite，並配上固定的 X-Line-Retry-Key，
+  重試時沿用同一個 key，LINE 會忽略已經受理過的請求，不會重複送達
+- 同一次傳送給同一對象的多個請求共用 send_id，依序傳送：前一個請求送達後才能領取下一個，
+  前一個無法送達時其餘的請求一起移入 dead_letters，訊息不會亂序
+- 可重試的錯誤以指數退避排程，由背景執行緒重送；收到 429 時所有傳送一起暫停
+- 不可重試的錯誤（其他 4xx）或超過嘗試次數的請求移入 dead_letters，
+  可用 `python src/main.py --replay-dead-letters [id ...]` 重新排入佇列
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+
+from linebot.v3.messaging import Message, ApiException
+
+logger = logging.getLogger(__name__)
+
+# 導入訊息傳送器（共用限速與打包邏輯）
+try:
+    from src.line_sender import line_sender, plan_requests
+except ImportError:
+    from line_sender import line_sender, plan_requests
+
+# 導入共用的 SQLite 連線（每個執行緒、每個程序各自一條）
+try:
+    from src.sqlite_connection import ThreadLocalConnection
+except ImportError:
+    from sqlite_connection import ThreadLocalConnection
+
+STATUS_PENDING = "pending"
+STATUS_SENDING = "sending"
+
+# 傳送結果
+RESULT_SENT = "sent"        # 已送達
+RESULT_QUEUED = "queued"    # 暫時失敗，已排程重試
+RESULT_DEAD = "dead"        # 無法送達，已移入 dead_letters
+
+# 收到 429 但沒有 Retry-After 時，所有傳送暫停的秒數
+DEFAULT_RATE_LIMIT_PAUSE = 10
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               '.cache', 'line_outbound.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbound (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    retry_key TEXT UNIQUE NOT NULL,
+    kind TEXT NOT NULL,
+    target TEXT NOT NULL,
+    messages TEXT NOT NULL,
+    send_id TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    lease_expires_at REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outbound_status_next ON outbound (status, next_attempt_at);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    retry_key TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    target TEXT NOT NULL,
+    messages TEXT NOT NULL,
+    send_id TEXT,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    failed_at REAL NOT NULL
+);
+"""
+
+
+def classify_error(error):
+    """
+    判斷 LINE API 錯誤是否可以重試
+
+    參數:
+        error: 傳送時拋出的例外
+
+    返回:
+        tuple: (結果, HTTP 狀態碼或 None)，結果為 "accepted"（409：相同 retry key 已受理）、
+            "retry" 或 "fatal"
+    """
+    status = getattr(error, "status", None) if isinstance(error, ApiException) else None
+    if status == 409:
+        return "accepted", status
+    if status is None or status == 429 or status >= 500:
+        # 沒有狀態碼的例外是連線錯誤或逾時
+        return "retry", status
+    return "fatal", status
+
+
+def describe_error(error):
+    """將傳送錯誤轉為單行描述（ApiException 的字串包含完整的標頭與內容）"""
+    if isinstance(error, ApiException):
+        body = (error.body or "").decode("utf-8", "replace") if isinstance(error.body, bytes) else (error.body or "")
+        return f"HTTP {error.status} {error.reason or ''} {body}".strip()[:500]
+    return f"{type(error).__name__}: {str(error)[:500]}"
+
+
+def _retry_after(error):
+    """讀取 429 回應的 Retry-After 秒數"""
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return DEFAULT_RATE_LIMIT_PAUSE
+
+
+class OutboundQueue:
+    """
+    SQLite 持久化的 LINE 推送佇列
+
+    呼叫端送出時會先立即嘗試一次，成功就直接完成，只有失敗的請求才會留在佇列中等待重送
+    """
+
+    def __init__(self, db_path=None, max_attempts=6, base_backoff=5, max_backoff=900,
+                 lease_seconds=60, sender=None):
+        """
+        初始化推送佇列
+
+        參數:
+            db_path: SQLite 檔案路徑，預設為 .cache/line_outbound.db
+            max_attempts: 最多嘗試次數，超過後移入 dead_letters
+            base_backoff: 重試退避的基礎秒數
+            max_backoff: 重試退避的最大秒數
+            lease_seconds: 傳送中的請求多久沒有結果視為中斷，可被重新領取
+            sender: 訊息傳送器，預設為全域的 line_sender
+        """
+        self.db_path = db_path or os.getenv("LINE_OUTBOUND_DB", DEFAULT_DB_PATH)
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.lease_seconds = lease_seconds
+        self.sender = sender or line_sender
+
+        self._connect = ThreadLocalConnection(self.db_path, row_factory=sqlite3.Row)
+        self._lock = threading.Lock()
+        self._worker_pid = None
+        self._counters = {"sent": 0, "retried": 0, "dead_lettered": 0, "replayed": 0, "rate_limited": 0}
+
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        self._migrate(conn)
+
+    def _migrate(self, conn):
+        """為舊版資料庫補上 send_id 欄位"""
+        for table in ("outbound", "dead_letters"):
+            columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+            if "send_id" not in columns:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN send_id TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_outbound_send ON outbound (send_id, id)")
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._counters[key] += amount
+
+    def push(self, to, messages):
+        """
+        推送訊息給單一對象（失敗時排程重試）
+
+        參數:
+            to: 使用者、群組或聊天室 ID
+            messages: 訊息物件列表
+
+        返回:
+            str: sent / queued / dead（多個請求時取最差的結果）
+        """
+        return self.multicast([to], messages)
+
+    def multicast(self, recipients, messages):
+        """
+        將相同的訊息送給多個對象（失敗時排程重試）
+
+        參數:
+            recipients: 對象 ID 列表
+            messages: 訊息物件列表
+
+        返回:
+            str: sent / queued / dead（多個請求時取最差的結果）
+        """
+        # 同一對象的多個批次是同一次傳送，需要依序送達
+        sends = {}
+        for kind, target, batch in plan_requests(recipients, messages):
+            sends.setdefault((kind, json.dumps(target)), []).append(batch)
+        results = [self._send_new(kind, json.loads(target), batches) for (kind, target), batches in sends.items()]
+        for result in (RESULT_DEAD, RESULT_QUEUED):
+            if result in results:
+                return result
+        return RESULT_SENT
+
+    def _send_new(self, kind, target, batches):
+        """
+        寫入一次傳送的所有請求並立即依序嘗試傳送
+
+        參數:
+            kind: push 或 multicast
+            target: 對象 ID（multicast 時為 ID 列表）
+            batches: 訊息批次列表（每批一個 API 請求）
+        """
+        now = time.time()
+        send_id = str(uuid.uuid4()) if len(batches) > 1 else None
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row_ids = []
+            for position, batch in enumerate(batches):
+                # 第一個請求由呼叫端的執行緒立即傳送，其餘的等前一個送達後才能被領取
+                first = position == 0
+                cursor = conn.execute(
+                    "INSERT INTO outbound (retry_key, kind, target, messages, send_id, status, attempts, "
+                    "next_attempt_at, lease_expires_at, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (str(uuid.uuid4()), kind, json.dumps(target), json.dumps([m.to_dict() for m in batch]), send_id,
+                     STATUS_SENDING if first else STATUS_PENDING, 1 if first else 0, now,
+                     now + self.lease_seconds if first else None, now, now)
+                )
+                row_ids.append(cursor.lastrowid)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        row = conn.execute("SELECT * FROM outbound WHERE id = ?", (row_ids[0],)).fetchone()
+        return self._send_chain(row)
+
+    def _send_chain(self, row):
+        """傳送一個已領取的請求；送達後接著領取並傳送同一次傳送的下一個請求"""
+        while True:
+            result = self._attempt(row)
+            if result != RESULT_SENT or row["send_id"] is None:
+                return result
+            row = self._claim_next(row["send_id"])
+            if row is None:
+                return RESULT_SENT
+
+    def _claim_next(self, send_id):
+        """領取同一次傳送中最早、且已到期的請求，沒有時返回 None"""
+        now = time.time()
+        conn = self._connect()
+        row = conn.execute("SELECT id FROM outbound WHERE send_id = ? ORDER BY id LIMIT 1", (send_id,)).fetchone()
+        if row is None:
+            return None
+        cursor = conn.execute(
+            "UPDATE outbound SET status = ?, attempts = attempts + 1, lease_expires_at = ?, updated_at = ? "
+            "WHERE id = ? AND status = ? AND next_attempt_at <= ?",
+            (STATUS_SENDING, now + self.lease_seconds, now, row["id"], STATUS_PENDING, now)
+        )
+        if cursor.rowcount == 0:
+            # 已被重送執行緒領取，或還在退避中
+            return None
+        return conn.execute("SELECT * FROM outbound WHERE id = ?", (row["id"],)).fetchone()
+
+    def _attempt(self, row):
+        """傳送一個已領取的請求並依結果更新佇列"""
+        messages = [Message.from_dict(m) for m in json.loads(row["messages"])]
+        try:
+            self.sender.send_batch(row["kind"], json.loads(row["target"]), messages, retry_key=row["retry_key"])
+        except Exception as e:
+            outcome, status = classify_error(e)
+            if outcome == "accepted":
+                logger.info(f"推送請求 {row['retry_key']} 已被 LINE 受理過 (409)，視為成功")
+            else:
+                if status == 429:
+                    self._count("rate_limited")
+                    self.sender.bucket.penalize(_retry_after(e))
+                return self._fail(row, describe_error(e), retryable=outcome == "retry")
+
+        self._connect().execute("DELETE FROM outbound WHERE id = ?", (row["id"],))
+        self._count("sent")
+        return RESULT_SENT
+
+    def _fail(self, row, error, retryable):
+        """記錄失敗：可重試時以指數退避排程，否則移入 dead_letters"""
+        now = time.time()
+        conn = self._connect()
+        if not retryable or row["attempts"] >= self.max_attempts:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 同一次傳送中後面的請求不能先送達，一起移入 dead_letters
+                later = []
+                if row["send_id"] is not None:
+                    later = conn.execute("SELECT * FROM outbound WHERE send_id = ? AND id > ? ORDER BY id",
+                                         (row["send_id"], row["id"])).fetchall()
+                conn.executemany(
+                    "INSERT INTO dead_letters (retry_key, kind, target, messages, send_id, attempts, last_error, "
+                    "failed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(r["retry_key"], r["kind"], r["target"], r["messages"], r["send_id"], r["attempts"],
+                      error if r is row else f"前一個請求無法送達: {error}", now) for r in [row] + later]
+                )
+                conn.executemany("DELETE FROM outbound WHERE id = ?", [(r["id"],) for r in [row] + later])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._count("dead_lettered", 1 + len(later))
+            logger.error(f"推送給 {json.loads(row['target'])} 的請求已移入 dead_letters（嘗試 {row['attempts']} 次）: {error}")
+            return RESULT_DEAD
+
+        backoff = min(self.base_backoff * (2 ** (row["attempts"] - 1)), self.max_backoff)
+        conn.execute(
+            "UPDATE outbound SET status = ?, next_attempt_at = ?, lease_expires_at = NULL, last_error = ?, "
+            "updated_at = ? WHERE id = ?",
+            (STATUS_PENDING, now + backoff, error, now, row["id"])
+        )
+        self._count("retried")
+        logger.warning(f"推送給 {json.loads(row['target'])} 失敗，{backoff} 秒後重試 (第 {row['attempts']} 次): {error}")
+        return RESULT_QUEUED
+
+    def _claim_due(self, limit=20):
+        """領取到期的重試請求與租約已過期的傳送中請求（同一次傳送中還有較早的請求時不領取）"""
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id FROM outbound WHERE ((status = ? AND next_attempt_at <= ?) "
+                "OR (status = ? AND lease_expires_at <= ?)) "
+                "AND (send_id IS NULL OR NOT EXISTS ("
+                "    SELECT 1 FROM outbound AS earlier WHERE earlier.send_id = outbound.send_id "
+                "    AND earlier.id < outbound.id)) ORDER BY id LIMIT ?",
+                (STATUS_PENDING, now, STATUS_SENDING, now, limit)
+            ).fetchall()
+            row_ids = [row["id"] for row in rows]
+            conn.executemany(
+                "UPDATE outbound SET status = ?, attempts = attempts + 1, lease_expires_at = ?, updated_at = ? "
+                "WHERE id = ?",
+                [(STATUS_SENDING, now + self.lease_seconds, now, row_id) for row_id in row_ids]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [conn.execute("SELECT * FROM outbound WHERE id = ?", (row_id,)).fetchone() for row_id in row_ids]
+
+    def process_due(self):
+        """
+        重送所有到期的請求
+
+        返回:
+            dict: 各結果的數量
+        """
+        results = {RESULT_SENT: 0, RESULT_QUEUED: 0, RESULT_DEAD: 0}
+        for row in self._claim_due():
+            results[self._send_chain(row)] += 1
+        return results
+
+    def start_worker(self, interval=5):
+        """
+        啟動重送執行緒（每個程序一條）
+
+        參數:
+            interval: 檢查間隔（秒）
+        """
+        with self._lock:
+            if self._worker_pid == os.getpid():
+                return
+            self._worker_pid = os.getpid()
+
+        def worker_loop():
+            while True:
+                try:
+                    self.process_due()
+                except Exception as e:
+                    logger.error(f"推送重送執行緒發生錯誤: {str(e)}")
+                time.sleep(interval)
+
+        threading.Thread(target=worker_loop, name="line-outbound-retry", daemon=True).start()
+        logger.info("LINE 推送重送執行緒已啟動")
+
+    def list_dead_letters(self, limit=50):
+        """
+        列出 dead letters
+
+        參數:
+            limit: 最多筆數
+
+        返回:
+            list: dead letter 的 dict 列表（由新到舊）
+        """
+        rows = self._connect().execute(
+            "SELECT id, kind, target, messages, attempts, last_error, failed_at FROM dead_letters "
+            "ORDER BY id DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def replay_dead_letters(self, ids=None):
+        """
+        將 dead letters 重新排入佇列（沿用原本的 retry key 與 send_id，已送達過的請求不會重複送達，
+        同一次傳送的請求依原本的順序傳送）
+
+        參數:
+            ids: 要重送的 dead letter id 列表，None 表示全部
+
+        返回:
+            int: 重新排入的數量
+        """
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if ids is None:
+                rows = conn.execute("SELECT * FROM dead_letters ORDER BY id").fetchall()
+            else:
+                placeholders = ",".join("?" * len(ids))
+                rows = conn.execute(f"SELECT * FROM dead_letters WHERE id IN ({placeholders}) ORDER BY id",
+                                    list(ids)).fetchall()
+            for row in rows:
+                conn.execute(
+                    "INSERT OR IGNORE INTO outbound (retry_key, kind, target, messages, send_id, status, attempts, "
+                    "next_attempt_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?, ?)",
+                    (row["retry_key"], row["kind"], row["target"], row["messages"], row["send_id"],
+                     STATUS_PENDING, now, now, now)
+                )
+                conn.execute("DELETE FROM dead_letters WHERE id = ?", (row["id"],))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._count("replayed", len(rows))
+        logger.info(f"已將 {len(rows)} 筆 dead letter 重新排入推送佇列")
+        return len(rows)
+
+    def get_stats(self):
+        """
+        獲取佇列統計
+
+        返回:
+            dict: 等待重送與傳送中的請求數、dead letter 數與計數器
+        """
+        conn = self._connect()
+        by_status = {row["status"]: row["n"] for row in
+                     conn.execute("SELECT status, COUNT(*) AS n FROM outbound GROUP BY status")}
+        dead_letters = conn.execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0]
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            "pending": by_status.get(STATUS_PENDING, 0),
+            "sending": by_status.get(STATUS_SENDING, 0),
+            "dead_letters": dead_letters,
+            "counters": counters,
+        }
+
+    def render_prometheus(self, prefix="line_outbound"):
+        """以 Prometheus 文字格式輸出佇列指標"""
+        stats = self.get_stats()
+        lines = [f"# TYPE {prefix}_requests gauge"]
+        for status in (STATUS_PENDING, STATUS_SENDING):
+            lines.append(f'{prefix}_requests{{status="{status}"}} {stats[status]}')
+        lines.append(f"# TYPE {prefix}_dead_letters gauge")
+        lines.append(f"{prefix}_dead_letters {stats['dead_letters']}")
+        lines.append(f"# TYPE {prefix}_operations_total counter")
+        for key, value in stats["counters"].items():
+            lines.append(f'{prefix}_operations_total{{operation="{key}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+# 全域推送佇列實例
+outbound_queue = OutboundQueue()
@@ -14,6 +14,8 @@ from .intent_classifier import intent_classifier
 from .memory_manager import mem0_manager, local_memory_manager
 from .todo_manager import todo_manager
 from .content_manager import content_manager
+from .trigger_matcher import match_trigger
+from .chat_history_index import chat_history_index, KIND_SAVED, KIND_TODO
 # 連結分析功能已移除
 
 logger = logging.getLogger(__name__)
@@ -29,6 +31,7 @@ class PeanutAssistant:
         self.local_memory = local_memory_manager
         self.todo_manager = todo_manager
         self.content_manager = content_manager
+        self.chat_history_index = chat_history_index
         # 連結分析功能已移除
         
         logger.info("花生 AI 小幫手整合服務已初始化")
@@ -49,8 +52,15 @@ class PeanutAssistant:
             clean_message = self._clean_message(message)
             logger.info(f"處理訊息: 原始='{message}', 清理後='{clean_message}'")
             
-            # 1. 意圖分類
-            intent_result = self.intent_classifier.classify_intent(clean_message)
+            # 1. 意圖分類（可能呼叫 Gemini API，移到執行緒中以免阻塞共用的事件迴圈）
+            # 規則就能判斷為查詢對話紀錄時，先以本地索引回答，不需要呼叫模型
+            rule_result = self.intent_classifier.classify_with_rules(clean_message)
+            if rule_result.get("queryType") == "chat_history":
+                history_result = self._answer_from_history_index(user_id, clean_message)
+                if history_result:
+                    return history_result
+            
+            intent_result = await asyncio.to_thread(self.intent_classifier.classify_intent, clean_message)
             intent = intent_result.get("intent")
             sub_intent = intent_result.get("subIntent")
             content_type = intent_result.get("contentType")
@@ -80,22 +90,8 @@ class PeanutAssistant:
             }
     
     def _clean_message(self, message: str) -> str:
-        """清理訊息，移除前綴"""
-        message = message.strip()
-        
-        # 移除常見前綴
-        prefixes = ['ai:', 'ai：', '@ai ', '@ai', 'ai ', '小幫手', '花生', '小幫手，', '花生，']
-        
-        for prefix in prefixes:
-            if message.lower().startswith(prefix):
-                message = message[len(prefix):].strip()
-                break
-        
-        # 移除開頭的逗號、句號等
-        while message and message[0] in '，,。. 　':
-            message = message[1:].strip()
-        
-        return message
+        """清理訊息，移除觸發前綴與開頭的分隔符號"""
+        return match_trigger(message).query
     
     async def _handle_todo(self, user_id: str, message: str, sub_intent: Optional[str]) -> Dict:
         """處理待辦事項相關請求"""
@@ -120,6 +116,8 @@ class PeanutAssistant:
             if result.get("success"):
                 todo = result["todo"]
                 response = f"✅ 已新增待辦事項：\n{todo['content']}"
+                if self.chat_history_index:
+                    self.chat_history_index.add(user_id, KIND_TODO, todo['content'])
                 
                 if todo.get("due_date"):
                     response += f"\n截止日期：{todo['due_date']}"
@@ -287,6 +285,8 @@ class PeanutAssistant:
         if result.get("success"):
             type_name = self.content_manager.CONTENT_TYPES.get(content_type, content_type)
             response = f"✅ 已儲存到 {type_name}\n\n內容：{message}"
+            if self.chat_history_index:
+                self.chat_history_index.add(user_id, KIND_SAVED, message, type_name)
             
             # 也儲存到長期記憶
             if self.mem0_manager.enabled:
@@ -352,6 +352,12 @@ class PeanutAssistant:
             else:
                 return {"success": True, "response": "目前沒有相關內容喔！"}
         
+        # 查詢過往對話：先以本地索引回答，找不到紀錄時才改用記憶搜尋與 Gemini
+        if query_type == "chat_history":
+            history_result = self._answer_from_history_index(user_id, message)
+            if history_result:
+                return history_result
+        
         # 其他查詢類型：搜尋相關記憶
         memories = []
         
@@ -383,6 +389,29 @@ class PeanutAssistant:
         
         return {"success": True, "response": response, "needs_ai_response": True, "context": context}
     
+    def _answer_from_history_index(self, user_id: str, message: str) -> Optional[Dict]:
+        """
+        以本地對話紀錄索引回答查詢
+        
+        Args:
+            user_id: 用戶 ID
+            message: 查詢訊息
+            
+        Returns:
+            Optional[Dict]: 處理結果；索引未啟用或找不到紀錄時返回 None
+        """
+        if not self.chat_history_index:
+            return None
+        try:
+            result = self.chat_history_index.answer(user_id, message)
+        except Exception as e:
+            logger.error(f"查詢對話紀錄索引失敗: {e}")
+            return None
+        if not result.get("found"):
+            return None
+        logger.info(f"以本地索引回答對話紀錄查詢，共 {result['count']} 筆")
+        return {"success": True, "response": result["response"]}
+    
     async def _handle_chat(self, user_id: str, message: str) -> Dict:
         """處理一般聊天"""
         
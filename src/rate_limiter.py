@@ -5,14 +5,202 @@
 用於處理 API 請求的限流和重試，以避免超過 API 配額限制
 """
 
+import os
+import re
+import json
 import time
+import sqlite3
 import logging
 import threading
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from collections import deque
 
+# 導入共用的 SQLite 連線（每個執行緒、每個程序各自一條）
+try:
+    from src.sqlite_connection import ThreadLocalConnection
+except ImportError:
+    from sqlite_connection import ThreadLocalConnection
+
 logger = logging.getLogger(__name__)
 
+# 流量優先級通道（數字越小優先級越高）
+LANE_BROADCAST = "broadcast"            # 排程早安問候
+LANE_CHAT = "chat"                      # 互動式對話
+LANE_CLASSIFICATION = "classification"  # 意圖分類
+LANE_BACKGROUND = "background"          # 連結分析、緩存預熱等背景工作
+
+LANE_PRIORITIES = {
+    LANE_BROADCAST: 0,
+    LANE_CHAT: 1,
+    LANE_CLASSIFICATION: 2,
+    LANE_BACKGROUND: 3,
+}
+
+# 各通道保留的每日配額比例
+# 較低優先級的通道不能動用較高優先級通道尚未用完的保留額度，
+# 因此配額接近用盡時會依序淘汰 background → classification → chat
+DEFAULT_LANE_RESERVES = {
+    LANE_BROADCAST: 0.05,
+    LANE_CHAT: 0.40,
+    LANE_CLASSIFICATION: 0.10,
+    LANE_BACKGROUND: 0.0,
+}
+
+# 各通道等待每分鐘配額的最長秒數（None 表示持續等待）
+# 分類有規則備援、背景工作可延後，不值得長時間佔住執行緒
+DEFAULT_LANE_MAX_WAIT = {
+    LANE_BROADCAST: None,
+    LANE_CHAT: None,
+    LANE_CLASSIFICATION: 3,
+    LANE_BACKGROUND: 30,
+}
+
+# 自適應限流 (AIMD) 參數
+AIMD_DECREASE_FACTOR = 0.5      # 遇到 429 時每分鐘速率乘上此係數
+AIMD_DECREASE_COOLDOWN = 10     # 兩次調降之間的最短間隔（秒），避免同一波 429 連續調降
+AIMD_DAILY_INCREASE = 0.05      # 每日重置時，每日上限回升配置值的比例
+AIMD_DAILY_FLOOR = 0.1          # 學習到的每日上限不低於配置值的比例
+AIMD_SAVE_INTERVAL = 60         # 速率回升時寫入狀態檔的最短間隔（秒）
+
+# 遙測：滾動統計的時間範圍與等待時間直方圖的分桶上界（秒）
+STATS_WINDOW_SECONDS = 3600
+WAIT_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60)
+FORECAST_WINDOW_SECONDS = 3600  # 預測每日配額用盡時間時參考的最近時間範圍
+
+# 請求結果
+OUTCOME_ACQUIRED = "acquired"
+OUTCOME_REJECTED_DAILY = "rejected_daily"
+OUTCOME_REJECTED_TIMEOUT = "rejected_timeout"
+OUTCOMES = (OUTCOME_ACQUIRED, OUTCOME_REJECTED_DAILY, OUTCOME_REJECTED_TIMEOUT)
+
+
+def parse_retry_delay(error_message):
+    """
+    從 429 錯誤訊息中解析伺服器建議的重試秒數
+    
+    參數:
+        error_message: 錯誤訊息字串
+    
+    返回:
+        float 或 None
+    """
+    if not error_message:
+        return None
+    match = re.search(r'retry_delay\s*{\s*seconds:\s*(\d+)\s*}', error_message)
+    if not match:
+        match = re.search(r'retry in\s*([\d.]+)\s*s', error_message, re.IGNORECASE)
+    if match:
+        try:
+            return float(match.group(1))
+        except ValueError:
+            return None
+    return None
+
+
+def is_daily_quota_error(error_message):
+    """判斷 429 錯誤是否來自每日配額（而非每分鐘配額）"""
+    if not error_message:
+        return False
+    lowered = error_message.lower()
+    return "perday" in lowered or "per day" in lowered or "daily" in lowered
+
+
+# 共用每日用量以台灣時間的日期切分（各服務的系統時區可能不同）
+USAGE_TZ = timezone(timedelta(hours=8))
+USAGE_RETENTION_DAYS = 7
+
+USAGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    day TEXT NOT NULL,
+    lane TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, lane)
+);
+"""
+
+
+def _usage_day():
+    """共用每日用量目前的日期鍵"""
+    return datetime.now(USAGE_TZ).date().isoformat()
+
+
+class SharedDailyUsage:
+    """
+    以 SQLite 保存各通道的當日用量，讓同一台主機上的所有 gunicorn worker 與排程程序
+    共用同一份每日配額（各通道的保留額度因此也跨程序生效）
+    """
+    
+    def __init__(self, db_path):
+        """
+        參數:
+            db_path: SQLite 檔案路徑
+        """
+        self.db_path = db_path
+        self._connect = ThreadLocalConnection(self.db_path, timeout=5)
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        self._connect().executescript(USAGE_SCHEMA)
+        
+    def counts(self, day):
+        """返回指定日期各通道的用量 {lane: count}"""
+        return dict(self._connect().execute("SELECT lane, count FROM usage WHERE day = ?", (day,)))
+    
+    def try_acquire(self, day, lane, allow):
+        """
+        在同一個交易中讀取當日用量、判斷是否仍有額度並計入一次
+        
+        參數:
+            day: 日期鍵
+            lane: 通道
+            allow: 接收 {lane: count}、返回是否允許的函數
+        
+        返回:
+            tuple: (是否計入, 計入後的 {lane: count})
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            counts = dict(conn.execute("SELECT lane, count FROM usage WHERE day = ?", (day,)))
+            if not allow(counts):
+                conn.execute("ROLLBACK")
+                return False, counts
+            conn.execute(
+                "INSERT INTO usage (day, lane, count) VALUES (?, ?, 1) "
+                "ON CONFLICT(day, lane) DO UPDATE SET count = count + 1",
+                (day, lane)
+            )
+            cutoff = (datetime.fromisoformat(day) - timedelta(days=USAGE_RETENTION_DAYS)).date().isoformat()
+            conn.execute("DELETE FROM usage WHERE day < ?", (cutoff,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        counts[lane] = counts.get(lane, 0) + 1
+        return True, counts
+
+
+def _bucket_index(seconds):
+    """找出等待時間所屬的直方圖分桶"""
+    for i, upper in enumerate(WAIT_BUCKETS):
+        if seconds <= upper:
+            return i
+    return len(WAIT_BUCKETS)
+
+
+def _bucket_label(index):
+    """直方圖分桶的標籤，例如 <=0.5、>60"""
+    if index == len(WAIT_BUCKETS):
+        return f">{WAIT_BUCKETS[-1]}"
+    return f"<={WAIT_BUCKETS[index]}"
+
+
+def _percentile(sorted_values, q):
+    """計算已排序數列的百分位數"""
+    if not sorted_values:
+        return 0.0
+    index = min(int(q * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
 class RateLimiter:
     """
     API 流量限制器
@@ -22,9 +210,14 @@ class RateLimiter:
     - 每分鐘請求數限制
     - 每日請求數限制
     - 重試機制
+    - 優先級通道與各通道保留配額
+    - 依 429 回應自適應調整速率 (AIMD)，並保存學習結果
+    - 每日用量可保存在共用的 SQLite（SharedDailyUsage），多個程序共用同一份每日配額
     """
     
-    def __init__(self, requests_per_minute=10, requests_per_day=60, retry_after=5):
+    def __init__(self, requests_per_minute=10, requests_per_day=60, retry_after=5,
+                 lane_reserves=None, lane_max_wait=None, max_requests_per_minute=None,
+                 min_requests_per_minute=1, state_file=None, shared_usage=None):
         """
         初始化流量限制器
         
@@ -32,21 +225,55 @@ class RateLimiter:
             requests_per_minute: 每分鐘最大請求數
             requests_per_day: 每日最大請求數
             retry_after: 重試前等待的秒數
+            lane_reserves: 各通道保留的每日配額比例，預設為 DEFAULT_LANE_RESERVES
+            lane_max_wait: 各通道等待每分鐘配額的最長秒數，預設為 DEFAULT_LANE_MAX_WAIT
+            max_requests_per_minute: 自適應速率可回升到的上限，預設為 requests_per_minute 的兩倍
+            min_requests_per_minute: 自適應速率的下限
+            state_file: 保存學習結果的 JSON 檔案路徑（None 表示不保存）
+            shared_usage: 共用的每日用量（SharedDailyUsage），None 表示只計算本程序的用量
         """
         self.requests_per_minute = requests_per_minute
         self.requests_per_day = requests_per_day
         self.retry_after = retry_after
+        self.lane_reserves = dict(DEFAULT_LANE_RESERVES, **(lane_reserves or {}))
+        self.lane_max_wait = dict(DEFAULT_LANE_MAX_WAIT, **(lane_max_wait or {}))
         
-        # 請求歷史記錄
-        self.minute_requests = deque(maxlen=requests_per_minute)
-        self.daily_requests = deque(maxlen=requests_per_day)
+        # 請求歷史記錄（每日記錄同時保存所屬通道）
+        self.minute_requests = deque()
+        self.daily_requests = deque()
         
         # 計數器和鎖
         self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
         self._daily_count = 0
         self._minute_count = 0
+        self._lane_daily_counts = {lane: 0 for lane in LANE_PRIORITIES}
+        self._lane_waiting = {lane: 0 for lane in LANE_PRIORITIES}
         self._reset_time = datetime.now() + timedelta(days=1)
         
+        # 最近遇到的配額限制錯誤 (429) 時間
+        self._quota_errors = deque()
+        
+        # 自適應限流狀態：以配置值為起點，依 429 調降、依成功請求緩慢回升
+        self.max_requests_per_minute = max_requests_per_minute or requests_per_minute * 2
+        self.min_requests_per_minute = min_requests_per_minute
+        self.effective_rpm = float(requests_per_minute)
+        self.effective_daily = requests_per_day
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._last_save = 0.0
+        self._total_429 = 0
+        
+        # 遙測：最近一小時的事件 (monotonic 時間, 通道, 結果, 等待秒數) 與啟動以來的累計值
+        self._events = deque()
+        self._totals = {lane: {outcome: 0 for outcome in OUTCOMES} for lane in LANE_PRIORITIES}
+        self._wait_totals = {lane: {"sum": 0.0, "buckets": [0] * (len(WAIT_BUCKETS) + 1)}
+                             for lane in LANE_PRIORITIES}
+        
+        self.state_file = state_file
+        self._load_state()
+        self.shared_usage = shared_usage
+        
     def _clean_old_requests(self):
         """清理過期的請求歷史"""
         now = datetime.now()
@@ -57,66 +284,496 @@ class RateLimiter:
             self._minute_count -= 1
             
         # 清理一天前的請求
-        while self.daily_requests and (now - self.daily_requests[0]).total_seconds() > 86400:
-            self.daily_requests.popleft()
+        while self.daily_requests and (now - self.daily_requests[0][0]).total_seconds() > 86400:
+            _, lane = self.daily_requests.popleft()
             self._daily_count -= 1
+            self._lane_daily_counts[lane] -= 1
             
         # 檢查是否需要重置每日計數器
         if now >= self._reset_time:
             logger.info("重置每日 API 請求計數器")
             self._daily_count = 0
             self.daily_requests.clear()
+            self._lane_daily_counts = {lane: 0 for lane in LANE_PRIORITIES}
+            # 每日上限以加法方式回升，逐步試探真正的配額
+            if self.effective_daily < self.requests_per_day * 2:
+                step = max(1, int(self.requests_per_day * AIMD_DAILY_INCREASE))
+                self.effective_daily = min(self.effective_daily + step, self.requests_per_day * 2)
+                self._save_state(force=True)
             # 設定下一個重置時間
             self._reset_time = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        
+        # 使用共用用量時，每日計數以共用的紀錄為準（包含其他程序的用量）
+        if self.shared_usage is not None:
+            try:
+                self._apply_shared_counts(self.shared_usage.counts(_usage_day()))
+            except sqlite3.Error as e:
+                logger.warning(f"讀取共用每日用量失敗，暫時使用本程序的計數: {str(e)}")
+    
+    def _apply_shared_counts(self, counts):
+        """以共用用量覆蓋本程序的每日計數（需在持有鎖時呼叫）"""
+        self._lane_daily_counts = {lane: counts.get(lane, 0) for lane in LANE_PRIORITIES}
+        self._daily_count = sum(self._lane_daily_counts.values())
+    
+    def _commit_daily(self, lane):
+        """
+        計入一次每日用量（需在持有鎖時呼叫）
+        
+        使用共用用量時，在同一個交易中確認仍有額度，避免多個程序同時用掉最後的額度
+        
+        返回:
+            bool: 是否計入（False 表示每日配額已被其他程序用完）
+        """
+        if self.shared_usage is not None:
+            def allow(counts):
+                self._apply_shared_counts(counts)
+                return self._has_daily_budget(lane)
+            try:
+                acquired, counts = self.shared_usage.try_acquire(_usage_day(), lane, allow)
+                self._apply_shared_counts(counts)
+                return acquired
+            except sqlite3.Error as e:
+                logger.warning(f"寫入共用每日用量失敗，只計入本程序: {str(e)}")
+        self._daily_count += 1
+        self._lane_daily_counts[lane] += 1
+        return True
+    
+    def _rpm_limit(self):
+        """目前生效的每分鐘請求上限（整數）"""
+        return max(int(self.effective_rpm), self.min_requests_per_minute)
+    
+    def _load_state(self):
+        """從狀態檔載入先前學習到的速率"""
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            rpm = float(state.get("effective_rpm", self.effective_rpm))
+            self.effective_rpm = min(max(rpm, self.min_requests_per_minute), self.max_requests_per_minute)
+            daily = int(state.get("effective_daily", self.effective_daily))
+            self.effective_daily = min(max(daily, 1), self.requests_per_day * 2)
+            logger.info(f"載入自適應限流狀態: 每分鐘 {self.effective_rpm:.1f}, 每日 {self.effective_daily}")
+        except Exception as e:
+            logger.warning(f"載入自適應限流狀態失敗: {str(e)}")
+    
+    def _save_state(self, force=False):
+        """保存目前學習到的速率（需在持有鎖時呼叫）"""
+        if not self.state_file:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_save < AIMD_SAVE_INTERVAL:
+            return
+        self._last_save = now
+        state = {
+            "effective_rpm": round(self.effective_rpm, 2),
+            "effective_daily": self.effective_daily,
+            "updated_at": datetime.now().isoformat(),
+        }
+        try:
+            os.makedirs(os.path.dirname(self.state_file) or ".", exist_ok=True)
+            tmp_file = f"{self.state_file}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(tmp_file, self.state_file)
+        except Exception as e:
+            logger.warning(f"保存自適應限流狀態失敗: {str(e)}")
+    
+    def _record_event(self, lane, outcome, waited):
+        """記錄一次 wait_if_needed 的結果（需在持有鎖時呼叫）"""
+        now = time.monotonic()
+        self._events.append((now, lane, outcome, waited))
+        while self._events and now - self._events[0][0] > STATS_WINDOW_SECONDS:
+            self._events.popleft()
+        
+        self._totals[lane][outcome] += 1
+        if outcome == OUTCOME_ACQUIRED:
+            wait_totals = self._wait_totals[lane]
+            wait_totals["sum"] += waited
+            wait_totals["buckets"][_bucket_index(waited)] += 1
+    
+    def _resolve_lane(self, lane):
+        """將未知的通道名稱歸入 chat 通道"""
+        if lane not in LANE_PRIORITIES:
+            logger.warning(f"未知的流量通道 '{lane}'，改用 {LANE_CHAT}")
+            return LANE_CHAT
+        return lane
+    
+    def _reserved_above(self, lane):
+        """計算優先級高於指定通道、且尚未用完的保留配額總數"""
+        priority = LANE_PRIORITIES[lane]
+        reserved = 0
+        for other, other_priority in LANE_PRIORITIES.items():
+            if other_priority < priority:
+                reserve = int(self.effective_daily * self.lane_reserves.get(other, 0))
+                reserved += max(0, reserve - self._lane_daily_counts[other])
+        return reserved
+    
+    def _has_daily_budget(self, lane):
+        """檢查指定通道是否還能使用每日配額（不可動用高優先級通道的保留額度）"""
+        remaining = self.effective_daily - self._daily_count
+        return remaining > self._reserved_above(lane)
+    
+    def _higher_priority_waiting(self, lane):
+        """檢查是否有更高優先級的通道正在等待每分鐘配額"""
+        priority = LANE_PRIORITIES[lane]
+        return any(count > 0 for other, count in self._lane_waiting.items()
+                   if LANE_PRIORITIES[other] < priority)
     
-    def wait_if_needed(self):
+    def wait_if_needed(self, lane=LANE_CHAT):
         """
         檢查是否需要等待，並在必要時等待
         
+        參數:
+            lane: 流量通道 (broadcast/chat/classification/background)
+        
         返回:
             True 如果可以繼續請求
-            False 如果已達到每日限制
+            False 如果已達到每日限制、或該通道的請求被淘汰
         """
-        with self._lock:
+        lane = self._resolve_lane(lane)
+        max_wait = self.lane_max_wait.get(lane)
+        started = time.monotonic()
+        deadline = started + max_wait if max_wait is not None else None
+        
+        with self._cond:
             self._clean_old_requests()
             
-            # 檢查每日請求限制
-            if self._daily_count >= self.requests_per_day:
-                logger.warning(f"已達到每日請求限制 ({self.requests_per_day})，請求被拒絕")
+            # 檢查每日請求限制（含高優先級通道的保留額度）
+            if not self._has_daily_budget(lane):
+                logger.warning(f"[{lane}] 每日配額不足 ({self._daily_count}/{self.effective_daily})，請求被拒絕")
+                self._record_event(lane, OUTCOME_REJECTED_DAILY, 0.0)
                 return False
-                
-            # 檢查每分鐘請求限制
-            while self._minute_count >= self.requests_per_minute:
-                oldest = self.minute_requests[0]
-                now = datetime.now()
-                # 計算需要等待的時間
-                time_passed = (now - oldest).total_seconds()
-                if time_passed < 60:
-                    wait_time = 61 - time_passed  # 多等 1 秒以確保安全
-                    logger.info(f"已達到每分鐘請求限制，等待 {wait_time:.1f} 秒")
-                    # 釋放鎖，等待後重新獲取
-                    self._lock.release()
-                    time.sleep(wait_time)
-                    self._lock.acquire()
-                    self._clean_old_requests()
-                else:
-                    # 如果最舊的請求已經超過一分鐘，應該已經被 _clean_old_requests 清理
-                    # 但以防萬一，我們再次檢查
+            
+            # 檢查每分鐘請求限制，較高優先級的通道優先取得下一個名額
+            self._lane_waiting[lane] += 1
+            try:
+                while (self._minute_count >= self._rpm_limit() or
+                       time.monotonic() < self._blocked_until or
+                       self._higher_priority_waiting(lane)):
+                    if time.monotonic() < self._blocked_until:
+                        # 遵守伺服器建議的重試時間
+                        wait_time = self._blocked_until - time.monotonic()
+                    elif self._minute_count >= self._rpm_limit():
+                        oldest = self.minute_requests[0]
+                        time_passed = (datetime.now() - oldest).total_seconds()
+                        wait_time = max(61 - time_passed, 0.1)  # 多等 1 秒以確保安全
+                    else:
+                        # 讓高優先級通道先取得名額，取得後會喚醒其他等待者
+                        wait_time = 1
+                    
+                    if deadline is not None:
+                        remaining_wait = deadline - time.monotonic()
+                        if remaining_wait <= 0:
+                            logger.info(f"[{lane}] 等待每分鐘配額逾時，請求被淘汰")
+                            self._record_event(lane, OUTCOME_REJECTED_TIMEOUT, time.monotonic() - started)
+                            return False
+                        wait_time = min(wait_time, remaining_wait)
+                    
+                    logger.info(f"[{lane}] 已達到每分鐘請求限制，等待 {wait_time:.1f} 秒")
+                    # 等待期間釋放鎖
+                    self._cond.wait(wait_time)
                     self._clean_old_requests()
-                    break
+                    
+                    if not self._has_daily_budget(lane):
+                        logger.warning(f"[{lane}] 等待期間每日配額已不足，請求被拒絕")
+                        self._record_event(lane, OUTCOME_REJECTED_DAILY, time.monotonic() - started)
+                        return False
+            finally:
+                self._lane_waiting[lane] -= 1
             
             # 記錄新請求
+            if not self._commit_daily(lane):
+                logger.warning(f"[{lane}] 每日配額已被其他程序用完，請求被拒絕")
+                self._record_event(lane, OUTCOME_REJECTED_DAILY, time.monotonic() - started)
+                return False
             now = datetime.now()
             self.minute_requests.append(now)
-            self.daily_requests.append(now)
+            self.daily_requests.append((now, lane))
             self._minute_count += 1
-            self._daily_count += 1
+            self._record_event(lane, OUTCOME_ACQUIRED, time.monotonic() - started)
+            self._cond.notify_all()
             
-            logger.info(f"API 請求計數: 每分鐘 {self._minute_count}/{self.requests_per_minute}, 每日 {self._daily_count}/{self.requests_per_day}")
+            logger.debug(f"API 請求計數 [{lane}]: 每分鐘 {self._minute_count}/{self._rpm_limit()}, 每日 {self._daily_count}/{self.effective_daily}")
             
             return True
     
-    def execute_with_rate_limit(self, func, *args, max_retries=3, **kwargs):
+    def get_lane_usage(self):
+        """
+        獲取各通道的每日使用情況
+        
+        返回:
+            dict: 每個通道的已用數量、保留額度與是否仍可使用
+        """
+        with self._lock:
+            self._clean_old_requests()
+            return {
+                lane: {
+                    "used_today": self._lane_daily_counts[lane],
+                    "reserved": int(self.effective_daily * self.lane_reserves.get(lane, 0)),
+                    "available": self._has_daily_budget(lane),
+                }
+                for lane in LANE_PRIORITIES
+            }
+    
+    def get_remaining_ratio(self):
+        """
+        獲取剩餘每日配額比例
+        
+        返回:
+            float: 0.0 ~ 1.0 之間的剩餘比例
+        """
+        with self._lock:
+            self._clean_old_requests()
+            if self.effective_daily <= 0:
+                return 0.0
+            remaining = max(self.effective_daily - self._daily_count, 0)
+            return remaining / self.effective_daily
+    
+    def record_quota_error(self, error_message=None):
+        """
+        記錄一次配額限制錯誤 (429)，並以乘法方式調降速率
+        
+        參數:
+            error_message: 429 的錯誤訊息，用於解析建議的重試時間及判斷是否為每日配額
+        """
+        retry_hint = parse_retry_delay(error_message)
+        daily = is_daily_quota_error(error_message)
+        
+        with self._cond:
+            now = time.monotonic()
+            self._quota_errors.append(datetime.now())
+            self._total_429 += 1
+            # 只保留最近一小時的記錄
+            cutoff = datetime.now() - timedelta(hours=1)
+            while self._quota_errors and self._quota_errors[0] < cutoff:
+                self._quota_errors.popleft()
+            
+            if retry_hint:
+                self._blocked_until = max(self._blocked_until, now + retry_hint)
+            
+            if daily:
+                # 每日配額已被伺服器判定用盡，以目前的用量作為新的每日上限
+                # （設有下限，避免剛重啟、計數偏低時學到過小的值）
+                learned = max(self._daily_count, int(self.requests_per_day * AIMD_DAILY_FLOOR), 1)
+                if learned < self.effective_daily:
+                    logger.warning(f"學習到每日配額上限: {self.effective_daily} -> {learned}")
+                    self.effective_daily = learned
+                    self._save_state(force=True)
+            elif now - self._last_decrease >= AIMD_DECREASE_COOLDOWN:
+                old_rpm = self.effective_rpm
+                self.effective_rpm = max(self.effective_rpm * AIMD_DECREASE_FACTOR,
+                                         float(self.min_requests_per_minute))
+                self._last_decrease = now
+                logger.warning(f"遇到 429，每分鐘速率調降: {old_rpm:.1f} -> {self.effective_rpm:.1f}"
+                               + (f"，{retry_hint:.0f} 秒內暫停請求" if retry_hint else ""))
+                self._save_state(force=True)
+    
+    def record_success(self):
+        """記錄一次成功的 API 呼叫，以加法方式緩慢回升每分鐘速率（約每個速率窗口 +1）"""
+        with self._cond:
+            if self.effective_rpm >= self.max_requests_per_minute:
+                return
+            self.effective_rpm = min(self.effective_rpm + 1.0 / max(self.effective_rpm, 1.0),
+                                     float(self.max_requests_per_minute))
+            self._save_state()
+    
+    def get_effective_limits(self):
+        """
+        獲取目前生效的自適應限制
+        
+        返回:
+            dict: 配置值、目前生效的速率與學習狀態
+        """
+        with self._lock:
+            self._clean_old_requests()
+            return {
+                "configured_rpm": self.requests_per_minute,
+                "configured_daily": self.requests_per_day,
+                "effective_rpm": round(self.effective_rpm, 2),
+                "effective_daily": self.effective_daily,
+                "rpm_bounds": [self.min_requests_per_minute, self.max_requests_per_minute],
+                "used_this_minute": self._minute_count,
+                "used_today": self._daily_count,
+                "blocked_for_seconds": round(max(self._blocked_until - time.monotonic(), 0), 1),
+                "total_429": self._total_429,
+            }
+    
+    def count_recent_quota_errors(self, window_seconds=300):
+        """
+        計算最近一段時間內的配額限制錯誤次數
+        
+        參數:
+            window_seconds: 統計的時間範圍（秒）
+        
+        返回:
+            int: 錯誤次數
+        """
+        cutoff = datetime.now() - timedelta(seconds=window_seconds)
+        with self._lock:
+            return sum(1 for t in self._quota_errors if t >= cutoff)
+    
+    def _forecast(self):
+        """
+        依最近的請求速率預測每日配額（整體及各通道可用額度）何時用盡（需在持有鎖時呼叫）
+        
+        返回:
+            dict: 預測結果
+        """
+        now = datetime.now()
+        window_start = now - timedelta(seconds=FORECAST_WINDOW_SECONDS)
+        recent = sum(1 for t, _ in self.daily_requests if t >= window_start)
+        # 啟動未滿一個窗口時，以實際經過的時間計算速率
+        oldest = self.daily_requests[0][0] if self.daily_requests else now
+        span = min(max((now - oldest).total_seconds(), 60), FORECAST_WINDOW_SECONDS)
+        rate_per_second = recent / span if recent else 0.0
+        seconds_to_reset = max((self._reset_time - now).total_seconds(), 0)
+        
+        def eta(remaining):
+            if remaining <= 0:
+                return 0.0
+            if rate_per_second <= 0:
+                return None
+            return remaining / rate_per_second
+        
+        remaining = max(self.effective_daily - self._daily_count, 0)
+        exhausts_in = eta(remaining)
+        lanes = {}
+        for lane in LANE_PRIORITIES:
+            lane_remaining = max(remaining - self._reserved_above(lane), 0)
+            lane_eta = eta(lane_remaining)
+            lanes[lane] = {
+                "remaining": lane_remaining,
+                "exhausts_in_seconds": round(lane_eta, 1) if lane_eta is not None else None,
+                "exhausts_before_reset": lane_eta is not None and lane_eta < seconds_to_reset,
+            }
+        
+        return {
+            "remaining": remaining,
+            "rate_per_hour": round(rate_per_second * 3600, 2),
+            "exhausts_in_seconds": round(exhausts_in, 1) if exhausts_in is not None else None,
+            "exhausts_at": (now + timedelta(seconds=exhausts_in)).isoformat() if exhausts_in is not None else None,
+            "exhausts_before_reset": exhausts_in is not None and exhausts_in < seconds_to_reset,
+            "reset_at": self._reset_time.isoformat(),
+            "lanes": lanes,
+        }
+    
+    def get_stats(self):
+        """
+        獲取限制器遙測資料：各通道最近一小時的請求、等待與拒絕統計，以及每日配額預測
+        
+        返回:
+            dict: 可直接序列化為 JSON 的統計資料
+        """
+        with self._lock:
+            self._clean_old_requests()
+            now = time.monotonic()
+            while self._events and now - self._events[0][0] > STATS_WINDOW_SECONDS:
+                self._events.popleft()
+            
+            lanes = {}
+            for lane in LANE_PRIORITIES:
+                counts = {outcome: 0 for outcome in OUTCOMES}
+                buckets = [0] * (len(WAIT_BUCKETS) + 1)
+                waits = []
+                for _, event_lane, outcome, waited in self._events:
+                    if event_lane != lane:
+                        continue
+                    counts[outcome] += 1
+                    if outcome == OUTCOME_ACQUIRED:
+                        buckets[_bucket_index(waited)] += 1
+                        waits.append(waited)
+                waits.sort()
+                lanes[lane] = {
+                    "window": counts,
+                    "wait_seconds": {
+                        "buckets": {_bucket_label(i): n for i, n in enumerate(buckets)},
+                        "p50": round(_percentile(waits, 0.5), 3),
+                        "p95": round(_percentile(waits, 0.95), 3),
+                        "max": round(waits[-1], 3) if waits else 0.0,
+                    },
+                    "totals": dict(self._totals[lane]),
+                    "used_today": self._lane_daily_counts[lane],
+                    "waiting": self._lane_waiting[lane],
+                }
+            
+            return {
+                "window_seconds": STATS_WINDOW_SECONDS,
+                "limits": {
+                    "effective_rpm": round(self.effective_rpm, 2),
+                    "effective_daily": self.effective_daily,
+                    "used_this_minute": self._minute_count,
+                    "used_today": self._daily_count,
+                },
+                "lanes": lanes,
+                "forecast": self._forecast(),
+                "total_429": self._total_429,
+            }
+    
+    def render_prometheus(self, prefix="gemini_limiter"):
+        """
+        以 Prometheus 文字格式輸出限制器指標
+        
+        參數:
+            prefix: 指標名稱前綴
+        
+        返回:
+            str: Prometheus exposition 格式的文字
+        """
+        with self._lock:
+            self._clean_old_requests()
+            totals = {lane: dict(counts) for lane, counts in self._totals.items()}
+            wait_totals = {lane: {"sum": data["sum"], "buckets": list(data["buckets"])}
+                           for lane, data in self._wait_totals.items()}
+            forecast = self._forecast()
+            lane_used = dict(self._lane_daily_counts)
+            lane_waiting = dict(self._lane_waiting)
+            gauges = {
+                "effective_rpm": self.effective_rpm,
+                "effective_daily": self.effective_daily,
+                "used_this_minute": self._minute_count,
+                "used_today": self._daily_count,
+                "quota_errors_total": self._total_429,
+            }
+        
+        lines = [f"# TYPE {prefix}_requests_total counter"]
+        for lane, counts in totals.items():
+            for outcome, value in counts.items():
+                lines.append(f'{prefix}_requests_total{{lane="{lane}",outcome="{outcome}"}} {value}')
+        
+        lines.append(f"# TYPE {prefix}_wait_seconds histogram")
+        for lane, data in wait_totals.items():
+            cumulative = 0
+            for i, count in enumerate(data["buckets"]):
+                cumulative += count
+                le = "+Inf" if i == len(WAIT_BUCKETS) else str(WAIT_BUCKETS[i])
+                lines.append(f'{prefix}_wait_seconds_bucket{{lane="{lane}",le="{le}"}} {cumulative}')
+            lines.append(f'{prefix}_wait_seconds_sum{{lane="{lane}"}} {data["sum"]:.6f}')
+            lines.append(f'{prefix}_wait_seconds_count{{lane="{lane}"}} {cumulative}')
+        
+        lines.append(f"# TYPE {prefix}_lane_used_today gauge")
+        for lane, value in lane_used.items():
+            lines.append(f'{prefix}_lane_used_today{{lane="{lane}"}} {value}')
+        lines.append(f"# TYPE {prefix}_lane_waiting gauge")
+        for lane, value in lane_waiting.items():
+            lines.append(f'{prefix}_lane_waiting{{lane="{lane}"}} {value}')
+        
+        for name, value in gauges.items():
+            metric_type = "counter" if name.endswith("_total") else "gauge"
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            lines.append(f"{prefix}_{name} {value}")
+        
+        lines.append(f"# TYPE {prefix}_forecast_exhausts_in_seconds gauge")
+        for lane, data in forecast["lanes"].items():
+            # 目前沒有流量時無法預測，以 -1 表示
+            value = data["exhausts_in_seconds"] if data["exhausts_in_seconds"] is not None else -1
+            lines.append(f'{prefix}_forecast_exhausts_in_seconds{{lane="{lane}"}} {value}')
+        lines.append(f"# TYPE {prefix}_forecast_rate_per_hour gauge")
+        lines.append(f"{prefix}_forecast_rate_per_hour {forecast['rate_per_hour']}")
+        
+        return "\n".join(lines) + "\n"
+    
+    def execute_with_rate_limit(self, func, *args, max_retries=3, lane=LANE_CHAT, **kwargs):
         """
         執行函數，並在必要時進行重試和限流
         
@@ -124,6 +781,7 @@ class RateLimiter:
             func: 要執行的函數
             *args, **kwargs: 傳給函數的參數
             max_retries: 最大重試次數
+            lane: 流量通道，決定優先級與可用的保留配額
         
         返回:
             函數的執行結果
@@ -132,30 +790,26 @@ class RateLimiter:
         last_error = None
         
         while retry_count <= max_retries:
-            if not self.wait_if_needed():
+            if not self.wait_if_needed(lane=lane):
                 return None, "已達到每日 API 請求限制，請明天再試"
             
             try:
                 result = func(*args, **kwargs)
+                self.record_success()
                 return result, None
             except Exception as e:
                 last_error = e
                 logger.error(f"API 呼叫失敗 (嘗試 {retry_count + 1}/{max_retries + 1}): {str(e)}")
                 
                 if "429" in str(e) and "quota" in str(e).lower():
-                    # 配額限制錯誤，等待後重試
-                    retry_delay = self.retry_after
-                    # 嘗試從錯誤中提取建議的等待時間
-                    try:
-                        import re
-                        match = re.search(r'retry_delay\s*{\s*seconds:\s*(\d+)\s*}', str(e))
-                        if match:
-                            retry_delay = int(match.group(1))
-                    except:
-                        pass
-                    
-                    logger.info(f"遇到配額限制，等待 {retry_delay} 秒後重試...")
-                    time.sleep(retry_delay)
+                    # 配額限制錯誤：調降速率並記錄伺服器建議的等待時間，
+                    # 下一次 wait_if_needed 會等到暫停結束後再送出請求
+                    self.record_quota_error(str(e))
+                    if is_daily_quota_error(str(e)):
+                        return None, str(e)
+                    if parse_retry_delay(str(e)) is None:
+                        logger.info(f"遇到配額限制，等待 {self.retry_after} 秒後重試...")
+                        time.sleep(self.retry_after)
                     retry_count += 1
                 else:
                     # 非配額限制錯誤，直接返回錯誤
@@ -164,9 +818,25 @@ class RateLimiter:
         # 如果所有重試都失敗，返回最後一個錯誤
         return None, f"在 {max_retries + 1} 次嘗試後仍然失敗: {str(last_error)}"
 
+def _create_shared_usage():
+    """依環境變數建立共用的每日用量（GEMINI_USAGE_DB 設為空字串時只計算本程序的用量）"""
+    db_path = os.getenv("GEMINI_USAGE_DB", os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.cache', 'rate_limiter', 'usage.db'))
+    if not db_path:
+        return None
+    try:
+        return SharedDailyUsage(db_path)
+    except sqlite3.Error as e:
+        logger.warning(f"無法開啟共用每日用量資料庫，改為只計算本程序的用量: {str(e)}")
+        return None
+
 # 全域流量限制器實例 - 調整限制以適應實際使用情況
+# 以下為起始值，實際速率會依 429 回應自適應調整並保存在 .cache/rate_limiter/
 gemini_limiter = RateLimiter(
     requests_per_minute=10,  # 提高每分鐘請求數限制
     requests_per_day=100,    # 提高每日請求數限制
-    retry_after=30          # 減少重試間隔
+    retry_after=30,         # 減少重試間隔
+    state_file=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            '.cache', 'rate_limiter', 'gemini_state.json'),
+    shared_usage=_create_shared_usage()
 )
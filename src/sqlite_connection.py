@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+SQLite 連線模組
+待辦事項、對話歷史、對話紀錄索引、事件佇列、推送佇列與用量統計共用的連線取得方式：
+
+- 每個執行緒各自一條連線（sqlite3 連線不能跨執行緒共用）
+- 記錄建立連線的程序：gunicorn fork 之後子程序第一次使用時重新連線，不會沿用父程序的連線
+- WAL 模式搭配 synchronous=NORMAL：讀取不會被寫入阻塞，每次提交不需要 fsync
+- autocommit（isolation_level=None），需要時由呼叫端自行 BEGIN IMMEDIATE
+"""
+
+import os
+import sqlite3
+import threading
+
+
+class ThreadLocalConnection:
+    """依執行緒與程序分配的 SQLite 連線，呼叫實例即取得目前執行緒的連線"""
+
+    def __init__(self, db_path, timeout=30, row_factory=None):
+        """
+        參數:
+            db_path: SQLite 檔案路徑
+            timeout: 等待其他連線釋放寫入鎖的秒數
+            row_factory: 查詢結果的列型別（例如 sqlite3.Row），None 表示 tuple
+        """
+        self.db_path = db_path
+        self.timeout = timeout
+        self.row_factory = row_factory
+        self._local = threading.local()
+
+    def __call__(self):
+        """取得目前執行緒的連線（每個執行緒、每個程序各自一條）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+            if self.row_factory is not None:
+                conn.row_factory = self.row_factory
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
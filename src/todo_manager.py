@@ -2,61 +2,143 @@
 """
 待辦事項管理模組
 支援新增、查詢、更新和刪除待辦事項
+
+待辦事項存放在 SQLite (WAL)，以 (user_id, status, due_date, created_at) 建立索引，
+新增、更新與刪除都只影響相關的資料列；內容關鍵字以 FTS5 trigram 索引比對。
+舊版每位用戶一個的 <user>_todos.json 會在初始化時匯入資料庫
 """
 
 import os
+import glob
 import json
+import sqlite3
 import logging
 from typing import List, Dict, Optional
 from datetime import datetime, timedelta
 import re
 
+# 導入共用的 SQLite 連線（每個執行緒、每個程序各自一條）
+try:
+    from src.sqlite_connection import ThreadLocalConnection
+except ImportError:
+    from sqlite_connection import ThreadLocalConnection
+
 logger = logging.getLogger(__name__)
 
+TODO_COLUMNS = ("id", "content", "status", "created_at", "due_date", "completed_at")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS todos (
+    id TEXT NOT NULL UNIQUE,
+    user_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    due_date TEXT,
+    completed_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_todos_user_status ON todos (user_id, status, due_date, created_at);
+CREATE INDEX IF NOT EXISTS idx_todos_user_created ON todos (user_id, created_at);
+"""
+
+# 內容的全文索引（trigram 可以比對任意位置的中文子字串，區分大小寫與原本的 in 比對一致），以觸發器與 todos 表同步
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS todos_fts USING fts5(
+    content, content='todos', content_rowid='rowid', tokenize='trigram case_sensitive 1'
+);
+CREATE TRIGGER IF NOT EXISTS todos_fts_insert AFTER INSERT ON todos BEGIN
+    INSERT INTO todos_fts (rowid, content) VALUES (new.rowid, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS todos_fts_delete AFTER DELETE ON todos BEGIN
+    INSERT INTO todos_fts (todos_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+END;
+CREATE TRIGGER IF NOT EXISTS todos_fts_update AFTER UPDATE OF content ON todos BEGIN
+    INSERT INTO todos_fts (todos_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+    INSERT INTO todos_fts (rowid, content) VALUES (new.rowid, new.content);
+END;
+"""
+
+# trigram 索引只能比對至少三個字的關鍵字，較短的關鍵字改以 instr 比對（範圍已由索引限縮到該用戶）
+FTS_MIN_KEYWORD_CHARS = 3
+
 
 class TodoManager:
     """待辦事項管理器"""
     
-    def __init__(self, storage_dir: str = ".cache/todos"):
+    def __init__(self, storage_dir: str = ".cache/todos", db_path: Optional[str] = None):
         """
         初始化待辦事項管理器
         
         Args:
-            storage_dir: 待辦事項儲存目錄
+            storage_dir: 待辦事項儲存目錄（舊版 JSON 檔案也從這裡匯入）
+            db_path: SQLite 檔案路徑，預設為 storage_dir/todos.db
         """
         self.storage_dir = storage_dir
+        self.db_path = db_path or os.path.join(storage_dir, "todos.db")
+        self._connect = ThreadLocalConnection(self.db_path, row_factory=sqlite3.Row)
         os.makedirs(storage_dir, exist_ok=True)
-        logger.info(f"待辦事項管理器已初始化，儲存目錄: {storage_dir}")
-    
+        
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        try:
+            conn.executescript(FTS_SCHEMA)
+            self.fts_enabled = True
+        except sqlite3.OperationalError as e:
+            # 舊版 SQLite 沒有 FTS5 或 trigram tokenizer 時，關鍵字一律以 instr 比對
+            self.fts_enabled = False
+            logger.warning(f"無法建立待辦事項全文索引，改用逐筆比對: {e}")
+        self._import_json_files()
+        logger.info(f"待辦事項管理器已初始化，資料庫: {self.db_path}")
+        
     def _get_user_file(self, user_id: str) -> str:
-        """獲取用戶待辦事項檔案路徑"""
+        """獲取用戶舊版待辦事項 JSON 檔案路徑"""
         return os.path.join(self.storage_dir, f"{user_id}_todos.json")
     
+    def _import_json_files(self):
+        """把舊版的 <user>_todos.json 匯入資料庫，完成後改名為 .migrated 避免重複匯入"""
+        conn = self._connect()
+        for file_path in glob.glob(os.path.join(self.storage_dir, "*_todos.json")):
+            user_id = os.path.basename(file_path)[:-len("_todos.json")]
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    todos = json.load(f)
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(
+                    "INSERT OR IGNORE INTO todos (id, user_id, content, status, created_at, due_date, completed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(t["id"], user_id, t["content"], t["status"], t["created_at"],
+                      t.get("due_date"), t.get("completed_at")) for t in todos]
+                )
+                conn.execute("COMMIT")
+                os.replace(file_path, file_path + ".migrated")
+                logger.info(f"已匯入舊版待辦事項: user_id={user_id}, count={len(todos)}")
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                logger.error(f"匯入舊版待辦事項失敗: {file_path}: {e}")
+    
+    @staticmethod
+    def _row_to_todo(row: sqlite3.Row) -> Dict:
+        """資料列轉換為與舊版 JSON 相同格式的 dict"""
+        return {column: row[column] for column in TODO_COLUMNS}
+    
     def _load_todos(self, user_id: str) -> List[Dict]:
-        """載入用戶的待辦事項"""
-        file_path = self._get_user_file(user_id)
-        
-        if not os.path.exists(file_path):
-            return []
-        
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"載入待辦事項失敗: {e}")
-            return []
+        """載入用戶的所有待辦事項（依新增順序）"""
+        rows = self._connect().execute(
+            "SELECT * FROM todos WHERE user_id = ? ORDER BY rowid", (user_id,)
+        )
+        return [self._row_to_todo(row) for row in rows]
     
-    def _save_todos(self, user_id: str, todos: List[Dict]) -> bool:
-        """儲存用戶的待辦事項"""
-        file_path = self._get_user_file(user_id)
+    def _keyword_condition(self, content_keyword: str):
+        """
+        返回比對內容關鍵字的 SQL 條件與參數
         
-        try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(todos, f, ensure_ascii=False, indent=2)
-            return True
-        except Exception as e:
-            logger.error(f"儲存待辦事項失敗: {e}")
-            return False
+        關鍵字夠長時使用 trigram 全文索引，否則以 instr 比對
+        """
+        if self.fts_enabled and len(content_keyword) >= FTS_MIN_KEYWORD_CHARS:
+            phrase = '"' + content_keyword.replace('"', '""') + '"'
+            return "rowid IN (SELECT rowid FROM todos_fts WHERE todos_fts MATCH ?)", [phrase]
+        return "instr(content, ?) > 0", [content_keyword]
     
     def create_todo(self, user_id: str, content: str, due_date: Optional[str] = None) -> Dict:
         """
@@ -70,43 +152,48 @@ class TodoManager:
         Returns:
             Dict: 新增結果
         """
-        todos = self._load_todos(user_id)
+        conn = self._connect()
         
         # 檢查是否有重複的待辦（5分鐘內創建的相同內容）
         now = datetime.now()
-        for todo in todos:
-            if todo["status"] == "pending" and todo["content"] == content:
-                # 檢查創建時間
-                try:
-                    created_at = datetime.fromisoformat(todo["created_at"])
-                    time_diff = (now - created_at).total_seconds()
-                    
-                    # 如果 5 分鐘內已有相同待辦，返回現有的而非創建新的
-                    if time_diff < 300:  # 5分鐘 = 300秒
-                        logger.info(f"待辦事項已存在（5分鐘內創建），跳過重複創建: user_id={user_id}, content='{content}'")
-                        return {"success": True, "todo": todo, "isDuplicate": True}
-                except:
-                    pass
+        try:
+            duplicate = conn.execute(
+                "SELECT * FROM todos WHERE user_id = ? AND status = 'pending' AND content = ? AND created_at > ? "
+                "ORDER BY rowid LIMIT 1",
+                (user_id, content, (now - timedelta(seconds=300)).isoformat())
+            ).fetchone()
+        except Exception as e:
+            logger.error(f"查詢重複待辦事項失敗: {e}")
+            duplicate = None
+        if duplicate:
+            logger.info(f"待辦事項已存在（5分鐘內創建），跳過重複創建: user_id={user_id}, content='{content}'")
+            return {"success": True, "todo": self._row_to_todo(duplicate), "isDuplicate": True}
         
         # 解析可能的時間資訊
         parsed_due_date = self._parse_due_date(content, due_date)
         
-        new_todo = {
-            "id": f"todo_{len(todos) + 1}_{datetime.now().timestamp()}",
-            "content": content,
-            "status": "pending",
-            "created_at": datetime.now().isoformat(),
-            "due_date": parsed_due_date,
-            "completed_at": None
-        }
-        
-        todos.append(new_todo)
-        
-        if self._save_todos(user_id, todos):
-            logger.info(f"待辦事項新增成功: user_id={user_id}, content='{content}'")
-            return {"success": True, "todo": new_todo}
-        else:
+        try:
+            count = conn.execute("SELECT COUNT(*) FROM todos WHERE user_id = ?", (user_id,)).fetchone()[0]
+            new_todo = {
+                "id": f"todo_{count + 1}_{datetime.now().timestamp()}",
+                "content": content,
+                "status": "pending",
+                "created_at": datetime.now().isoformat(),
+                "due_date": parsed_due_date,
+                "completed_at": None
+            }
+            conn.execute(
+                "INSERT INTO todos (id, user_id, content, status, created_at, due_date, completed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (new_todo["id"], user_id, content, new_todo["status"], new_todo["created_at"],
+                 parsed_due_date, None)
+            )
+        except Exception as e:
+            logger.error(f"儲存待辦事項失敗: {e}")
             return {"success": False, "error": "儲存失敗"}
+        
+        logger.info(f"待辦事項新增成功: user_id={user_id}, content='{content}'")
+        return {"success": True, "todo": new_todo}
     
     def _parse_due_date(self, content: str, due_date: Optional[str] = None) -> Optional[str]:
         """
@@ -189,31 +276,32 @@ class TodoManager:
         Returns:
             Dict: 更新結果
         """
-        todos = self._load_todos(user_id)
-        
-        updated_count = 0
+        # 根據 ID 或關鍵字查找待完成的待辦事項
+        conditions, params = [], []
+        if todo_id:
+            conditions.append("id = ?")
+            params.append(todo_id)
+        if content_keyword:
+            condition, keyword_params = self._keyword_condition(content_keyword)
+            conditions.append(condition)
+            params.extend(keyword_params)
+        if not conditions:
+            return {"success": False, "error": "找不到匹配的待辦事項"}
         
-        for todo in todos:
-            # 根據 ID 或關鍵字查找待辦事項
-            match = False
-            
-            if todo_id and todo["id"] == todo_id:
-                match = True
-            elif content_keyword and content_keyword in todo["content"]:
-                match = True
-            
-            if match and todo["status"] == "pending":
-                todo["status"] = status
-                if status == "completed":
-                    todo["completed_at"] = datetime.now().isoformat()
-                updated_count += 1
+        completed_at = datetime.now().isoformat() if status == "completed" else None
+        try:
+            updated_count = self._connect().execute(
+                f"UPDATE todos SET status = ?, completed_at = COALESCE(?, completed_at) "
+                f"WHERE user_id = ? AND status = 'pending' AND ({' OR '.join(conditions)})",
+                [status, completed_at, user_id] + params
+            ).rowcount
+        except Exception as e:
+            logger.error(f"儲存待辦事項失敗: {e}")
+            return {"success": False, "error": "儲存失敗"}
         
         if updated_count > 0:
-            if self._save_todos(user_id, todos):
-                logger.info(f"待辦事項更新成功: user_id={user_id}, updated={updated_count}")
-                return {"success": True, "updated_count": updated_count}
-            else:
-                return {"success": False, "error": "儲存失敗"}
+            logger.info(f"待辦事項更新成功: user_id={user_id}, updated={updated_count}")
+            return {"success": True, "updated_count": updated_count}
         else:
             return {"success": False, "error": "找不到匹配的待辦事項"}
     
@@ -230,20 +318,26 @@ class TodoManager:
         Returns:
             Dict: 查詢結果
         """
-        todos = self._load_todos(user_id)
-        
-        # 過濾條件
-        filtered_todos = todos
+        # 過濾條件（created_at 為 ISO 格式，可以直接以字串比較日期）
+        conditions, params = ["user_id = ?"], [user_id]
         
         if status:
-            filtered_todos = [t for t in filtered_todos if t["status"] == status]
+            conditions.append("status = ?")
+            params.append(status)
         
         if days:
             cutoff_date = (datetime.now() - timedelta(days=days)).date()
-            filtered_todos = [
-                t for t in filtered_todos
-                if datetime.fromisoformat(t["created_at"]).date() >= cutoff_date
-            ]
+            conditions.append("created_at >= ?")
+            params.append(cutoff_date.isoformat())
+        
+        try:
+            rows = self._connect().execute(
+                f"SELECT * FROM todos WHERE {' AND '.join(conditions)} ORDER BY rowid", params
+            )
+            filtered_todos = [self._row_to_todo(row) for row in rows]
+        except Exception as e:
+            logger.error(f"載入待辦事項失敗: {e}")
+            filtered_todos = []
         
         logger.info(f"待辦事項查詢完成: user_id={user_id}, found={len(filtered_todos)}")
         return {"success": True, "todos": filtered_todos, "count": len(filtered_todos)}
@@ -258,21 +352,18 @@ class TodoManager:
         Returns:
             Dict: 完成結果，包含 completed_count
         """
-        todos = self._load_todos(user_id)
-        completed_count = 0
-        
-        for todo in todos:
-            if todo["status"] == "pending":
-                todo["status"] = "completed"
-                todo["completed_at"] = datetime.now().isoformat()
-                completed_count += 1
+        try:
+            completed_count = self._connect().execute(
+                "UPDATE todos SET status = 'completed', completed_at = ? WHERE user_id = ? AND status = 'pending'",
+                (datetime.now().isoformat(), user_id)
+            ).rowcount
+        except Exception as e:
+            logger.error(f"儲存待辦事項失敗: {e}")
+            return {"success": False, "error": "儲存失敗"}
         
         if completed_count > 0:
-            if self._save_todos(user_id, todos):
-                logger.info(f"批量完成待辦事項成功: user_id={user_id}, completed_count={completed_count}")
-                return {"success": True, "completed_count": completed_count}
-            else:
-                return {"success": False, "error": "儲存失敗"}
+            logger.info(f"批量完成待辦事項成功: user_id={user_id}, completed_count={completed_count}")
+            return {"success": True, "completed_count": completed_count}
         else:
             return {"success": True, "completed_count": 0, "message": "沒有待完成的事項"}
     
@@ -286,18 +377,18 @@ class TodoManager:
         Returns:
             Dict: 刪除結果，包含 deleted_count
         """
-        todos = self._load_todos(user_id)
-        pending_todos = [t for t in todos if t["status"] == "pending"]
-        deleted_count = len(pending_todos)
+        # 保留已完成的待辦，刪除待完成的
+        try:
+            deleted_count = self._connect().execute(
+                "DELETE FROM todos WHERE user_id = ? AND status = 'pending'", (user_id,)
+            ).rowcount
+        except Exception as e:
+            logger.error(f"儲存待辦事項失敗: {e}")
+            return {"success": False, "error": "儲存失敗"}
         
         if deleted_count > 0:
-            # 保留已完成的待辦，刪除待完成的
-            filtered_todos = [t for t in todos if t["status"] != "pending"]
-            if self._save_todos(user_id, filtered_todos):
-                logger.info(f"批量刪除待辦事項成功: user_id={user_id}, deleted_count={deleted_count}")
-                return {"success": True, "deleted_count": deleted_count}
-            else:
-                return {"success": False, "error": "儲存失敗"}
+            logger.info(f"批量刪除待辦事項成功: user_id={user_id}, deleted_count={deleted_count}")
+            return {"success": True, "deleted_count": deleted_count}
         else:
             return {"success": True, "deleted_count": 0, "message": "沒有待刪除的事項"}
     
@@ -314,29 +405,26 @@ class TodoManager:
         Returns:
             Dict: 刪除結果，包含 deleted_count
         """
-        todos = self._load_todos(user_id)
-        original_count = len(todos)
-        
         if todo_id:
             # 根據 ID 刪除
-            filtered_todos = [t for t in todos if t["id"] != todo_id]
+            sql, params = "DELETE FROM todos WHERE user_id = ? AND id = ?", [user_id, todo_id]
         elif content_keyword:
             # 根據關鍵字刪除（只刪除待完成的）
-            filtered_todos = [
-                t for t in todos 
-                if not (t["status"] == "pending" and content_keyword in t["content"])
-            ]
+            condition, params = self._keyword_condition(content_keyword)
+            sql = f"DELETE FROM todos WHERE user_id = ? AND status = 'pending' AND {condition}"
+            params = [user_id] + params
         else:
             return {"success": False, "error": "必須提供 todo_id 或 content_keyword"}
         
-        deleted_count = original_count - len(filtered_todos)
+        try:
+            deleted_count = self._connect().execute(sql, params).rowcount
+        except Exception as e:
+            logger.error(f"儲存待辦事項失敗: {e}")
+            return {"success": False, "error": "儲存失敗"}
         
         if deleted_count > 0:
-            if self._save_todos(user_id, filtered_todos):
-                logger.info(f"待辦事項刪除成功: user_id={user_id}, deleted_count={deleted_count}")
-                return {"success": True, "deleted_count": deleted_count}
-            else:
-                return {"success": False, "error": "儲存失敗"}
+            logger.info(f"待辦事項刪除成功: user_id={user_id}, deleted_count={deleted_count}")
+            return {"success": True, "deleted_count": deleted_count}
         else:
             return {"success": False, "error": "找不到指定的待辦事項", "deleted_count": 0}
     
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+觸發詞比對模組
+app.py、line_webhook.py 與花生助手原本各自實作一次前綴偵測（逐一比對關鍵字與前導字符、
+逐字元檢查「花生」），同一則訊息會被掃描好幾次。本模組以一個預先編譯的正規表示式，
+一次比對就得到「是否觸發」、「去除觸發詞後的查詢內容」與「觸發類型」
+
+觸發規則（去除前後空白後比對，全形字元視同半形）：
+- AI 前綴：訊息以 ai:、ai：、@ai、「ai 」開頭，或整則訊息就是 ai（不分大小寫）
+- 關鍵字：訊息以「小幫手」或「花生」開頭，前面可以有一個允許的前導字符（可再接一個空格）
+"""
+
+import re
+import unicodedata
+from collections import namedtuple
+
+# 觸發類型
+KIND_AI_PREFIX = "ai_prefix"
+KIND_KEYWORD = "keyword"
+
+# 觸發關鍵字
+KEYWORDS = ("小幫手", "花生")
+
+# 關鍵字前允許的前導字符
+ALLOWED_PREFIXES = "!！,，。.?？ 　:：@#$%、~～"
+
+# 查詢內容開頭需要去除的分隔符號（例如「花生，明天天氣」中的逗號）
+LEADING_SEPARATORS = "，,。.、:：!！~～ 　"
+
+_TRIGGER_RE = re.compile(
+    r"(?P<ai>ai(?:[:：]|\s|$)|@ai)"
+    r"|(?:[" + re.escape(ALLOWED_PREFIXES) + r"]\s?)?(?P<keyword>" + "|".join(KEYWORDS) + r")",
+    re.IGNORECASE,
+)
+_LEADING_SEPARATORS_RE = re.compile(r"[\s" + re.escape(LEADING_SEPARATORS) + r"]+")
+
+TriggerMatch = namedtuple("TriggerMatch", ["is_trigger", "query", "kind"])
+
+
+def normalize(message):
+    """NFKC 正規化（已是正規形式的訊息直接返回，避免重新配置字串）"""
+    if message.isascii() or unicodedata.is_normalized("NFKC", message):
+        return message
+    return unicodedata.normalize("NFKC", message)
+
+
+def match_trigger(message):
+    """
+    比對訊息開頭的觸發詞
+
+    參數:
+        message: 使用者訊息
+
+    返回:
+        TriggerMatch: (is_trigger, query, kind)
+            is_trigger: 是否為 AI 請求
+            query: 去除觸發詞與開頭分隔符號後的查詢內容（未觸發時為去除開頭分隔符號的原訊息）
+            kind: "ai_prefix"、"keyword" 或 None
+    """
+    if not message:
+        return TriggerMatch(False, "", None)
+
+    # 先比對原訊息，查詢內容才能保留使用者原本的全形標點；
+    # 比對不到時才以 NFKC 正規化後的訊息再比對一次（例如全形的「ＡＩ：」）
+    text = message.strip()
+    match = _TRIGGER_RE.match(text)
+    if match is None:
+        normalized = normalize(text)
+        if normalized is not text:
+            match = _TRIGGER_RE.match(normalized)
+            text = normalized if match else text
+    if match is None:
+        return TriggerMatch(False, _strip_separators(text), None)
+
+    kind = KIND_AI_PREFIX if match.group("ai") else KIND_KEYWORD
+    return TriggerMatch(True, _strip_separators(text[match.end():]), kind)
+
+
+def _strip_separators(text):
+    """去除開頭的分隔符號與空白"""
+    leading = _LEADING_SEPARATORS_RE.match(text)
+    return (text[leading.end():] if leading else text).strip()
+
+
+def is_trigger(message):
+    """訊息是否以觸發詞開頭"""
+    return match_trigger(message).is_trigger
+
+
+def extract_query(message):
+    """去除觸發詞後的查詢內容"""
+    return match_trigger(message).query
+
+
+if __name__ == "__main__":
+    # 微基準測試：與原本逐一比對關鍵字的實作比較（python src/trigger_matcher.py）
+    import timeit
+
+    def legacy_match(message):
+        """原本 is_ai_request + extract_query 的比對方式（不含日誌）"""
+        allowed = list(ALLOWED_PREFIXES)
+        trimmed = unicodedata.normalize("NFKC", message).strip()
+        lower = trimmed.lower()
+        triggered = (lower.startswith(("ai:", "ai：", "@ai", "ai ")) or lower == "ai")
+        if not triggered:
+            for keyword in KEYWORDS:
+                if trimmed.startswith(keyword):
+                    triggered = True
+                    break
+                if len(trimmed) > 1 and trimmed[0] in allowed:
+                    if trimmed[1:].startswith(keyword) or (trimmed[1] == " " and trimmed[2:].startswith(keyword)):
+                        triggered = True
+                        break
+        query = message.strip()
+        for prefix in ["ai:", "ai：", "@ai ", "@ai", "ai "]:
+            if query.lower().startswith(prefix):
+                query = query[len(prefix):]
+                break
+        for keyword in KEYWORDS:
+            if query.startswith(keyword):
+                query = query[len(keyword):]
+                break
+            if len(query) > 1 and query[0] in allowed and query[1:].startswith(keyword):
+                query = query[1 + len(keyword):]
+                break
+        while query and query[0] in LEADING_SEPARATORS:
+            query = query[1:]
+        return triggered, query.strip()
+
+    samples = [
+        "花生，明天台北天氣如何？",
+        "小幫手 幫我記下週一要開會",
+        "AI: 推薦幾本好書",
+        "@ai 今天的天氣如何？",
+        "！花生 你好",
+        ". 小幫手 介紹台灣夜市文化",
+        "今天晚上要吃什麼呢，大家有沒有推薦",
+        "哈哈哈哈哈",
+        "ＡＩ：全形字元的請求",
+        "https://example.com/some/long/link?with=query&and=more",
+    ]
+
+    for sample in samples:
+        new = match_trigger(sample)
+        old = legacy_match(sample)
+        flag = "" if (new.is_trigger, new.query) == old else f"  （原實作: {old}）"
+        print(f"{sample!r:45} -> {new}{flag}")
+
+    number = 20000
+    for name, func in (("原本的逐一比對", legacy_match), ("預先編譯的正規表示式", match_trigger)):
+        seconds = timeit.timeit(lambda: [func(s) for s in samples], number=number)
+        per_message = seconds / (number * len(samples)) * 1e6
+        print(f"{name}: 每則訊息 {per_message:.2f} µs")
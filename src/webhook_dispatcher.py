@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Webhook 事件派送模組
+讓 /callback 在驗證簽名後立即回應 LINE 平台，事件交由有上限的背景工作池處理
+
+事件依排序鍵（使用者 ID，沒有時用群組/聊天室 ID）雜湊到固定的通道，
+每個通道由一個工作執行緒依序處理：同一使用者的事件保持順序，不同使用者則平行處理
+
+通道已滿時，呼叫端會先等待一小段時間；仍然額滿才改由呼叫端（請求執行緒）
+直接處理該事件 (caller-runs)，以自然的方式對 LINE 平台施加背壓，而不是丟棄事件
+"""
+
+import os
+import hmac
+import json
+import time
+import zlib
+import queue
+import base64
+import hashlib
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# 計算佇列等待與處理時間百分位數時保留的樣本數
+SAMPLE_SIZE = 500
+
+# 通道已滿時，呼叫端等待空位的秒數（之後改由呼叫端直接處理）
+DEFAULT_PUT_TIMEOUT = 2
+
+
+def sign_webhook_body(channel_secret, body):
+    """
+    以 channel secret 計算 webhook 請求體的 X-Line-Signature
+
+    參數:
+        channel_secret: LINE channel secret
+        body: 請求體文字
+
+    返回:
+        str: base64 編碼的 HMAC-SHA256 簽名
+    """
+    digest = hmac.new(channel_secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def split_webhook_events(body, event_filter=None):
+    """
+    將 webhook 請求體拆成每個事件各自的請求體，讓事件可以分別排入佇列
+
+    參數:
+        body: 請求體文字
+        event_filter: 接收事件 dict 的函數，返回 False 的事件直接略過（不會產生請求體）
+
+    返回:
+        list: (事件 dict, 只包含該事件的請求體文字) 的列表
+    """
+    payload = json.loads(body)
+    destination = payload.get("destination")
+    return [
+        (event, json.dumps({"destination": destination, "events": [event]}, ensure_ascii=False))
+        for event in payload.get("events", [])
+        if event_filter is None or event_filter(event)
+    ]
+
+
+def event_ordering_key(event):
+    """
+    獲取事件的排序鍵：同一個鍵的事件會依序處理
+
+    參數:
+        event: webhook 事件 dict
+
+    返回:
+        str 或 None
+    """
+    source = event.get("source") or {}
+    return source.get("userId") or source.get("groupId") or source.get("roomId")
+
+
+def _percentile(values, q):
+    """計算數列的百分位數"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class WebhookDispatcher:
+    """
+    依排序鍵分通道的背景工作池
+
+    工作執行緒在第一次送出事件時才啟動，並記錄啟動時的 pid；
+    在 fork 之後（例如 gunicorn preload）子程序會重新建立自己的佇列與執行緒
+    """
+
+    def __init__(self, process_func, workers=4, queue_size=100, name="webhook",
+                 put_timeout=DEFAULT_PUT_TIMEOUT):
+        """
+        初始化派送器
+
+        參數:
+            process_func: 處理單一事件的函數，接收 submit 時傳入的項目
+            workers: 工作執行緒（通道）數量
+            queue_size: 所有通道合計的佇列上限，平均分配給各通道
+            name: 執行緒與指標名稱
+            put_timeout: 通道已滿時呼叫端等待的秒數，逾時改由呼叫端直接處理
+        """
+        self.process_func = process_func
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.name = name
+        self.put_timeout = put_timeout
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queues = []
+        self._threads = []
+        self._next_lane = 0
+
+        self._busy = 0
+        self._max_depth = 0
+        self._counters = {"submitted": 0, "queued": 0, "caller_runs": 0, "processed": 0, "failed": 0}
+        self._queue_waits = deque(maxlen=SAMPLE_SIZE)
+        self._run_times = deque(maxlen=SAMPLE_SIZE)
+
+    def _ensure_started(self):
+        """確保目前程序的工作執行緒已啟動（fork 後會重新建立）"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            lane_size = max(1, self.queue_size // self.workers)
+            self._queues = [queue.Queue(maxsize=lane_size) for _ in range(self.workers)]
+            self._busy = 0
+            self._threads = []
+            for i, lane_queue in enumerate(self._queues):
+                thread = threading.Thread(target=self._worker, args=(lane_queue,),
+                                          name=f"{self.name}-lane-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+            logger.info(f"{self.name} 工作池已啟動: {self.workers} 個通道, 每個通道佇列上限 {lane_size}")
+
+    def _lane_for(self, key):
+        """依排序鍵選擇通道；沒有排序鍵的事件輪流分配"""
+        if key is None:
+            with self._lock:
+                lane = self._next_lane
+                self._next_lane = (self._next_lane + 1) % self.workers
+            return lane
+        # 使用 crc32 而非 hash()，讓不同程序對同一個鍵得到相同的通道
+        return zlib.crc32(str(key).encode('utf-8')) % self.workers
+
+    def _run(self, item):
+        """執行一個事件並記錄處理時間"""
+        started = time.monotonic()
+        try:
+            self.process_func(item)
+            outcome = "processed"
+        except Exception as e:
+            logger.error(f"{self.name} 事件處理失敗: {str(e)}", exc_info=True)
+            outcome = "failed"
+        with self._lock:
+            self._counters[outcome] += 1
+            self._run_times.append(time.monotonic() - started)
+
+    def _worker(self, work_queue):
+        """工作執行緒主迴圈：依序處理一個通道的事件"""
+        while True:
+            enqueued_at, item = work_queue.get()
+            with self._lock:
+                self._busy += 1
+                self._queue_waits.append(time.monotonic() - enqueued_at)
+            try:
+                self._run(item)
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                work_queue.task_done()
+
+    def _depth(self):
+        """所有通道目前的佇列深度合計"""
+        return sum(lane_queue.qsize() for lane_queue in self._queues)
+
+    def submit(self, item, key=None):
+        """
+        送出一個事件
+
+        參數:
+            item: 傳給 process_func 的項目
+            key: 排序鍵（例如使用者 ID），相同鍵的事件會依序處理
+
+        返回:
+            bool: True 表示已排入佇列，False 表示通道已滿、已由呼叫端直接處理
+        """
+        self._ensure_started()
+        lane_queue = self._queues[self._lane_for(key)]
+        with self._lock:
+            self._counters["submitted"] += 1
+        try:
+            lane_queue.put((time.monotonic(), item), timeout=self.put_timeout)
+        except queue.Full:
+            # 此時同一排序鍵的事件可能還在通道中，順序無法保證，但不會遺失事件
+            logger.warning(f"{self.name} 通道已滿 ({lane_queue.maxsize})，由請求執行緒直接處理事件")
+            with self._lock:
+                self._counters["caller_runs"] += 1
+            self._run(item)
+            return False
+
+        with self._lock:
+            self._counters["queued"] += 1
+            self._max_depth = max(self._max_depth, self._depth())
+        return True
+
+    def get_stats(self):
+        """
+        獲取工作池的背壓指標
+
+        返回:
+            dict: 佇列深度、忙碌執行緒數、計數器與等待/處理時間
+        """
+        with self._lock:
+            waits = list(self._queue_waits)
+            runs = list(self._run_times)
+            return {
+                "workers": self.workers,
+                "busy_workers": self._busy,
+                "queue_depth": self._depth(),
+                "lane_depths": [lane_queue.qsize() for lane_queue in self._queues],
+                "queue_size": self.queue_size,
+                "max_queue_depth": self._max_depth,
+                "counters": dict(self._counters),
+                "queue_wait_seconds": {"p50": round(_percentile(waits, 0.5), 3),
+                                       "p95": round(_percentile(waits, 0.95), 3)},
+                "processing_seconds": {"p50": round(_percentile(runs, 0.5), 3),
+                                       "p95": round(_percentile(runs, 0.95), 3)},
+            }
+
+    def render_prometheus(self):
+        """
+        以 Prometheus 文字格式輸出工作池指標
+
+        返回:
+            str: Prometheus exposition 格式的文字
+        """
+        stats = self.get_stats()
+        prefix = f"{self.name}_dispatcher"
+        lines = [f"# TYPE {prefix}_events_total counter"]
+        for key, value in stats["counters"].items():
+            lines.append(f'{prefix}_events_total{{outcome="{key}"}} {value}')
+        for key in ("workers", "busy_workers", "queue_depth", "queue_size", "max_queue_depth"):
+            lines.append(f"# TYPE {prefix}_{key} gauge")
+            lines.append(f"{prefix}_{key} {stats[key]}")
+        lines.append(f"# TYPE {prefix}_lane_depth gauge")
+        for i, depth in enumerate(stats["lane_depths"]):
+            lines.append(f'{prefix}_lane_depth{{lane="{i}"}} {depth}')
+        for key in ("queue_wait_seconds", "processing_seconds"):
+            lines.append(f"# TYPE {prefix}_{key} summary")
+            for q in ("p50", "p95"):
+                quantile = "0.5" if q == "p50" else "0.95"
+                lines.append(f'{prefix}_{key}{{quantile="{quantile}"}} {stats[key][q]}')
+        return "\n".join(lines) + "\n"
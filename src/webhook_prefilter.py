@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Webhook 事件預先過濾模組
+在熱鬧的群組中，大部分訊息都不是給機器人的，但每則訊息原本都要經過持久化佇列、
+SDK 的事件模型反序列化與 handle_message 才會被 is_ai_request 排除。
+
+本模組直接檢查拆分後的原始事件 dict（events[].message.text），
+用編譯好的觸發詞比對判斷：群組或聊天室中既不是觸發詞、也不是指令的文字訊息，
+在建立任何 SDK 物件之前就丟棄，並記錄丟棄數量
+
+啟用訊息合併時，觸發詞通過過濾的同時就為該使用者開啟後續訊息窗口：
+同一請求體中稍後的事件、以及派送執行緒還沒處理到觸發詞之前到達的後續訊息都會保留，
+不必等 handle_message 開啟合併窗口
+"""
+
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 導入觸發詞比對
+try:
+    from src.trigger_matcher import match_trigger
+except ImportError:
+    from trigger_matcher import match_trigger
+
+# 丟棄/保留原因
+REASON_NOT_TEXT = "not_text"            # 非文字訊息事件（follow、join、圖片等）一律保留
+REASON_DIRECT_CHAT = "direct_chat"      # 一對一聊天一律保留
+REASON_TRIGGER = "trigger"              # 觸發詞
+REASON_COMMAND = "command"              # 不需要觸發詞的指令
+REASON_FOLLOW_UP = "follow_up"          # 觸發詞之後、後續訊息窗口內的訊息
+REASON_KEEP_HOOK = "keep_hook"          # 呼叫端指定保留（例如訊息合併窗口仍開啟）
+REASON_NOT_ADDRESSED = "not_addressed"  # 群組/聊天室中不是給機器人的訊息（丟棄）
+
+
+class WebhookPrefilter:
+    """以原始事件 dict 判斷是否需要處理的過濾器"""
+
+    def __init__(self, exact_commands=(), command_prefixes=(), keep_func=None, enabled=True,
+                 casefold_commands=(), follow_up_window=0, follow_up_max_delay=None):
+        """
+        初始化過濾器
+
+        參數:
+            exact_commands: 整則訊息（去除前後空白）完全相同時視為指令
+            command_prefixes: 訊息以這些字串開頭時視為指令
+            keep_func: 額外的保留條件，接收 (chat_id, user_id)，返回 True 表示保留
+            enabled: 是否啟用（停用時所有事件都保留）
+            casefold_commands: 整則訊息（去除前後空白）不分大小寫相同時視為指令
+            follow_up_window: 觸發詞之後保留同一使用者訊息的秒數（每則後續訊息重新計算），0 表示停用
+            follow_up_max_delay: 從觸發詞開始最多保留的秒數，預設為窗口的 4 倍（與訊息合併的設定相同）
+        """
+        self.exact_commands = frozenset(exact_commands)
+        self.casefold_commands = frozenset(command.lower() for command in casefold_commands)
+        self.command_prefixes = tuple(command_prefixes)
+        self.keep_func = keep_func
+        self.enabled = enabled
+        self.follow_up_window = max(follow_up_window, 0)
+        self.follow_up_max_delay = follow_up_max_delay or self.follow_up_window * 4
+        self._follow_ups = {}  # (chat_id, user_id) -> [開始時間, 截止時間]
+        self._lock = threading.Lock()
+        self._counters = {"inspected": 0, "dropped": 0}
+        self._reasons = {}
+
+    def _classify(self, event):
+        """返回 (是否保留, 原因)"""
+        message = event.get("message") or {}
+        if event.get("type") != "message" or message.get("type") != "text":
+            return True, REASON_NOT_TEXT
+
+        source = event.get("source") or {}
+        chat_id = source.get("groupId") or source.get("roomId")
+        if not chat_id:
+            return True, REASON_DIRECT_CHAT
+
+        text = (message.get("text") or "").strip()
+        if (text in self.exact_commands or text.lower() in self.casefold_commands
+                or text.startswith(self.command_prefixes)):
+            return True, REASON_COMMAND
+        key = (chat_id, source.get("userId"))
+        if match_trigger(text).is_trigger:
+            self._open_follow_up(key)
+            return True, REASON_TRIGGER
+        if self._extend_follow_up(key):
+            return True, REASON_FOLLOW_UP
+        if self.keep_func is not None and self.keep_func(chat_id, source.get("userId")):
+            return True, REASON_KEEP_HOOK
+        return False, REASON_NOT_ADDRESSED
+
+    def _open_follow_up(self, key):
+        """觸發詞通過時開啟（或延長）該使用者的後續訊息窗口"""
+        if not self.follow_up_window:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not self._extend_locked(key, now):
+                self._follow_ups[key] = [now, now + self.follow_up_window]
+            if len(self._follow_ups) > 1024:
+                for expired in [k for k, (_, deadline) in self._follow_ups.items() if deadline <= now]:
+                    del self._follow_ups[expired]
+
+    def _extend_follow_up(self, key):
+        """後續訊息窗口仍開啟時延長窗口並返回 True"""
+        if not self.follow_up_window:
+            return False
+        with self._lock:
+            return self._extend_locked(key, time.monotonic())
+
+    def _extend_locked(self, key, now):
+        """與訊息合併相同：每則訊息延後 window 秒，但從第一則開始最多 max_delay 秒（呼叫端需持有鎖）"""
+        window = self._follow_ups.get(key)
+        if window is None or window[1] <= now:
+            return False
+        window[1] = min(now + self.follow_up_window, window[0] + self.follow_up_max_delay)
+        return True
+
+    def should_process(self, event):
+        """
+        判斷事件是否需要交給 SDK 處理
+
+        參數:
+            event: 拆分後的 webhook 事件 dict
+
+        返回:
+            bool: False 表示可以直接丟棄
+        """
+        if not self.enabled:
+            return True
+        keep, reason = self._classify(event)
+        with self._lock:
+            self._counters["inspected"] += 1
+            self._reasons[reason] = self._reasons.get(reason, 0) + 1
+            if not keep:
+                self._counters["dropped"] += 1
+        return keep
+
+    def get_stats(self):
+        """
+        獲取過濾統計
+
+        返回:
+            dict: 檢查數、丟棄數、丟棄比例與各原因的數量
+        """
+        with self._lock:
+            inspected = self._counters["inspected"]
+            return {
+                "enabled": self.enabled,
+                "inspected": inspected,
+                "dropped": self._counters["dropped"],
+                "drop_ratio": round(self._counters["dropped"] / inspected, 3) if inspected else 0.0,
+                "reasons": dict(self._reasons),
+            }
+
+    def render_prometheus(self, prefix="webhook_prefilter"):
+        """以 Prometheus 文字格式輸出過濾指標"""
+        stats = self.get_stats()
+        lines = [f"# TYPE {prefix}_events_total counter"]
+        for reason, value in stats["reasons"].items():
+            lines.append(f'{prefix}_events_total{{reason="{reason}"}} {value}')
+        lines.append(f"# TYPE {prefix}_dropped_total counter")
+        lines.append(f"{prefix}_dropped_total {stats['dropped']}")
+        return "\n".join(lines) + "\n"
@@ -40,4 +40,4 @@ fi
 
 # 啟動應用程式
 echo -e "${GREEN}啟動 LINE Bot 應用程式...${NC}"
-exec gunicorn app:app
+exec gunicorn -c gunicorn.conf.py app:app